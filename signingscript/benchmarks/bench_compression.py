@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""Compare single stream and block-parallel tarball compression.
+
+Generates a tree of semi-compressible files, then times creating a tarball of
+it with the single stream path (`compression_workers: 1`) and with the
+block-parallel path, for each compression.
+
+    python benchmarks/bench_compression.py --size-mb 200 --workers 8
+"""
+
+import argparse
+import os
+import random
+import tarfile
+import tempfile
+import time
+
+# Import signingscript.sign via signingscript.script, to avoid the
+# signingscript.sign <-> signingscript.task import cycle
+import signingscript.script  # noqa: F401
+from signingscript.compression import DEFAULT_BLOCK_SIZES, create_parallel_tarfile
+from signingscript.sign import _create_xz_tarfile, _owner_filter
+
+
+def make_tree(root, size_mb, file_size_mb=4):
+    """Write `size_mb` of files under `root` that compress roughly like binaries do."""
+    rng = random.Random(0)
+    words = [rng.randbytes(rng.randint(2, 12)) for _ in range(4096)]
+    files = []
+    for i in range(max(1, size_mb // file_size_mb)):
+        path = os.path.join(root, f"dir{i % 8}", f"file{i}")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as fh:
+            written = 0
+            while written < file_size_mb * 1024 * 1024:
+                chunk = b"".join(rng.choices(words, k=4096)) + rng.randbytes(4096)
+                fh.write(chunk)
+                written += len(chunk)
+        files.append(path)
+    return files
+
+
+def single_stream(to, files, root, compression):
+    if compression == "xz":
+        return _create_xz_tarfile(to, files, root)
+    with tarfile.open(to, mode=f"w:{compression}") as t:
+        for f in files:
+            t.add(f, arcname=os.path.relpath(f, root), filter=_owner_filter)
+    return to
+
+
+def run(name, func, *args):
+    start = time.monotonic()
+    to = func(*args)
+    elapsed = time.monotonic() - start
+    size = os.path.getsize(to)
+    os.unlink(to)
+    print(f"{name:<28} {elapsed:8.2f}s {size / 1024 / 1024:10.2f}MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=int, default=64)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--compression", choices=sorted(DEFAULT_BLOCK_SIZES), action="append")
+    parser.add_argument("--block-size-mb", type=int, help="defaults to the per-compression default")
+    args = parser.parse_args()
+    block_size = args.block_size_mb * 1024 * 1024 if args.block_size_mb else None
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        root = os.path.join(tmp_dir, "tree")
+        files = make_tree(root, args.size_mb)
+        print(f"{len(files)} files, {args.size_mb}MiB, {args.workers} workers")
+        for compression in args.compression or ("gz", "bz2", "xz"):
+            to = os.path.join(tmp_dir, f"out.tar.{compression}")
+            run(f"{compression} single stream", single_stream, to, files, root, compression)
+            run(f"{compression} parallel", create_parallel_tarfile, to, files, root, compression, args.workers, block_size, _owner_filter)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+"""Compare detached signing of large files by digest and by upload.
+
+Writes a file of each size, then signs it against a local fake autograph
+server, once with `sign_file_detached` (which hashes locally and sends the
+digest to `/sign/hash`), and once through autograph's `/sign/data` method,
+which is what `sign_gpg_with_autograph` uses. Each run happens in a fresh
+process, so its peak RSS is its own. The server counts the request bytes it
+receives.
+
+    python benchmarks/bench_detached.py --size-gb 1 --size-gb 10 --dir /big/tmp
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+import aiohttp.web
+
+# Import signingscript.sign via signingscript.script, to avoid the
+# signingscript.sign <-> signingscript.task import cycle
+import signingscript.script  # noqa: F401
+from signingscript.sign import sign_file_detached, sign_with_autograph
+from signingscript.utils import Autograph
+
+CERT_TYPE = "project:releng:signing:cert:dep-signing"
+FORMATS = {"hash": "autograph_hash_only_mar384", "data": "autograph_gpg"}
+
+
+def write_file(path, size, block_size=1024 * 1024):
+    block = os.urandom(block_size)
+    with open(path, "wb") as fh:
+        for _ in range(size // block_size):
+            fh.write(block)
+        fh.write(block[: size % block_size])
+
+
+class FakeAutograph:
+    """Accept any signing request, and count how many bytes were sent."""
+
+    def __init__(self):
+        self.received = 0
+
+    async def handle(self, request):
+        async for chunk in request.content.iter_chunked(1024 * 1024):
+            self.received += len(chunk)
+        return aiohttp.web.json_response([{"signature": base64.b64encode(b"\0" * 512).decode("ascii")}])
+
+
+async def run_one(url, method, path):
+    """Sign `path` with `method`, in this process, and report the time and peak RSS."""
+    server = Autograph(url, "user", "key", set(FORMATS.values()))
+
+    class Context:
+        config = {"taskcluster_scope_prefixes": ["project:releng:signing:"]}
+        task = {"scopes": [CERT_TYPE]}
+        autograph_configs = {CERT_TYPE: [server]}
+
+    start = time.monotonic()
+    async with aiohttp.ClientSession() as session:
+        Context.session = session
+        if method == "hash":
+            await sign_file_detached(Context, path, FORMATS["hash"])
+        else:
+            with open(path, "rb") as fh:
+                await sign_with_autograph(session, server, fh, FORMATS["data"], "data")
+    elapsed = time.monotonic() - start
+    print(json.dumps({"elapsed": elapsed, "maxrss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}))
+
+
+async def run_all(sizes, methods, tmp_dir):
+    fake = FakeAutograph()
+    app = aiohttp.web.Application(client_max_size=0)
+    app.router.add_post("/sign/{method}", fake.handle)
+    runner = aiohttp.web.AppRunner(app)
+    await runner.setup()
+    site = aiohttp.web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+    try:
+        print(f"{'size':>6} {'method':<6} {'time':>9} {'sent':>15} {'peak rss':>12}")
+        for size_gb in sizes:
+            path = os.path.join(tmp_dir, f"{size_gb}gb.bin")
+            write_file(path, int(size_gb * 1024**3))
+            for method in methods:
+                fake.received = 0
+                proc = await asyncio.create_subprocess_exec(sys.executable, __file__, "--run-one", method, "--url", url, path, stdout=subprocess.PIPE)
+                out, _ = await proc.communicate()
+                if proc.returncode:
+                    raise SystemExit(f"{method} failed for {size_gb}GB")
+                result = json.loads(out.decode().splitlines()[-1])
+                print(f"{size_gb:>4}GB {method:<6} {result['elapsed']:8.2f}s {fake.received / 1024:12.1f}KiB {result['maxrss_kb'] / 1024:10.2f}MiB")
+            os.unlink(path)
+    finally:
+        await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-gb", type=float, action="append", help="defaults to 1, 2, 5 and 10")
+    parser.add_argument("--method", choices=sorted(FORMATS), action="append")
+    parser.add_argument("--dir", help="where to write the test files; they need up to the largest size free")
+    parser.add_argument("--run-one", choices=sorted(FORMATS), help=argparse.SUPPRESS)
+    parser.add_argument("--url", help=argparse.SUPPRESS)
+    parser.add_argument("path", nargs="?", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        asyncio.run(run_one(args.url, args.run_one, args.path))
+        return
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp_dir:
+        asyncio.run(run_all(args.size_gb or (1, 2, 5, 10), args.method or sorted(FORMATS), tmp_dir))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""Compare converting a dmg to a tarball with `tar czf`, and with `_convert_dmg_to_tar_gz`.
+
+With `--dmg`, both conversions run on that dmg with the `dmg` and `hfsplus`
+tools from libdmg-hfsplus. Use a shippable Firefox dmg for representative
+numbers. Without it, the extraction stages are skipped, and a generated app
+tree stands in for the extracted dmg, which times just the tarball stage.
+
+    python benchmarks/bench_dmg.py --dmg Firefox.dmg --dmg-tool dmg --hfsplus-tool hfsplus --workers 8
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+# Import signingscript.sign via signingscript.script, to avoid the
+# signingscript.sign <-> signingscript.task import cycle
+import signingscript.script  # noqa: F401
+from signingscript.sign import _convert_dmg_to_tar_gz, _create_tarfile
+
+from bench_compression import make_tree  # isort: skip
+
+
+class Context:
+    def __init__(self, work_dir, **config):
+        self.config = {"work_dir": work_dir, **config}
+
+
+def tar_czf(context, from_):
+    """Convert the dmg the way signingscript used to."""
+    work_dir = context.config["work_dir"]
+    to = from_.replace(".dmg", ".tar.gz")
+    with tempfile.TemporaryDirectory(dir=work_dir) as temp_dir:
+        app_dir = os.path.join(temp_dir, "app")
+        os.mkdir(app_dir)
+        if "dmg" in context.config:
+            subprocess.check_call([context.config["dmg"], "extract", os.path.join(work_dir, from_), "tmp.hfs"], cwd=temp_dir, stdout=subprocess.DEVNULL)
+            subprocess.check_call([context.config["hfsplus"], "tmp.hfs", "extractall", "/", app_dir], cwd=temp_dir, stdout=subprocess.DEVNULL)
+        else:
+            shutil.copytree(context.config["tree"], app_dir, dirs_exist_ok=True, symlinks=True)
+        subprocess.check_call(["tar", "czf", os.path.join(work_dir, to), "."], cwd=app_dir)
+    return to
+
+
+async def pipelined(context, from_):
+    if "dmg" in context.config:
+        return await _convert_dmg_to_tar_gz(context, from_)
+    to = from_.replace(".dmg", ".tar.gz")
+    with tempfile.TemporaryDirectory(dir=context.config["work_dir"]) as temp_dir:
+        app_dir = os.path.join(temp_dir, "app")
+        shutil.copytree(context.config["tree"], app_dir, symlinks=True)
+        await _create_tarfile(context, os.path.join(context.config["work_dir"], to), [app_dir], "gz", tmp_dir=app_dir)
+    return to
+
+
+def run(name, context, func, from_):
+    start = time.monotonic()
+    to = func(context, from_)
+    elapsed = time.monotonic() - start
+    to = os.path.join(context.config["work_dir"], to)
+    size = os.path.getsize(to)
+    os.unlink(to)
+    print(f"{name:<24} {elapsed:8.2f}s {size / 1024 / 1024:10.2f}MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dmg", help="the dmg to convert")
+    parser.add_argument("--dmg-tool", default="dmg")
+    parser.add_argument("--hfsplus-tool", default="hfsplus")
+    parser.add_argument("--size-mb", type=int, default=400, help="the size of the generated app tree, without --dmg")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--dir", help="the work dir; it needs a few times the size of the app free")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as work_dir:
+        config = {"compression_workers": args.workers}
+        if args.dmg:
+            shutil.copyfile(args.dmg, os.path.join(work_dir, "app.dmg"))
+            config.update(dmg=args.dmg_tool, hfsplus=args.hfsplus_tool)
+            print(f"{args.dmg}, {os.path.getsize(args.dmg) / 1024 / 1024:.2f}MiB, {args.workers} workers")
+        else:
+            config["tree"] = os.path.join(work_dir, "tree", "Firefox.app")
+            make_tree(config["tree"], args.size_mb)
+            print(f"generated {args.size_mb}MiB app, tarball stage only, {args.workers} workers")
+        context = Context(work_dir, **config)
+        run("tar czf", context, tar_czf, "app.dmg")
+        run("pipelined", context, lambda *a: asyncio.run(pipelined(*a)), "app.dmg")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+"""Fixtures for the pytest-benchmark suite in this directory.
+
+The suite needs pytest-benchmark, which is in the dev dependencies, and is
+skipped without it. `tox -e benchmarks` runs it; pass pytest arguments
+after `--`:
+
+    tox -e benchmarks -- py.test benchmarks --bench-size-mb 10 --bench-size-mb 2048 --bench-dir /big/tmp --benchmark-autosave
+
+Each benchmark runs against synthetic archives of each `--bench-size-mb`,
+which are written to `--bench-dir` and reused when they're already there.
+Alongside the timings, each benchmark's `extra_info` has the peak RSS, the
+bytes written and the per stage signing metrics of its slowest round, so
+they end up in the saved json too. To gate a change on the timings:
+
+    python -m pytest benchmarks --benchmark-compare --benchmark-compare-fail=mean:10%
+
+and on memory, with `--bench-max-rss-mb`.
+"""
+
+import os
+import random
+import re
+import shutil
+import tempfile
+import zipfile
+
+import pytest
+
+# Import signingscript.sign via signingscript.script, to avoid the
+# signingscript.sign <-> signingscript.task import cycle
+import signingscript.script  # noqa: F401
+from bench_compression import make_tree
+from fake_autograph import FakeAutograph, serve
+from mardor.writer import MarWriter
+from signingscript.utils import Autograph
+
+from signingscript import metrics
+
+CERT_TYPE = "project:releng:signing:cert:dep-signing"
+MAR_CHANNEL = "firefox-mozilla-central"
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("signingscript benchmarks")
+    group.addoption("--bench-size-mb", type=int, action="append", help="the size of the synthetic inputs, in MiB; can be repeated. Defaults to 10")
+    group.addoption("--bench-dir", help="where to write the synthetic inputs, and reuse them from; defaults to a temporary directory")
+    group.addoption("--bench-max-rss-mb", type=int, help="fail benchmarks whose peak RSS grows by more than this")
+
+
+def pytest_generate_tests(metafunc):
+    if "size_mb" in metafunc.fixturenames:
+        sizes = metafunc.config.getoption("--bench-size-mb") or [10]
+        metafunc.parametrize("size_mb", sizes, ids=[f"{size}MiB" for size in sizes])
+
+
+def write_text_files(root, size_mb, file_size=16 * 1024):
+    """Write `size_mb` of small, very compressible files under `root`, like the js and css in an omni.ja."""
+    rng = random.Random(1)
+    words = [b"function", b"return", b"const", b"this", b"window", b"let", b"=", b"{", b"}", b"(", b")", b";", b"\n"]
+    words += [rng.randbytes(6).hex().encode("ascii") for _ in range(256)]
+    files = []
+    for i in range(max(1, size_mb * 1024 * 1024 // file_size)):
+        path = os.path.join(root, f"chrome{i % 16}", f"content{i % 64}", f"file{i}.js")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as fh:
+            fh.write(b" ".join(rng.choices(words, k=file_size // 6))[:file_size])
+        files.append(path)
+    return files
+
+
+class Synthetic:
+    """Build the synthetic inputs, once per size.
+
+    Application trees are 90% binary-like files and 10% small text files.
+    Builds are named by size, and reused from earlier runs if they exist.
+
+    Args:
+        root (str): the directory to write them to
+
+    """
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def _build(self, name, build):
+        path = os.path.join(self.root, name)
+        if not os.path.exists(path):
+            tmp_path = f"{path}.tmp"
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            build(tmp_path)
+            os.rename(tmp_path, path)
+        return path
+
+    def tree(self, size_mb):
+        """Return the root of an application tree of `size_mb`."""
+
+        def build(path):
+            make_tree(os.path.join(path, "bin"), max(1, size_mb * 9 // 10))
+            write_text_files(os.path.join(path, "resources"), max(1, size_mb // 10))
+
+        return self._build(f"tree-{size_mb}", build)
+
+    def files(self, size_mb):
+        """Return the paths to the files in the application tree of `size_mb`."""
+        return sorted(os.path.join(parent, f) for parent, _, files in os.walk(self.tree(size_mb)) for f in files)
+
+    def zipfile(self, size_mb):
+        """Return a deflated zip of the application tree of `size_mb`."""
+        root = self.tree(size_mb)
+
+        def build(path):
+            with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as z:
+                for f in self.files(size_mb):
+                    z.write(f, os.path.relpath(f, root))
+
+        return self._build(f"tree-{size_mb}.zip", build)
+
+    def blob(self, size_mb):
+        """Return a single binary-like file of `size_mb`."""
+
+        def build(path):
+            os.makedirs(path)
+            make_tree(path, size_mb, file_size_mb=size_mb)
+
+        return os.path.join(self._build(f"blob-{size_mb}", build), "dir0", "file0")
+
+    def omnija(self, size_mb):
+        """Return an omni.ja of `size_mb`, and a copy of it signed by autograph.
+
+        Like autograph's, the signed copy isn't optimized for preloading, and
+        has META-INF entries added.
+        """
+
+        def build_orig(path):
+            src = f"{path}-src"
+            shutil.rmtree(src, ignore_errors=True)
+            with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as z:
+                for f in write_text_files(src, size_mb):
+                    z.write(f, os.path.relpath(f, src))
+            shutil.rmtree(src)
+
+        def build_signed(path):
+            shutil.copyfile(orig, path)
+            with zipfile.ZipFile(path, "a", compression=zipfile.ZIP_DEFLATED) as z:
+                for name in ("manifest.mf", "mozilla.sf", "mozilla.rsa", "cose.manifest", "cose.sig"):
+                    z.writestr(f"META-INF/{name}", os.urandom(4096))
+
+        orig = self._build(f"omni-{size_mb}.ja", build_orig)
+        return orig, self._build(f"omni-{size_mb}-signed.ja", build_signed)
+
+    def mar(self, size_mb):
+        """Return an unsigned MAR of the application tree of `size_mb`."""
+        root = self.tree(size_mb)
+
+        def build(path):
+            cwd = os.getcwd()
+            with open(path, "w+b") as fh, MarWriter(fh, productversion="149.0a1", channel=MAR_CHANNEL) as m:
+                # MAR entries are named by the paths they're added with
+                os.chdir(root)
+                try:
+                    for f in self.files(size_mb):
+                        m.add(os.path.relpath(f, root))
+                finally:
+                    os.chdir(cwd)
+
+        return self._build(f"tree-{size_mb}.mar", build)
+
+
+@pytest.fixture(scope="session")
+def synthetic(request):
+    bench_dir = request.config.getoption("--bench-dir")
+    if bench_dir:
+        os.makedirs(bench_dir, exist_ok=True)
+        yield Synthetic(bench_dir)
+    else:
+        with tempfile.TemporaryDirectory(prefix="signingscript-bench") as tmp_dir:
+            yield Synthetic(tmp_dir)
+
+
+@pytest.fixture(scope="session")
+def fake_autograph():
+    fake = FakeAutograph()
+    with serve(fake) as url:
+        fake.url = url
+        yield fake
+
+
+@pytest.fixture
+def context(tmp_path, fake_autograph, mocker):
+    """Return a signing context that signs with the fake autograph server."""
+    public_key = tmp_path / "autograph.pem"
+    public_key.write_bytes(fake_autograph.public_key)
+    mocker.patch("signingscript.sign.get_mar_verification_key", return_value=str(public_key))
+
+    class Context:
+        config = {"work_dir": str(tmp_path / "work"), "taskcluster_scope_prefixes": ["project:releng:signing:"]}
+        task = {"scopes": [CERT_TYPE]}
+        autograph_configs = {CERT_TYPE: [Autograph(fake_autograph.url, "user", "key", ["autograph_hash_only_mar384"])]}
+        mar_channels = {CERT_TYPE: [MAR_CHANNEL]}
+
+    os.makedirs(Context.config["work_dir"])
+    return Context
+
+
+def reset_peak_rss():
+    """Reset the peak RSS to the current RSS, where the kernel supports it.
+
+    Returns:
+        int: the current RSS, in KiB
+
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as fh:
+            fh.write("5")
+    except OSError:
+        return metrics.get_rss()
+    return _proc_status("VmRSS")
+
+
+def get_peak_rss():
+    """Return the peak RSS since the last `reset_peak_rss`, in KiB."""
+    return _proc_status("VmHWM") or metrics.get_rss()
+
+
+def _proc_status(field):
+    try:
+        with open("/proc/self/status") as fh:
+            return int(re.search(rf"^{field}:\s+(\d+)", fh.read(), re.M).group(1))
+    except (OSError, AttributeError):
+        return 0
+
+
+def get_bytes_written():
+    """Return how many bytes this process has passed to write(2) and friends, or None if unknown."""
+    try:
+        with open("/proc/self/io") as fh:
+            return int(re.search(r"^wchar:\s+(\d+)", fh.read(), re.M).group(1))
+    except (OSError, AttributeError):
+        return None
+
+
+@pytest.fixture
+def measure(benchmark, request):
+    """Benchmark a function, and record its peak RSS, bytes written and signing stages.
+
+    Call it with the function and its args. Each round runs with a fresh
+    `SigningMetrics` collector. The `extra_info` is from the slowest round.
+    """
+    max_rss_mb = request.config.getoption("--bench-max-rss-mb")
+
+    def run(func, *args, rounds=3, setup=None):
+        info = {}
+
+        def target():
+            start_rss = reset_peak_rss()
+            start_written = get_bytes_written()
+            with metrics.activate(metrics.SigningMetrics()) as collector:
+                result = func(*args)
+            written = get_bytes_written()
+            peak_rss = get_peak_rss()
+            summary = collector.as_dict()
+            if summary["elapsed_seconds"] >= info.get("elapsed_seconds", 0):
+                info.update(
+                    elapsed_seconds=summary["elapsed_seconds"],
+                    peak_rss_kb=peak_rss,
+                    rss_growth_kb=peak_rss - start_rss,
+                    bytes_written=None if written is None else written - start_written,
+                    stages=summary["summary"]["by_stage"],
+                )
+            info["max_rss_growth_kb"] = max(info.get("max_rss_growth_kb", 0), peak_rss - start_rss)
+            return result
+
+        result = benchmark.pedantic(target, setup=setup, rounds=rounds, iterations=1)
+        benchmark.extra_info.update(info)
+        if max_rss_mb is not None:
+            assert info["max_rss_growth_kb"] <= max_rss_mb * 1024, f"peak RSS grew by {info['max_rss_growth_kb'] // 1024}MiB"
+        return result
+
+    return run
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+"""A local stand-in for autograph, for benchmarks and load tests.
+
+It implements autograph's `/sign/file`, `/sign/files`, `/sign/hash` and
+`/sign/data` endpoints, and rejects requests whose HAWK authorization
+doesn't verify against its credentials, with a 401 like autograph does.
+`/sign/hash` signs each input hash with an RSA key made at startup, so
+signatures verify against `public_key`. The other endpoints hand the input
+back as its own "signed" file or signature.
+
+Latency and errors can be injected: each request is delayed by `latency`
+plus up to `jitter` seconds, and fails with `error_status` at `error_rate`.
+The server counts the requests, errors and request bytes it receives, and
+the most requests it had in flight at once; see `stats`.
+
+`serve` runs it in a thread with its own event loop, so it can be called
+from synchronous code, and from code that runs its own event loops. It can
+also be run on its own, for clients in other processes like iscript:
+
+    python benchmarks/fake_autograph.py --port 9110 --credentials user:key --latency 0.2 --error-rate 0.05
+"""
+
+import argparse
+import asyncio
+import base64
+import contextlib
+import json
+import random
+import threading
+
+import aiohttp.web
+import mohawk
+import mohawk.exc
+from mardor.signing import make_rsa_keypair, sign_hash
+
+HASH_ALGORITHMS = {20: "sha1", 32: "sha256", 48: "sha384", 64: "sha512"}
+DEFAULT_CREDENTIALS = {"user": "key"}
+
+
+class InjectedError(Exception):
+    """An error the server was asked to inject."""
+
+
+class FakeAutograph:
+    """Handle autograph signing requests.
+
+    Args:
+        credentials (dict, optional): HAWK keys by id. If None, requests
+            aren't authenticated.
+        key_size (int, optional): the size of the RSA key hashes are signed with
+        latency (float, optional): how many seconds to delay each response by
+        jitter (float, optional): up to how many more seconds to delay each
+            response by, at random
+        error_rate (float, optional): the fraction of requests to fail
+        error_status (int, optional): the status of failed requests
+        seed (int, optional): the seed for the jitter and errors
+
+    """
+
+    def __init__(self, credentials=DEFAULT_CREDENTIALS, key_size=4096, latency=0.0, jitter=0.0, error_rate=0.0, error_status=503, seed=None):
+        self.credentials = credentials
+        self.private_key, self.public_key = make_rsa_keypair(key_size)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self._random = random.Random(seed)
+        self._nonces = set()
+        self.in_flight = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        """Reset the request counts."""
+        self.requests = 0
+        self.received = 0
+        self.errors = 0
+        self.unauthorized = 0
+        self.max_in_flight = self.in_flight
+
+    def stats(self):
+        """Return the request counts, as a dict."""
+        return {
+            "requests": self.requests,
+            "received": self.received,
+            "errors": self.errors,
+            "unauthorized": self.unauthorized,
+            "max_in_flight": self.max_in_flight,
+        }
+
+    def make_app(self):
+        """Return the aiohttp application."""
+        app = aiohttp.web.Application(client_max_size=0, middlewares=[self.track_requests])
+        app.router.add_post("/sign/hash", self.sign_hash)
+        app.router.add_post("/sign/file", self.sign_file)
+        app.router.add_post("/sign/files", self.sign_files)
+        app.router.add_post("/sign/data", self.sign_data)
+        return app
+
+    def _seen_nonce(self, sender_id, nonce, timestamp):
+        key = (sender_id, nonce, timestamp)
+        if key in self._nonces:
+            return True
+        self._nonces.add(key)
+        return False
+
+    def verify_hawk(self, request, body):
+        """Verify the HAWK authorization of `request`, and its payload hash.
+
+        Raises:
+            aiohttp.web.HTTPUnauthorized: if it doesn't verify
+
+        """
+        if self.credentials is None:
+            return
+        try:
+            mohawk.Receiver(
+                lambda sender_id: {"id": sender_id, "key": self.credentials[sender_id], "algorithm": "sha256"},
+                request.headers["Authorization"],
+                str(request.url),
+                request.method,
+                content=bytes(body),
+                content_type=request.headers.get("Content-Type", ""),
+                seen_nonce=self._seen_nonce,
+            )
+        except (KeyError, mohawk.exc.HawkFail) as e:
+            self.unauthorized += 1
+            raise aiohttp.web.HTTPUnauthorized(text=f"HAWK verification failed: {e!r}")
+
+    async def read_request(self, request):
+        """Read, authenticate and decode the signing requests in `request`.
+
+        Injected latency and errors happen here too.
+
+        Raises:
+            aiohttp.web.HTTPUnauthorized: if the request isn't authorized
+            InjectedError: if an error is injected
+
+        """
+        body = bytearray()
+        async for chunk in request.content.iter_chunked(1024 * 1024):
+            body += chunk
+        self.requests += 1
+        self.received += len(body)
+        self.verify_hawk(request, body)
+        delay = self.latency + self._random.uniform(0, self.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+        if self._random.random() < self.error_rate:
+            self.errors += 1
+            raise InjectedError()
+        return json.loads(body)
+
+    @aiohttp.web.middleware
+    async def track_requests(self, request, handler):
+        """Count the requests in flight, and turn injected errors into responses."""
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            return await handler(request)
+        except InjectedError:
+            return aiohttp.web.Response(status=self.error_status, text="injected error")
+        finally:
+            self.in_flight -= 1
+
+    async def sign_hash(self, request):
+        signing_requests = await self.read_request(request)
+        loop = asyncio.get_running_loop()
+        responses = []
+        for signing_request in signing_requests:
+            digest = base64.b64decode(signing_request["input"])
+            signature = await loop.run_in_executor(None, sign_hash, self.private_key, digest, HASH_ALGORITHMS[len(digest)])
+            responses.append({"signature": base64.b64encode(signature).decode("ascii")})
+        return aiohttp.web.json_response(responses)
+
+    async def sign_file(self, request):
+        return aiohttp.web.json_response([{"signed_file": r["input"]} for r in await self.read_request(request)])
+
+    async def sign_files(self, request):
+        return aiohttp.web.json_response([{"signed_files": r["files"]} for r in await self.read_request(request)])
+
+    async def sign_data(self, request):
+        return aiohttp.web.json_response([{"signature": r["input"]} for r in await self.read_request(request)])
+
+
+@contextlib.contextmanager
+def serve(fake, host="127.0.0.1", port=0):
+    """Serve `fake` in a background thread.
+
+    Args:
+        fake (FakeAutograph): the server to run
+        host (str, optional): the address to listen on
+        port (int, optional): the port to listen on; by default, any free port
+
+    Yields:
+        str: the server's url
+
+    """
+    loop = asyncio.new_event_loop()
+    runner = aiohttp.web.AppRunner(fake.make_app())
+    loop.run_until_complete(runner.setup())
+    site = aiohttp.web.TCPSite(runner, host, port)
+    loop.run_until_complete(site.start())
+    port = runner.addresses[0][1]
+    thread = threading.Thread(target=loop.run_forever, name="fake-autograph", daemon=True)
+    thread.start()
+    try:
+        yield f"http://{host}:{port}"
+    finally:
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9110)
+    parser.add_argument("--credentials", action="append", metavar="ID:KEY", help="HAWK credentials to accept; defaults to user:key")
+    parser.add_argument("--no-auth", action="store_true", help="accept unauthenticated requests")
+    parser.add_argument("--public-key", help="write the public key hashes are signed with to this file")
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    credentials = dict(c.split(":", 1) for c in args.credentials) if args.credentials else DEFAULT_CREDENTIALS
+    fake = FakeAutograph(
+        credentials=None if args.no_auth else credentials,
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        seed=args.seed,
+    )
+    if args.public_key:
+        with open(args.public_key, "wb") as fh:
+            fh.write(fake.public_key)
+    try:
+        aiohttp.web.run_app(fake.make_app(), host=args.host, port=args.port)
+    finally:
+        print(json.dumps(fake.stats()))
+
+
+if __name__ == "__main__":
+    main()
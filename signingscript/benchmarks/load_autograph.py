@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+"""Replay a recorded signing task against a local fake autograph server.
+
+Runs signingscript's `async_main` on the task's upstreamArtifacts, once for
+each combination of `--signing-concurrency` and `--autograph-concurrency`,
+against a `FakeAutograph` with the given latency and error rate. Each run
+reports how long it took, the requests the server got, the most it had in
+flight at once, the injected errors and the bytes sent, so concurrency
+limits can be tuned offline.
+
+    python benchmarks/load_autograph.py task.json --artifact-dir work_dir/cot \\
+        --signing-concurrency 1 --signing-concurrency 8 --autograph-concurrency 4 --latency 0.2 --error-rate 0.02
+
+The task is a task definition, like the `task.json` scriptworker writes to
+its work_dir. Artifacts are read from `<artifact-dir>/<taskId>/<path>`,
+like scriptworker's `work_dir/cot`. Those that are missing are made up, of
+`--size-mb`: MARs for `.mar` paths, zips for zip-like paths, tarballs for
+tarball paths, and random bytes otherwise. Other config, e.g. hash batching,
+can be set with `--config key=value`.
+
+Formats that need more than autograph, like `macapp` or the notarization
+formats, fail as they would without their tools and config.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import tarfile
+import tempfile
+import time
+import zipfile
+from unittest import mock
+
+from bench_detached import write_file
+from fake_autograph import FakeAutograph, serve
+from mardor.writer import MarWriter
+from scriptworker.context import Context
+from signingscript.script import async_main, get_default_config
+from signingscript.task import task_cert_type, task_signing_formats
+from signingscript.utils import split_autograph_format
+
+ZIP_EXTENSIONS = (".zip", ".xpi", ".jar", ".ja", ".apk", ".aab")
+TAR_EXTENSIONS = (".tar.gz", ".tgz", ".tar.bz2", ".tar.xz")
+
+
+def make_artifact(path, size_mb):
+    """Write a made up artifact of `size_mb` to `path`, of the type its name suggests."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    size = size_mb * 1024 * 1024
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        contents = os.path.join(tmp_dir, "contents")
+        write_file(contents, size)
+        if path.endswith(".mar"):
+            cwd = os.getcwd()
+            with open(path, "w+b") as fh, MarWriter(fh, productversion="149.0a1", channel="firefox-mozilla-central") as m:
+                # MAR entries are named by the paths they're added with
+                os.chdir(tmp_dir)
+                try:
+                    m.add("contents")
+                finally:
+                    os.chdir(cwd)
+        elif path.endswith(ZIP_EXTENSIONS):
+            with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as z:
+                z.write(contents, "contents")
+        elif path.endswith(TAR_EXTENSIONS):
+            with tarfile.open(path, f"w:{path.rsplit('.', 1)[1].replace('tgz', 'gz')}") as t:
+                t.add(contents, "contents")
+        else:
+            os.rename(contents, path)
+
+
+def prepare_artifacts(task, artifact_dir, cot_dir, size_mb):
+    """Link or make up each of the task's upstreamArtifacts under `cot_dir`."""
+    for artifact in task["payload"]["upstreamArtifacts"]:
+        for path in artifact["paths"]:
+            target = os.path.join(cot_dir, artifact["taskId"], path)
+            source = artifact_dir and os.path.join(artifact_dir, artifact["taskId"], path)
+            if source and os.path.exists(source):
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.symlink(os.path.abspath(source), target)
+            else:
+                make_artifact(target, size_mb)
+
+
+def parse_config_value(value):
+    key, _, value = value.partition("=")
+    try:
+        return key, json.loads(value)
+    except ValueError:
+        return key, value
+
+
+async def run_one(task, url, cot_dir, run_dir, config_overrides):
+    """Run `async_main` on `task`, signing with the server at `url`.
+
+    Returns:
+        dict: the summary of the signing metrics
+
+    """
+    context = Context()
+    context.config = get_default_config(base_dir=run_dir)
+    context.config.update(
+        {
+            "work_dir": os.path.join(run_dir, "work"),
+            "artifact_dir": os.path.join(run_dir, "artifacts"),
+            "taskcluster_scope_prefixes": ["project:releng:signing:"],
+        }
+    )
+    context.config.update(config_overrides)
+    context.task = task
+    os.makedirs(context.config["work_dir"])
+    os.symlink(cot_dir, os.path.join(context.config["work_dir"], "cot"))
+
+    formats = sorted({split_autograph_format(fmt)[0] for fmt in task_signing_formats(context)})
+    cert_type = task_cert_type(context)
+    autograph_configs = os.path.join(run_dir, "autograph.json")
+    mar_channels = os.path.join(run_dir, "mar_channels.json")
+    with open(autograph_configs, "w") as fh:
+        json.dump({cert_type: [[url, "user", "key", formats]]}, fh)
+    with open(mar_channels, "w") as fh:
+        json.dump({cert_type: ["*"]}, fh)
+    context.config.setdefault("autograph_configs", autograph_configs)
+    context.config.setdefault("mar_channels", mar_channels)
+
+    await async_main(context)
+    return context.metrics.summary()["by_stage"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("task", help="the task definition to replay")
+    parser.add_argument("--artifact-dir", help="where to find the upstream artifacts, laid out like scriptworker's work_dir/cot")
+    parser.add_argument("--size-mb", type=int, default=10, help="the size of the made up artifacts")
+    parser.add_argument("--signing-concurrency", type=int, action="append", help="can be repeated; defaults to the signingscript default")
+    parser.add_argument("--autograph-concurrency", type=int, action="append", help="can be repeated; defaults to the signingscript default")
+    parser.add_argument("--config", type=parse_config_value, action="append", default=[], metavar="KEY=VALUE", help="set signingscript config")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds to delay each autograph response by")
+    parser.add_argument("--jitter", type=float, default=0.0, help="up to how many more seconds to delay each response by")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="the fraction of autograph requests to fail")
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    with open(args.task) as fh:
+        task = json.load(fh)
+    defaults = get_default_config()
+    fake = FakeAutograph(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, error_status=args.error_status, seed=args.seed)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir, serve(fake) as url:
+        cot_dir = os.path.join(tmp_dir, "cot")
+        prepare_artifacts(task, args.artifact_dir, cot_dir, args.size_mb)
+        public_key = os.path.join(tmp_dir, "autograph.pem")
+        with open(public_key, "wb") as fh:
+            fh.write(fake.public_key)
+
+        print(f"{'signing':>7} {'autograph':>9} {'time':>9} {'requests':>8} {'in flight':>9} {'errors':>6} {'sent':>12}  result")
+        for i, (signing_concurrency, autograph_concurrency) in enumerate(
+            itertools.product(
+                args.signing_concurrency or [defaults["signing_concurrency"]],
+                args.autograph_concurrency or [defaults["autograph_concurrency"]],
+            )
+        ):
+            config = dict(args.config, signing_concurrency=signing_concurrency, autograph_concurrency=autograph_concurrency)
+            fake.reset_stats()
+            start = time.monotonic()
+            try:
+                # The made up signatures are checked against the fake server's key
+                with mock.patch("signingscript.sign.get_mar_verification_key", return_value=public_key):
+                    stages = asyncio.run(run_one(task, url, cot_dir, os.path.join(tmp_dir, f"run{i}"), config))
+                result = "ok"
+            except Exception as e:
+                stages = {}
+                result = f"failed: {e!r}"
+            elapsed = time.monotonic() - start
+            stats = fake.stats()
+            results.append(dict(stats, elapsed=elapsed, stages=stages, result=result, **config))
+            print(
+                f"{signing_concurrency:>7} {autograph_concurrency:>9} {elapsed:8.2f}s {stats['requests']:>8} {stats['max_in_flight']:>9} "
+                f"{stats['errors']:>6} {stats['received'] / 1024 / 1024:9.2f}MiB  {result}"
+            )
+
+    if args.json:
+        with open(args.json, "w") as fh:
+            json.dump(results, fh, indent=2)
+
+
+if __name__ == "__main__":
+    main()
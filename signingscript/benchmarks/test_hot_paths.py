@@ -0,0 +1,91 @@
+"""Benchmarks for the archive, encoding and signing hot paths.
+
+See conftest.py for how to run them.
+"""
+
+import asyncio
+import os
+
+import aiohttp
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+from mardor.reader import MarReader  # noqa: E402
+from signingscript.sign import (  # noqa: E402
+    _create_tarfile,
+    _create_zipfile,
+    _encode_single_file,
+    _extract_zipfile,
+    get_hawk_content_hash,
+    merge_omnija_files,
+    sign_mar384_with_autograph_hash,
+)
+
+
+def test_extract_zipfile(measure, synthetic, context, size_mb):
+    from_ = synthetic.zipfile(size_mb)
+    files = measure(lambda: asyncio.run(_extract_zipfile(context, from_)))
+    assert len(files) == len(synthetic.files(size_mb))
+
+
+def test_create_zipfile(measure, synthetic, context, size_mb):
+    root = synthetic.tree(size_mb)
+    files = synthetic.files(size_mb)
+    to = os.path.join(context.config["work_dir"], "out.zip")
+    measure(lambda: asyncio.run(_create_zipfile(context, to, files, tmp_dir=root)))
+    assert os.path.getsize(to) > 0
+
+
+@pytest.mark.parametrize("workers", sorted({1, os.cpu_count() or 1}))
+def test_create_tarfile(measure, synthetic, context, size_mb, workers):
+    context.config["compression_workers"] = workers
+    root = synthetic.tree(size_mb)
+    files = synthetic.files(size_mb)
+    to = os.path.join(context.config["work_dir"], "out.tar.gz")
+    measure(lambda: asyncio.run(_create_tarfile(context, to, files, "gz", tmp_dir=root)))
+    assert os.path.getsize(to) > 0
+
+
+def test_encode_single_file(measure, synthetic, size_mb):
+    blob = synthetic.blob(size_mb)
+
+    def encode():
+        with open(blob, "rb") as fh:
+            return sum(len(chunk) for chunk in _encode_single_file({"input": fh, "keyid": "key"}))
+
+    assert measure(encode) > size_mb * 1024 * 1024 * 4 // 3
+
+
+@pytest.mark.parametrize("source", ("file", "chunks"))
+def test_get_hawk_content_hash(measure, synthetic, size_mb, source):
+    blob = synthetic.blob(size_mb)
+
+    def content_hash():
+        with open(blob, "rb") as fh:
+            body = fh if source == "file" else _encode_single_file({"input": fh})
+            return get_hawk_content_hash(body, "application/json")
+
+    assert measure(content_hash)
+
+
+def test_merge_omnija_files(measure, synthetic, context, size_mb):
+    orig, signed = synthetic.omnija(size_mb)
+    to = os.path.join(context.config["work_dir"], "omni.ja")
+    measure(lambda: asyncio.run(merge_omnija_files(orig, signed, to, context)))
+    assert os.path.getsize(to) > os.path.getsize(orig)
+
+
+def test_sign_mar384_with_autograph_hash(measure, synthetic, context, fake_autograph, size_mb):
+    from_ = synthetic.mar(size_mb)
+    to = os.path.join(context.config["work_dir"], "signed.mar")
+
+    async def sign():
+        async with aiohttp.ClientSession() as session:
+            context.session = session
+            return await sign_mar384_with_autograph_hash(context, from_, "autograph_hash_only_mar384", to=to)
+
+    measure(lambda: asyncio.run(sign()))
+    with open(to, "rb") as fh, MarReader(fh) as m:
+        assert m.verify(fake_autograph.public_key)
+    assert fake_autograph.requests
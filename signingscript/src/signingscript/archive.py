@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+"""Archive helpers that avoid recompressing unchanged members."""
+
+import logging
+import os
+import shutil
+import struct
+import tempfile
+import zipfile
+
+from signingscript.exceptions import SigningScriptError
+
+log = logging.getLogger(__name__)
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# general purpose flag bits
+_FLAG_ENCRYPTED = 0x1
+_FLAG_DATA_DESCRIPTOR = 0x8
+
+
+def copy_bytes(fsrc, fdst, length):
+    """Copy exactly `length` bytes from `fsrc` to `fdst`, a buffer at a time.
+
+    Raises:
+        SigningScriptError: if `fsrc` ends before `length` bytes
+
+    """
+    while length:
+        buf = fsrc.read(min(length, COPY_BUFFER_SIZE))
+        if not buf:
+            raise SigningScriptError("Unexpected end of zipfile")
+        fdst.write(buf)
+        length -= len(buf)
+
+
+def seek_zip_member_data(zin, info):
+    """Seek to a member's compressed data, and get the ZipInfo to write it elsewhere with.
+
+    The returned ZipInfo has the CRC and sizes in the header rather than in a
+    trailing data descriptor, and no `header_offset`.
+
+    Args:
+        zin (zipfile.ZipFile): the zipfile to read from, opened for reading
+        info (zipfile.ZipInfo): the member of `zin` to read
+
+    Raises:
+        SigningScriptError: if the member is encrypted, or the local header is corrupt
+
+    Returns:
+        zipfile.ZipInfo: the info for a copy of the member. `info.compress_size`
+            bytes of compressed data can be read from `zin.fp`.
+
+    """
+    if info.flag_bits & _FLAG_ENCRYPTED:
+        raise SigningScriptError(f"Can't copy encrypted zip member {info.filename}")
+    zin.fp.seek(info.header_offset)
+    header = struct.unpack(zipfile.structFileHeader, zin.fp.read(zipfile.sizeFileHeader))
+    if header[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+        raise SigningScriptError(f"Bad local header for zip member {info.filename}")
+    zin.fp.seek(header[zipfile._FH_FILENAME_LENGTH] + header[zipfile._FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+
+    new_info = zipfile.ZipInfo(info.filename, info.date_time)
+    for attr in ("compress_type", "comment", "create_system", "create_version", "extract_version", "internal_attr", "external_attr", "CRC"):
+        setattr(new_info, attr, getattr(info, attr))
+    new_info.flag_bits = info.flag_bits & ~_FLAG_DATA_DESCRIPTOR
+    new_info.compress_size = info.compress_size
+    new_info.file_size = info.file_size
+    # The zip64 extra field is regenerated as needed when the headers are written
+    new_info.extra = zipfile._strip_extra(info.extra, (1,))
+    return new_info
+
+
+def copy_zip_member(zin, zout, info):
+    """Copy a member's compressed data from one zipfile to another, without recompressing it.
+
+    The local header is rewritten from `info`, so that the CRC and sizes are
+    in the header rather than in a trailing data descriptor.
+
+    Args:
+        zin (zipfile.ZipFile): the zipfile to copy from, opened for reading
+        zout (zipfile.ZipFile): the zipfile to copy to, opened for writing
+        info (zipfile.ZipInfo): the member of `zin` to copy
+
+    Raises:
+        SigningScriptError: if the member is encrypted, or the local header is corrupt
+
+    """
+    new_info = seek_zip_member_data(zin, info)
+    zout.fp.seek(zout.start_dir)
+    new_info.header_offset = zout.fp.tell()
+    zout.fp.write(new_info.FileHeader())
+    copy_bytes(zin.fp, zout.fp, info.compress_size)
+    zout.start_dir = zout.fp.tell()
+    zout.filelist.append(new_info)
+    zout.NameToInfo[new_info.filename] = new_info
+    zout._didModify = True
+
+
+def update_zipfile(path, replacements, compression=zipfile.ZIP_DEFLATED):
+    """Replace or add some members of a zipfile, copying the rest verbatim.
+
+    Members that aren't in `replacements` have their compressed data copied
+    across as-is, so only the new and changed members are compressed. Members
+    keep their original order, and new members are added at the end.
+
+    Args:
+        path (str): the zipfile to update
+        replacements (dict): maps member names to the local files to store
+            under those names
+        compression (int): the compression to use for the new and changed members
+
+    Returns:
+        str: `path`
+
+    """
+    replacements = dict(replacements)
+    fd, tmp_path = tempfile.mkstemp(prefix="zip", dir=os.path.dirname(os.path.abspath(path)))
+    os.close(fd)
+    try:
+        copied = 0
+        with zipfile.ZipFile(path, mode="r") as zin, zipfile.ZipFile(tmp_path, mode="w", compression=compression) as zout:
+            for info in zin.infolist():
+                if info.filename in replacements:
+                    zout.write(replacements.pop(info.filename), arcname=info.filename)
+                else:
+                    copy_zip_member(zin, zout, info)
+                    copied += 1
+            for arcname, local_path in replacements.items():
+                zout.write(local_path, arcname=arcname)
+        log.debug("Copied %s members of %s as-is, and wrote %s", copied, path, len(zout.filelist) - copied)
+        shutil.copymode(path, tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return path
@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+"""Bounded, pipelined authenticode signing.
+
+`winsign.sign.sign_file` runs osslsigncode synchronously, which blocks the
+event loop, and has no way to limit how many files are signed or
+timestamped at once. `sign_file` here goes through the same steps, but runs
+osslsigncode in a thread, and limits each stage separately through an
+`AuthenticodePool`:
+
+* hashing: generating the dummy signature (which hashes the file), and
+  attaching the real one, each of which is an osslsigncode process
+* signing: signing the digest with autograph
+* timestamping: countersigning with the timestamp server. Identical
+  signatures get identical timestamp requests, so these are cached.
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import struct
+import zipfile
+from pathlib import Path
+
+import winsign.makemsix
+import winsign.osslsigncode
+import winsign.timestamp
+from winsign.asn1 import ContentInfo, SignedData, der_decode, der_encode, get_signeddata, resign
+from winsign.crypto import load_pem_certs
+
+log = logging.getLogger(__name__)
+
+DEFAULT_HASH_CONCURRENCY = os.cpu_count() or 1
+DEFAULT_SIGN_CONCURRENCY = 8
+DEFAULT_TIMESTAMP_CONCURRENCY = 4
+
+# The PE headers are normally in the first few hundred bytes of the file.
+# Anything that claims they're further in than this isn't worth reading
+# the member that far for; osslsigncode can decide.
+_MAX_PE_HEADER_OFFSET = 64 * 1024
+_PE_SIGNATURE = b"PE\0\0"
+_COFF_HEADER_SIZE = 20
+# offsets into the optional header of the number of data directories, and
+# of the certificate table's data directory, for PE32 and PE32+
+_PE_OPTIONAL_HEADER_OFFSETS = {
+    0x10B: (92, 128),
+    0x20B: (108, 144),
+}
+
+
+class AuthenticodePool:
+    """Concurrency limits, and a timestamp cache, shared by every authenticode signature in a task.
+
+    Args:
+        hash_concurrency (int): the max number of osslsigncode processes at once
+        sign_concurrency (int): the max number of digests being signed at once
+        timestamp_concurrency (int): the max number of timestamp requests at once
+
+    """
+
+    def __init__(
+        self,
+        hash_concurrency=DEFAULT_HASH_CONCURRENCY,
+        sign_concurrency=DEFAULT_SIGN_CONCURRENCY,
+        timestamp_concurrency=DEFAULT_TIMESTAMP_CONCURRENCY,
+    ):
+        self.hash_semaphore = asyncio.Semaphore(hash_concurrency)
+        self.sign_semaphore = asyncio.Semaphore(sign_concurrency)
+        self.timestamp_semaphore = asyncio.Semaphore(timestamp_concurrency)
+        self._timestamps = {}
+
+    @classmethod
+    def from_config(cls, config):
+        """Create an AuthenticodePool from the signingscript config.
+
+        Args:
+            config (dict): the signingscript config
+
+        Returns:
+            AuthenticodePool: the pool
+
+        """
+        return cls(
+            hash_concurrency=config.get("authenticode_hash_concurrency", DEFAULT_HASH_CONCURRENCY),
+            sign_concurrency=config.get("authenticode_sign_concurrency", DEFAULT_SIGN_CONCURRENCY),
+            timestamp_concurrency=config.get("authenticode_timestamp_concurrency", DEFAULT_TIMESTAMP_CONCURRENCY),
+        )
+
+    async def run_osslsigncode(self, func, *args, **kwargs):
+        """Run a blocking winsign function that runs osslsigncode, in a thread."""
+        async with self.hash_semaphore:
+            return await asyncio.to_thread(func, *args, **kwargs)
+
+    def bound_signer(self, signer):
+        """Wrap a winsign `signer` so it runs within the signing limit."""
+
+        async def _signer(digest, digest_algo):
+            async with self.sign_semaphore:
+                return await signer(digest, digest_algo)
+
+        return _signer
+
+    async def add_timestamp(self, sig, timestamp_style, digest_algo, timestamp_url):
+        """Add a timestamp countersignature to a SignedData signature.
+
+        The timestamped signature is cached by the signature it was made from,
+        and concurrent requests for the same signature share one request.
+        Failures aren't cached.
+
+        Args:
+            sig (SignedData): the signature to add a timestamp to
+            timestamp_style (str): `old` or `rfc3161`
+            digest_algo (str): the digest algorithm, e.g. `sha256`
+            timestamp_url (str): the timestamp server
+
+        Returns:
+            SignedData: the timestamped signature
+
+        """
+        key = (timestamp_style, timestamp_url, digest_algo, hashlib.sha256(der_encode(sig)).hexdigest())
+        if key not in self._timestamps:
+            self._timestamps[key] = asyncio.ensure_future(self._add_timestamp(sig, timestamp_style, digest_algo, timestamp_url))
+        else:
+            log.info("Reusing timestamp for an identical signature")
+        try:
+            timestamped = await asyncio.shield(self._timestamps[key])
+        except Exception:
+            self._timestamps.pop(key, None)
+            raise
+        return der_decode(timestamped, SignedData())[0]
+
+    async def _add_timestamp(self, sig, timestamp_style, digest_algo, timestamp_url):
+        async with self.timestamp_semaphore:
+            if timestamp_style == "old":
+                sig = await winsign.timestamp.add_old_timestamp(sig, timestamp_url)
+            else:
+                sig = await winsign.timestamp.add_rfc3161_timestamp(sig, digest_algo, timestamp_url)
+        return der_encode(sig)
+
+
+# A copy of `winsign.sign.sign_file` from winsign 2.3.0, built from the same
+# public winsign functions. winsign has no hooks for running osslsigncode off
+# the event loop or for sharing timestamps, so the only changes are that each
+# step goes through `pool`, and that `certs` isn't extended in place (the
+# call is retried with the same list). Diff this against
+# `winsign.sign.sign_file` when upgrading winsign.
+async def sign_file(
+    infile,
+    outfile,
+    digest_algo,
+    certs,
+    signer,
+    cafile=None,
+    timestampfile=None,
+    url=None,
+    comment=None,
+    crosscert=None,
+    timestamp_style=None,
+    timestamp_url=None,
+    pool=None,
+):
+    """Sign a PE or MSI file, like `winsign.sign.sign_file`, within the limits of `pool`.
+
+    Args:
+        infile (str): path to the unsigned file
+        outfile (str): path to write the signed file to
+        digest_algo (str): the digest algorithm, generally `sha256`
+        certs (list): x509 certificates to attach to the signature
+        signer (function): takes (digest, digest_algo) and returns the signature
+        cafile (str): path to the cafile of the signing cert
+        timestampfile (str): path to the ca for verifying the timestamp
+        url (str): a URL to embed into the signature
+        comment (str): a string to embed into the signature
+        crosscert (str): path to extra certificates to attach to the signature
+        timestamp_style (str): None, `old` or `rfc3161`
+        timestamp_url (str): the timestamp server. Required if `timestamp_style` is set.
+        pool (AuthenticodePool, optional): the limits to sign within. Defaults
+            to a new pool with the default limits.
+
+    Returns:
+        True on success, False otherwise
+
+    """
+    pool = pool or AuthenticodePool()
+    infile = Path(infile)
+    outfile = Path(outfile)
+
+    is_msix = winsign.makemsix.is_msixfile(infile)
+    if not is_msix and (cafile is None or not Path(cafile).is_file()):
+        log.error("CAfile is required while writing signatures for non msix files, expected path to file, found '%s'", cafile)
+        return False
+
+    try:
+        log.debug("Generating dummy signature")
+        if is_msix:
+            old_sig, wrap_sig = await pool.run_osslsigncode(winsign.makemsix.dummy_sign, infile, outfile), False
+        else:
+            old_sig, wrap_sig = await pool.run_osslsigncode(
+                winsign.osslsigncode.get_dummy_signature, infile, digest_algo, url=url, comment=comment, crosscert=crosscert
+            )
+    except OSError:
+        log.exception("Couldn't generate dummy signature")
+        return False
+
+    try:
+        log.debug("Re-signing with real keys")
+        if crosscert:
+            certs = certs + load_pem_certs(Path(crosscert).read_bytes())
+        newsig = await resign(get_signeddata(old_sig), certs, pool.bound_signer(signer))
+    except Exception:
+        log.exception("Couldn't re-sign")
+        return False
+
+    if timestamp_style in ("old", "rfc3161"):
+        ci = der_decode(newsig, ContentInfo())[0]
+        sig = der_decode(ci["content"], SignedData())[0]
+        ci["content"] = await pool.add_timestamp(sig, timestamp_style, digest_algo, timestamp_url)
+        newsig = der_encode(ci)
+
+    try:
+        log.debug("Attaching new signature")
+        if is_msix:
+            await pool.run_osslsigncode(winsign.makemsix.attach_signature, outfile, outfile, newsig)
+        else:
+            await pool.run_osslsigncode(winsign.osslsigncode.write_signature, infile, outfile, newsig, certs, cafile, timestampfile, wrap_sig)
+    except Exception:
+        log.exception("Couldn't write new signature")
+        return False
+
+    return True
+
+
+def pe_is_signed(fh):
+    """Check whether a PE file has an authenticode signature, from its headers.
+
+    Only reads forward, so `fh` can be a zip member opened with
+    `zipfile.ZipFile.open`.
+
+    Args:
+        fh (file): the file, opened for reading at its start
+
+    Returns:
+        bool: whether the file has a certificate table, or None if it
+            doesn't look like a PE file
+
+    """
+    dos_header = fh.read(64)
+    if len(dos_header) < 64 or dos_header[:2] != b"MZ":
+        return None
+    (pe_offset,) = struct.unpack_from("<I", dos_header, 0x3C)
+    if pe_offset < 64 or pe_offset > _MAX_PE_HEADER_OFFSET:
+        return None
+    max_directory_offset = max(offset for _, offset in _PE_OPTIONAL_HEADER_OFFSETS.values())
+    headers = dos_header + fh.read(pe_offset - 64 + len(_PE_SIGNATURE) + _COFF_HEADER_SIZE + max_directory_offset + 8)
+    if headers[pe_offset : pe_offset + len(_PE_SIGNATURE)] != _PE_SIGNATURE:
+        return None
+    optional_header = pe_offset + len(_PE_SIGNATURE) + _COFF_HEADER_SIZE
+    if len(headers) < optional_header + 2:
+        return None
+    (magic,) = struct.unpack_from("<H", headers, optional_header)
+    if magic not in _PE_OPTIONAL_HEADER_OFFSETS:
+        return None
+    count_offset, directory_offset = _PE_OPTIONAL_HEADER_OFFSETS[magic]
+    if len(headers) < optional_header + directory_offset + 8:
+        return None
+    (count,) = struct.unpack_from("<I", headers, optional_header + count_offset)
+    if count < 5:
+        return False
+    cert_offset, cert_size = struct.unpack_from("<II", headers, optional_header + directory_offset)
+    return bool(cert_offset and cert_size)
+
+
+def find_unsigned_zip_members(path, names):
+    """Find the members of a zipfile that need to be signed, without extracting them.
+
+    PE files are checked by their headers. Members that aren't PE files,
+    like .msi files, can't be checked this way, so are assumed to need
+    signing.
+
+    Args:
+        path (str): the zipfile
+        names (list): the names of the members that might need signing
+
+    Returns:
+        list: the names of the members that need signing
+
+    """
+    unsigned = []
+    with zipfile.ZipFile(path) as z:
+        for name in names:
+            with z.open(name) as fh:
+                signed = pe_is_signed(fh)
+            if signed:
+                log.info("%s in %s is already signed", name, path)
+            else:
+                unsigned.append(name)
+    return unsigned
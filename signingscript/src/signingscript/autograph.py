@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+"""Pooled, keep-alive autograph client."""
+
+import asyncio
+import logging
+import time
+
+import aiohttp
+from yarl import URL
+
+log = logging.getLogger(__name__)
+
+DEFAULT_LIMIT_PER_HOST = 8
+DEFAULT_DNS_CACHE_TTL = 300
+DEFAULT_KEEPALIVE_TIMEOUT = 60
+# The circuit breaker is off unless `autograph_failure_threshold` is set
+DEFAULT_FAILURE_THRESHOLD = None
+DEFAULT_RESET_TIMEOUT = 60
+DEFAULT_BATCH_WINDOW = 0.05
+DEFAULT_MAX_BATCH_SIZE = 32
+
+
+class CircuitBreaker:
+    """Hold back requests to a server after too many consecutive failures.
+
+    Once `failure_threshold` consecutive requests have failed, the breaker
+    opens for `reset_timeout` seconds. Requests made while it's open wait
+    rather than fail, so they don't use up their callers' retry attempts.
+    After `reset_timeout`, exactly one waiting request is let through as a
+    probe. If it succeeds, the breaker closes and the others go ahead; if it
+    fails, the breaker stays open for another `reset_timeout`.
+
+    Args:
+        name (str): the name of the server, for logging
+        failure_threshold (int): how many consecutive failures open the breaker
+        reset_timeout (float): how many seconds to stay open for
+
+    """
+
+    def __init__(self, name, failure_threshold, reset_timeout=DEFAULT_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._probe = None
+
+    async def wait(self):
+        """Wait until a request can be sent.
+
+        Returns:
+            bool: True if the request is the probe, in which case `end_probe`
+                must be called once it's done
+
+        """
+        while self.opened_at is not None:
+            remaining = self.opened_at + self.reset_timeout - time.monotonic()
+            if remaining > 0:
+                await asyncio.sleep(remaining)
+            elif self._probe is None:
+                log.info("Letting a request through to %s after %ss", self.name, self.reset_timeout)
+                self._probe = asyncio.get_running_loop().create_future()
+                return True
+            else:
+                await asyncio.shield(self._probe)
+        return False
+
+    def end_probe(self):
+        """Let the requests waiting on the probe check the breaker again."""
+        if self._probe is not None:
+            self._probe.set_result(None)
+            self._probe = None
+
+    def record_success(self):
+        """Close the breaker."""
+        if self.opened_at is not None:
+            log.info("Requests to %s are succeeding again", self.name)
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        """Count a failure, opening the breaker if there have been too many."""
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                log.warning("%s consecutive failures talking to %s; holding back requests for %ss", self.failures, self.name, self.reset_timeout)
+            self.opened_at = time.monotonic()
+
+
+class AutographClient:
+    """A client shared by every signing format that talks to autograph.
+
+    Each autograph server gets its own `aiohttp.ClientSession` with a
+    keep-alive `TCPConnector`, so concurrent requests reuse warm TLS
+    connections. Each connector caps the number of concurrent connections to
+    its server and caches DNS lookups. If `failure_threshold` is set, each
+    server also gets a `CircuitBreaker`.
+
+    `post` has the same signature as `aiohttp.ClientSession.post`, and picks
+    the session from the url, so the client can be used as `context.session`.
+
+    Args:
+        autograph_configs (dict): the `Autograph` configs, keyed by cert type,
+            as returned by `load_autograph_configs`
+        limit_per_host (int): the max number of concurrent connections to each server
+        dns_cache_ttl (int): how long to cache DNS lookups for, in seconds
+        keepalive_timeout (float): how long to keep idle connections open for, in seconds
+        failure_threshold (int, optional): see `CircuitBreaker`. If None,
+            requests aren't held back after failures.
+        reset_timeout (float): see `CircuitBreaker`
+
+    """
+
+    def __init__(
+        self,
+        autograph_configs=None,
+        limit_per_host=DEFAULT_LIMIT_PER_HOST,
+        dns_cache_ttl=DEFAULT_DNS_CACHE_TTL,
+        keepalive_timeout=DEFAULT_KEEPALIVE_TIMEOUT,
+        failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+        reset_timeout=DEFAULT_RESET_TIMEOUT,
+    ):
+        self.limit_per_host = limit_per_host
+        self.dns_cache_ttl = dns_cache_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._sessions = {}
+        self._breakers = {}
+        for servers in (autograph_configs or {}).values():
+            for server in servers:
+                self._get_session(server.url)
+
+    @classmethod
+    def from_config(cls, config, autograph_configs):
+        """Create an AutographClient from the signingscript config.
+
+        Args:
+            config (dict): the signingscript config
+            autograph_configs (dict): the `Autograph` configs, keyed by cert type
+
+        Returns:
+            AutographClient: the client
+
+        """
+        return cls(
+            autograph_configs,
+            limit_per_host=config.get("autograph_concurrency", DEFAULT_LIMIT_PER_HOST),
+            dns_cache_ttl=config.get("autograph_dns_cache_ttl", DEFAULT_DNS_CACHE_TTL),
+            keepalive_timeout=config.get("autograph_keepalive_timeout", DEFAULT_KEEPALIVE_TIMEOUT),
+            failure_threshold=config.get("autograph_failure_threshold", DEFAULT_FAILURE_THRESHOLD),
+            reset_timeout=config.get("autograph_reset_timeout", DEFAULT_RESET_TIMEOUT),
+        )
+
+    def _get_session(self, url):
+        origin = URL(url).origin()
+        if origin not in self._sessions:
+            log.debug("Creating autograph session for %s", origin)
+            connector = aiohttp.TCPConnector(
+                limit_per_host=self.limit_per_host,
+                ttl_dns_cache=self.dns_cache_ttl,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            self._sessions[origin] = aiohttp.ClientSession(connector=connector)
+            if self.failure_threshold:
+                self._breakers[origin] = CircuitBreaker(str(origin), self.failure_threshold, self.reset_timeout)
+        return self._sessions[origin], self._breakers.get(origin)
+
+    async def post(self, url, **kwargs):
+        """POST to an autograph server.
+
+        If the server's circuit breaker is open, this waits for it first.
+
+        Raises:
+            aiohttp.ClientError: on connection failures
+
+        Returns:
+            aiohttp.ClientResponse: the response
+
+        """
+        session, breaker = self._get_session(url)
+        if breaker is None:
+            return await session.post(url, **kwargs)
+        probe = await breaker.wait()
+        try:
+            try:
+                resp = await session.post(url, **kwargs)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                breaker.record_failure()
+                raise
+            if resp.status >= 500:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            return resp
+        finally:
+            if probe:
+                breaker.end_probe()
+
+    async def close(self):
+        """Close all of the sessions."""
+        for session in self._sessions.values():
+            await session.close()
+        self._sessions = {}
+        self._breakers = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+
+class RequestBatcher:
+    """Collect concurrent requests into batches.
+
+    Requests submitted with the same key within `window` seconds of the first
+    one are sent together with a single call to `send`, and each caller gets
+    its own result back. A batch is sent early once it has `max_batch_size`
+    requests in it.
+
+    Args:
+        send (coroutine function): called as `send(key, items)`; must return a
+            list of results in the same order as `items`
+        window (float): how long to wait for more requests, in seconds
+        max_batch_size (int): the max number of requests per batch
+
+    """
+
+    def __init__(self, send, window=DEFAULT_BATCH_WINDOW, max_batch_size=DEFAULT_MAX_BATCH_SIZE):
+        self.send = send
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self._batches = {}
+        self._timers = {}
+        self._tasks = set()
+
+    async def submit(self, key, item):
+        """Add `item` to the batch for `key`, and wait for its result.
+
+        Raises:
+            Exception: whatever `send` raised for this batch
+
+        Returns:
+            the result for `item`
+
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        batch = self._batches.setdefault(key, [])
+        batch.append((item, future))
+        if len(batch) >= self.max_batch_size:
+            self._flush(key)
+        elif len(batch) == 1:
+            self._timers[key] = loop.call_later(self.window, self._flush, key)
+        return await future
+
+    def _flush(self, key):
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._batches.pop(key, None)
+        if batch:
+            task = asyncio.ensure_future(self._send(key, batch))
+            # Keep a reference to the task until it's done
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, key, batch):
+        items = [item for item, _ in batch]
+        log.debug("Sending a batch of %s requests", len(items))
+        try:
+            results = await self.send(key, items)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        except BaseException:
+            # e.g. the send was cancelled; don't leave the callers waiting
+            for _, future in batch:
+                if not future.done():
+                    future.cancel()
+            raise
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+"""On-disk cache of signing results.
+
+Only results that depend on nothing but the input and the key can be cached:
+signatures over a hash, and detached signatures. Formats that embed
+timestamps, ids or other per-request state in their output must not use it.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+
+
+class SigningCache:
+    """A size-bounded, least-recently-used cache of signing results.
+
+    Entries are files under `path`, named by a digest of their key. Reading
+    an entry bumps its mtime, and the oldest entries are evicted when the
+    cache grows past `max_size`. Entries are written atomically, so the same
+    cache directory can be shared between concurrent tasks.
+
+    The total size is counted on the first `put` and kept up to date as
+    entries are written, so the directory is only walked again when the
+    cache is over `max_size`. The methods block on disk i/o, so async code
+    should run them in a thread; they're safe to call from several threads.
+
+    Args:
+        path (str): the cache directory
+        max_size (int): the max total size of the entries, in bytes
+
+    """
+
+    def __init__(self, path, max_size=DEFAULT_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self._size = None
+        self._lock = threading.RLock()
+        os.makedirs(path, exist_ok=True)
+
+    @classmethod
+    def from_config(cls, config):
+        """Create a SigningCache from the signingscript config.
+
+        Args:
+            config (dict): the signingscript config
+
+        Returns:
+            SigningCache: the cache, or None if `signing_cache_dir` isn't set
+
+        """
+        if not config.get("signing_cache_dir"):
+            return None
+        return cls(config["signing_cache_dir"], max_size=config.get("signing_cache_max_size", DEFAULT_MAX_SIZE))
+
+    @staticmethod
+    def key(digest, fmt, keyid, cert_type, *extra):
+        """Get the cache key for a signing request.
+
+        Args:
+            digest (str): the sha256 hexdigest of the input
+            fmt (str): the signing format
+            keyid (str): the autograph key id, if any
+            cert_type (str): the task's cert type
+            *extra (str): anything else the result depends on
+
+        Returns:
+            str: the key
+
+        """
+        return hashlib.sha256(json.dumps([digest, fmt, keyid, cert_type, *extra]).encode("utf-8")).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, key):
+        """Get a cached result.
+
+        Args:
+            key (str): the key, from `SigningCache.key`
+
+        Returns:
+            bytes: the cached result, or None on a miss
+
+        """
+        path = self._entry_path(key)
+        try:
+            with open(path, "rb") as fh:
+                data = fh.read()
+            os.utime(path)
+        except FileNotFoundError:
+            log.debug("Signing cache miss for %s", key)
+            return None
+        log.info("Signing cache hit for %s", key)
+        return data
+
+    def put(self, key, data):
+        """Cache a result, evicting old entries if the cache is too big.
+
+        Args:
+            key (str): the key, from `SigningCache.key`
+            data (bytes): the result
+
+        """
+        path = self._entry_path(key)
+        try:
+            old_size = os.stat(path).st_size
+        except FileNotFoundError:
+            old_size = 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=".tmp", dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "wb") as fh:
+                fh.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan()[1]
+            else:
+                self._size += len(data) - old_size
+            if self._size > self.max_size:
+                self.evict()
+
+    def _scan(self):
+        entries = []
+        total = 0
+        for dirpath, _, filenames in os.walk(self.path):
+            for filename in filenames:
+                if filename.startswith(".tmp"):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        return entries, total
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in `max_size`."""
+        with self._lock:
+            entries, total = self._scan()
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_size:
+                    break
+                log.debug("Evicting %s from the signing cache", path)
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+            self._size = total
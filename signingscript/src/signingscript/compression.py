@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+"""Block-parallel compression.
+
+The input is split into blocks, and each block is compressed independently
+across a process pool. Each compressed block is a complete gzip member, bzip2
+stream or xz stream; concatenated, they're readable by the standard
+decompressors (`gzip -d`, `bzip2 -d`, `xz -d`, and python's `gzip`, `bz2`,
+`lzma` and `tarfile` modules).
+
+Readers that stop after the first member or stream can't read the output:
+python's `tarfile` in stream mode (`r|gz`, `r|bz2`, `r|xz`) fails on it, as
+may other consumers of the tarballs. Splitting the input also costs some
+compression ratio, especially with xz. So parallel compression is opt-in,
+with `compression_workers` above 1, and all of a task's tarballs share the
+one pool from `get_compression_executor`.
+"""
+
+import bz2
+import collections
+import contextlib
+import gzip
+import logging
+import lzma
+import os
+import tarfile
+from concurrent.futures import ProcessPoolExecutor
+
+log = logging.getLogger(__name__)
+
+# Single stream compression; see above for why parallel compression is opt-in
+DEFAULT_COMPRESSION_WORKERS = 1
+
+# Smaller blocks mean more parallelism for smaller archives, but worse
+# compression. gzip only looks back 32KiB, so small blocks cost it very
+# little; xz at preset 9 uses a 64MiB dictionary, so it needs much bigger
+# blocks to compress as well as a single stream.
+DEFAULT_BLOCK_SIZES = {
+    "gz": 4 * 1024 * 1024,
+    "bz2": 8 * 1024 * 1024,
+    "xz": 32 * 1024 * 1024,
+}
+
+# The xz dictionary is capped at the block size, so each worker only allocates
+# the memory it can use. This is liblzma's minimum dictionary size.
+_MIN_XZ_DICT_SIZE = 4096
+
+
+def compress_block(compression, data):
+    """Compress `data` as a complete gzip member, bzip2 stream or xz stream.
+
+    The settings match those used for single stream tarballs: gzip and bzip2
+    at level 9, and xz at preset 9 extreme.
+
+    Args:
+        compression (str): one of `gz`, `bz2` or `xz`
+        data (bytes): the data to compress
+
+    Raises:
+        ValueError: on an unknown compression
+
+    Returns:
+        bytes: the compressed data
+
+    """
+    if compression == "gz":
+        return gzip.compress(data, compresslevel=9, mtime=0)
+    if compression == "bz2":
+        return bz2.compress(data, 9)
+    if compression == "xz":
+        filters = [
+            {"id": lzma.FILTER_LZMA2, "preset": 9 | lzma.PRESET_EXTREME, "dict_size": max(len(data), _MIN_XZ_DICT_SIZE)},
+        ]
+        return lzma.compress(data, format=lzma.FORMAT_XZ, filters=filters)
+    raise ValueError(f"Unknown compression {compression}")
+
+
+def open_decompressed(path, compression):
+    """Open a compressed file for reading.
+
+    Unlike `tarfile`'s stream mode, this reads all of the concatenated
+    members or streams of the file, not just the first.
+
+    Args:
+        path (str): the path to the compressed file
+        compression (str): one of `gz`, `bz2` or `xz`
+
+    Raises:
+        ValueError: on an unknown compression
+
+    Returns:
+        file: the decompressed file object
+
+    """
+    openers = {"gz": gzip.open, "bz2": bz2.open, "xz": lzma.open}
+    if compression not in openers:
+        raise ValueError(f"Unknown compression {compression}")
+    return openers[compression](path, "rb")
+
+
+class ParallelCompressor:
+    """A write-only file object that compresses blocks in parallel.
+
+    Compressed blocks are written to `fileobj` in order. At most
+    `max_pending` blocks are held in memory waiting to be compressed or
+    written.
+
+    Args:
+        fileobj (file): the file object to write the compressed data to
+        compression (str): one of `gz`, `bz2` or `xz`
+        executor (concurrent.futures.Executor): the pool to compress blocks in
+        block_size (int, optional): the size of each uncompressed block.
+            Defaults to `DEFAULT_BLOCK_SIZES[compression]`
+        max_pending (int, optional): the max number of blocks in flight.
+            Defaults to 2.
+
+    """
+
+    def __init__(self, fileobj, compression, executor, block_size=None, max_pending=None):
+        if compression not in DEFAULT_BLOCK_SIZES:
+            raise ValueError(f"Unknown compression {compression}")
+        self.fileobj = fileobj
+        self.compression = compression
+        self.executor = executor
+        self.block_size = block_size or DEFAULT_BLOCK_SIZES[compression]
+        self.max_pending = max_pending or 2
+        self.closed = False
+        self._buffer = bytearray()
+        self._pending = collections.deque()
+        self._blocks = 0
+
+    def write(self, data):
+        """Buffer `data`, and compress any full blocks."""
+        self._buffer += data
+        while len(self._buffer) >= self.block_size:
+            self._submit(bytes(self._buffer[: self.block_size]))
+            del self._buffer[: self.block_size]
+        return len(data)
+
+    def _submit(self, block):
+        self._pending.append(self.executor.submit(compress_block, self.compression, block))
+        self._blocks += 1
+        while len(self._pending) > self.max_pending:
+            self._write_next()
+
+    def _write_next(self):
+        self.fileobj.write(self._pending.popleft().result())
+
+    def close(self):
+        """Compress what's left in the buffer, and write out all of the blocks."""
+        if self.closed:
+            return
+        # Always write at least one block, so empty input gives valid output
+        if self._buffer or not self._blocks:
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+        while self._pending:
+            self._write_next()
+        self.closed = True
+        log.debug("Compressed %s %s blocks", self._blocks, self.compression)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            for future in self._pending:
+                future.cancel()
+            self.closed = True
+
+
+def get_compression_executor(config):
+    """Create the pool that a task's tarballs are compressed in, if any.
+
+    Args:
+        config (dict): the signingscript config
+
+    Returns:
+        context manager: the `compression_workers` process pool, or a null
+            context that gives None when parallel compression is off
+
+    """
+    workers = config.get("compression_workers", DEFAULT_COMPRESSION_WORKERS)
+    if workers <= 1:
+        return contextlib.nullcontext()
+    return ProcessPoolExecutor(max_workers=workers)
+
+
+def create_parallel_tarfile(to, files, rel_dir, compression, workers=2, block_size=None, filter=None, executor=None):
+    """Create a compressed tarball, compressing blocks of it in parallel.
+
+    The tarball has several gzip members, bzip2 streams or xz streams, so
+    stream readers can't read it; see above.
+
+    Args:
+        to (str): the path to write the tarball to
+        files (list): the paths to add to the tarball
+        rel_dir (str): the directory the arcnames are relative to
+        compression (str): one of `gz`, `bz2` or `xz`
+        workers (int): the number of processes to compress with. At most
+            twice this many blocks are held in memory.
+        block_size (int, optional): see `ParallelCompressor`
+        filter (callable, optional): the `tarfile.TarFile.add` filter
+        executor (concurrent.futures.Executor, optional): the pool to
+            compress in. If None, a pool of `workers` processes is created
+            for this tarball.
+
+    Returns:
+        str: `to`
+
+    """
+    with contextlib.ExitStack() as stack:
+        if executor is None:
+            executor = stack.enter_context(ProcessPoolExecutor(max_workers=workers))
+        fh = stack.enter_context(open(to, "wb"))
+        with ParallelCompressor(fh, compression, executor, block_size=block_size, max_pending=2 * workers) as dest, tarfile.open(mode="w|", fileobj=dest) as tf:
+            for f in files:
+                tf.add(f, arcname=os.path.relpath(f, rel_dir), filter=filter)
+    return to
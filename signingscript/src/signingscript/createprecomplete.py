@@ -20,37 +20,70 @@ def get_build_entries(root_path):
         for file_name in files:
             parent_dir_rel_path = root[len(root_path) + 1 :]
             rel_path_file = os.path.join(parent_dir_rel_path, file_name)
-            rel_path_file = rel_path_file.replace("\\", "/")
-            if not (
-                rel_path_file.endswith("channel-prefs.js")
-                or rel_path_file.endswith("update-settings.ini")
-                or "/ChannelPrefs.framework/" in rel_path_file
-                or rel_path_file.startswith("ChannelPrefs.framework/")
-                or "/UpdateSettings.framework/" in rel_path_file
-                or rel_path_file.startswith("UpdateSettings.framework/")
-                or "distribution/" in rel_path_file
-            ):
-                rel_file_path_set.add(rel_path_file)
+            rel_file_path_set.add(rel_path_file.replace("\\", "/"))
 
         for dir_name in dirs:
             parent_dir_rel_path = root[len(root_path) + 1 :]
             rel_path_dir = os.path.join(parent_dir_rel_path, dir_name)
-            rel_path_dir = rel_path_dir.replace("\\", "/") + "/"
-            if rel_path_dir.find("distribution/") == -1:
-                rel_dir_path_set.add(rel_path_dir)
+            rel_dir_path_set.add(rel_path_dir.replace("\\", "/") + "/")
 
-    rel_file_path_list = list(rel_file_path_set)
+    return filter_build_entries(rel_file_path_set, rel_dir_path_set)
+
+
+def get_build_entries_from_paths(root_path, paths):
+    """Like get_build_entries, but from the paths the files under root_path
+    have, e.g. from an archive listing, rather than by walking root_path.
+    Directory paths end with a slash; the directories files are in don't need
+    their own paths.
+    """
+    prefix = root_path.rstrip("/") + "/"
+    rel_file_path_set = set()
+    rel_dir_path_set = set()
+    for path in paths:
+        if not path.startswith(prefix):
+            continue
+        rel_path = path[len(prefix) :]
+        if not rel_path:
+            continue
+        if not rel_path.endswith("/"):
+            rel_file_path_set.add(rel_path)
+        parts = rel_path.rstrip("/").split("/")
+        for i in range(1, len(parts) + rel_path.endswith("/")):
+            rel_dir_path_set.add("/".join(parts[:i]) + "/")
+
+    return filter_build_entries(rel_file_path_set, rel_dir_path_set)
+
+
+def filter_build_entries(rel_file_paths, rel_dir_paths):
+    """Excludes the files and directories that mustn't be removed, and sorts
+    the rest in the order they need removing.
+    """
+    rel_file_path_list = [
+        rel_path_file
+        for rel_path_file in rel_file_paths
+        if not (
+            rel_path_file.endswith("channel-prefs.js")
+            or rel_path_file.endswith("update-settings.ini")
+            or "/ChannelPrefs.framework/" in rel_path_file
+            or rel_path_file.startswith("ChannelPrefs.framework/")
+            or "/UpdateSettings.framework/" in rel_path_file
+            or rel_path_file.startswith("UpdateSettings.framework/")
+            or "distribution/" in rel_path_file
+        )
+    ]
     rel_file_path_list.sort(reverse=True)
-    rel_dir_path_list = list(rel_dir_path_set)
+    rel_dir_path_list = [rel_path_dir for rel_path_dir in rel_dir_paths if rel_path_dir.find("distribution/") == -1]
     rel_dir_path_list.sort(reverse=True)
 
     return rel_file_path_list, rel_dir_path_list
 
 
-def generate_precomplete(root_path):
+def generate_precomplete(root_path, paths=None):
     """Creates the precomplete file containing the remove and rmdir
     application update instructions. The given directory is used
     for the location to enumerate and to create the precomplete file.
+    If paths is given, the files and directories are enumerated from it
+    instead; see get_build_entries_from_paths.
     """
     rel_path_precomplete = "precomplete"
     # If inside a Mac bundle use the root of the bundle for the path.
@@ -62,7 +95,11 @@ def generate_precomplete(root_path):
     # Open the file so it exists before building the list of files and open it
     # in binary mode to prevent OS specific line endings.
     precomplete_file = open(precomplete_file_path, "wb")
-    rel_file_path_list, rel_dir_path_list = get_build_entries(root_path)
+    if paths is None:
+        rel_file_path_list, rel_dir_path_list = get_build_entries(root_path)
+    else:
+        paths = set(paths) | {precomplete_file_path}
+        rel_file_path_list, rel_dir_path_list = get_build_entries_from_paths(root_path, paths)
     for rel_file_path in rel_file_path_list:
         precomplete_file.write('remove "{}"\n'.format(rel_file_path).encode("utf-8"))
 
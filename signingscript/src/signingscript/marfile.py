@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+"""Single pass MAR signing.
+
+`mardor` adds a signature block by writing the whole MAR out, then reading
+it all back in to hash it, then writing it all out again with the real
+signature. Everything that's covered by the signature can be computed from
+the source MAR's headers and index, though, so here the signed MAR is
+written once, with space reserved for the signature, hashing the covered
+bytes as they're written. The signature is then patched into place.
+
+See https://wiki.mozilla.org/Software_Update:MAR for the format.
+"""
+
+import hashlib
+import logging
+import os
+import struct
+
+from mardor.format import extras_header, index_header, mar, mar_header
+from mardor.signing import verify_signature
+
+from signingscript.exceptions import SigningScriptError
+
+log = logging.getLogger(__name__)
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# algorithm id and signature size for each supported hash algorithm
+SIGNATURE_ALGORITHMS = {
+    "sha1": (1, 256),
+    "sha384": (2, 512),
+}
+
+# The MAR header is the magic and index offset, and the signature block
+# header is the file size, the signature count, then the algorithm id and
+# size of our one signature. The signature itself is the only part of the
+# file that isn't covered by the hash.
+_SIGS_HEADER = struct.Struct(">QIII")
+SIGNATURE_OFFSET = mar_header.sizeof() + _SIGS_HEADER.size
+
+
+def _productinfo(mardata):
+    """Return the productversion and channel of a parsed MAR, if present."""
+    if not mardata.additional:
+        return None
+    for section in mardata.additional.sections:
+        if section.id == 1:
+            return str(section.productversion), str(section.channel)
+    return None
+
+
+def write_unsigned_mar(from_, to, hash_algo):
+    """Write a copy of a MAR with an empty signature block, and hash it.
+
+    Any existing signatures are dropped. The index and data offsets are
+    worked out before anything is written, so `to` is written front to back
+    in one pass, and `from_` is read once.
+
+    Args:
+        from_ (str): the path to the MAR to sign
+        to (str): the path to write the MAR with an empty signature block to.
+            This must not be `from_`.
+        hash_algo (str): one of `sha1` or `sha384`
+
+    Raises:
+        SigningScriptError: if `from_` isn't a MAR file that can be signed
+
+    Returns:
+        tuple: the (productversion, channel) of the MAR, or None if it doesn't
+            have them, and the digest to sign
+
+    """
+    algorithm_id, signature_size = SIGNATURE_ALGORITHMS[hash_algo]
+    with open(from_, "rb") as src, open(to, "wb") as dest:
+        try:
+            mardata = mar.parse_stream(src)
+        except Exception as e:
+            raise SigningScriptError(f"Can't parse mar {from_}: {e}")
+        if mardata.additional is None:
+            raise SigningScriptError(f"Can't sign {from_}: it has no additional sections")
+
+        extras = extras_header.build(mardata.additional)
+        data_offset = SIGNATURE_OFFSET + signature_size + len(extras)
+        index_offset = data_offset + mardata.data_length
+        data_offset_delta = data_offset - mardata.data_offset
+        for entry in mardata.index.entries:
+            entry.offset += data_offset_delta
+        index = index_header.build(mardata.index)
+        filesize = index_offset + len(index)
+
+        hasher = hashlib.new(hash_algo)
+
+        def write(data, covered=True):
+            dest.write(data)
+            if covered:
+                hasher.update(data)
+
+        write(mar_header.build({"index_offset": index_offset}))
+        write(_SIGS_HEADER.pack(filesize, 1, algorithm_id, signature_size))
+        write(b"\0" * signature_size, covered=False)
+        write(extras)
+        src.seek(mardata.data_offset)
+        remaining = mardata.data_length
+        while remaining:
+            buf = src.read(min(remaining, COPY_BUFFER_SIZE))
+            if not buf:
+                raise SigningScriptError(f"Unexpected end of mar {from_}")
+            write(buf)
+            remaining -= len(buf)
+        write(index)
+
+    log.debug("Wrote %s bytes of %s to %s", filesize, from_, to)
+    return _productinfo(mardata), hasher.digest()
+
+
+def write_mar_signature(path, signature):
+    """Patch a signature into a MAR written by `write_unsigned_mar`.
+
+    Args:
+        path (str): the path to the MAR
+        signature (bytes): the signature, of the size reserved for it
+
+    """
+    with open(path, "r+b") as fh:
+        fh.seek(SIGNATURE_OFFSET)
+        fh.write(signature)
+
+
+def verify_mar_hash_signature(verify_key, signature, digest, hash_algo):
+    """Verify a MAR signature against the digest it was made from.
+
+    Args:
+        verify_key (str): the path to the PEM encoded public key
+        signature (bytes): the signature
+        digest (bytes): the digest from `write_unsigned_mar`
+        hash_algo (str): one of `sha1` or `sha384`
+
+    Raises:
+        SigningScriptError: if the signature doesn't verify
+
+    """
+    with open(verify_key, "rb") as fh:
+        public_key = fh.read()
+    if not verify_signature(public_key, signature, digest, hash_algo):
+        raise SigningScriptError(f"Mar signature doesn't verify with {os.path.basename(verify_key)}")
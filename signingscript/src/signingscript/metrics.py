@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+"""Per file, per format and per stage signing metrics.
+
+`async_main` activates a `SigningMetrics` collector for the task, and
+`signing` marks which file and format the code running under it is working
+on. Code anywhere below that records its stages with `stage`, without
+having to pass the collector around, and each sample is attributed to the
+current file and format. When nothing has been activated, `stage` only
+times and discards.
+
+At the end of the task, the samples and their totals are written to the
+`public/logs/signing-metrics.json` artifact, and optionally to a
+Prometheus textfile collector file.
+"""
+
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import resource
+import tempfile
+import time
+from collections import defaultdict
+
+log = logging.getLogger(__name__)
+
+METRICS_ARTIFACT = "public/logs/signing-metrics.json"
+
+# (collector, path, format) for the code running in this context
+_current = contextvars.ContextVar("signing_metrics", default=(None, None, None))
+
+
+def get_rss():
+    """Return the maximum resident set size for this process, in KiB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class Stage:
+    """A stage being timed. Stages that transfer data add to `bytes_up` and `bytes_down`."""
+
+    def __init__(self):
+        self.bytes_up = 0
+        self.bytes_down = 0
+
+
+class SigningMetrics:
+    """Collect signing stage samples for a task.
+
+    Args:
+        task_id (str, optional): the task id, for the artifact
+        run_id (str, optional): the run id, for the artifact
+
+    """
+
+    def __init__(self, task_id=None, run_id=None):
+        self.task_id = task_id
+        self.run_id = run_id
+        self.samples = []
+        self._start = time.monotonic()
+
+    @classmethod
+    def from_env(cls):
+        """Create a SigningMetrics for the task that scriptworker is running."""
+        return cls(task_id=os.environ.get("TASK_ID"), run_id=os.environ.get("RUN_ID"))
+
+    def record(self, stage, seconds, *, path=None, fmt=None, function=None, max_rss_kb=None, rss_delta_kb=None, bytes_up=0, bytes_down=0):
+        """Record a sample.
+
+        Args:
+            stage (str): the stage, e.g. `extract`, `hash`, `autograph`, `compress` or `copy`
+            seconds (float): how long it took
+            path (str, optional): the file it was for
+            fmt (str, optional): the format it was for
+            function (str, optional): the function that was timed
+            max_rss_kb (int, optional): the process' peak RSS at the end of the stage
+            rss_delta_kb (int, optional): how much the peak RSS grew during the stage
+            bytes_up (int): how many bytes were sent
+            bytes_down (int): how many bytes were received
+
+        """
+        self.samples.append(
+            {
+                "path": path,
+                "format": fmt,
+                "stage": stage,
+                "function": function,
+                "seconds": round(seconds, 6),
+                "max_rss_kb": max_rss_kb,
+                "rss_delta_kb": rss_delta_kb,
+                "bytes_up": bytes_up,
+                "bytes_down": bytes_down,
+            }
+        )
+
+    def summary(self):
+        """Total the samples by stage, and by format and stage.
+
+        Returns:
+            dict: `by_stage` maps stages to totals, and `by_format` maps
+                formats to stages to totals. Totals have the `count`,
+                `seconds`, `max_seconds`, `bytes_up` and `bytes_down` of
+                the samples.
+
+        """
+
+        def totals():
+            return {"count": 0, "seconds": 0.0, "max_seconds": 0.0, "bytes_up": 0, "bytes_down": 0}
+
+        by_stage = defaultdict(totals)
+        by_format = defaultdict(lambda: defaultdict(totals))
+        for sample in self.samples:
+            for total in (by_stage[sample["stage"]], by_format[sample["format"] or ""][sample["stage"]]):
+                total["count"] += 1
+                total["seconds"] = round(total["seconds"] + sample["seconds"], 6)
+                total["max_seconds"] = max(total["max_seconds"], sample["seconds"])
+                total["bytes_up"] += sample["bytes_up"]
+                total["bytes_down"] += sample["bytes_down"]
+        return {
+            "by_stage": dict(by_stage),
+            "by_format": {fmt: dict(stages) for fmt, stages in by_format.items()},
+        }
+
+    def as_dict(self):
+        """Return the metrics artifact contents."""
+        return {
+            "task_id": self.task_id,
+            "run_id": self.run_id,
+            "elapsed_seconds": round(time.monotonic() - self._start, 6),
+            "max_rss_kb": get_rss(),
+            "summary": self.summary(),
+            "samples": self.samples,
+        }
+
+    def write(self, artifact_dir):
+        """Write the metrics artifact to `artifact_dir`.
+
+        Returns:
+            str: the path to the artifact
+
+        """
+        path = os.path.join(artifact_dir, METRICS_ARTIFACT)
+        _write_atomically(path, json.dumps(self.as_dict(), indent=2, sort_keys=True))
+        log.info("Wrote signing metrics to %s", path)
+        return path
+
+    def write_prometheus(self, path):
+        """Write the totals for this task to a Prometheus textfile collector file.
+
+        The values are gauges for the last task that ran, labelled by format
+        and stage.
+
+        Args:
+            path (str): the textfile to write; it should end in `.prom`
+
+        """
+        lines = []
+
+        def gauge(name, help_, values):
+            lines.append(f"# HELP {name} {help_}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in values:
+                label_str = ",".join(f'{key}="{_escape_label(val)}"' for key, val in labels.items())
+                lines.append(f"{name}{{{label_str}}} {value}" if label_str else f"{name} {value}")
+
+        by_format = self.summary()["by_format"]
+        for field, name, help_ in (
+            ("seconds", "signingscript_stage_seconds", "Seconds spent in each signing stage in the last task."),
+            ("count", "signingscript_stage_count", "Number of times each signing stage ran in the last task."),
+            ("bytes_up", "signingscript_stage_bytes_sent", "Bytes sent by each signing stage in the last task."),
+            ("bytes_down", "signingscript_stage_bytes_received", "Bytes received by each signing stage in the last task."),
+        ):
+            gauge(
+                name,
+                help_,
+                [({"format": fmt, "stage": stage}, total[field]) for fmt, stages in sorted(by_format.items()) for stage, total in sorted(stages.items())],
+            )
+        gauge("signingscript_max_rss_bytes", "Peak RSS of the last task.", [({}, get_rss() * 1024)])
+        gauge("signingscript_last_run_timestamp_seconds", "When the last task finished.", [({}, int(time.time()))])
+        _write_atomically(path, "\n".join(lines) + "\n")
+        log.info("Wrote signing metrics to %s", path)
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _write_atomically(path, contents):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=".tmp", dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, "w") as fh:
+            fh.write(contents)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+@contextlib.contextmanager
+def activate(metrics):
+    """Record the stages run in this context, and the tasks it creates, to `metrics`."""
+    token = _current.set((metrics, None, None))
+    try:
+        yield metrics
+    finally:
+        _current.reset(token)
+
+
+@contextlib.contextmanager
+def signing(path, fmt=None):
+    """Attribute the stages run in this context to `path` and `fmt`."""
+    metrics, _, _ = _current.get()
+    token = _current.set((metrics, path, fmt))
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+@contextlib.contextmanager
+def stage(name, function=None):
+    """Time a stage, and record it to the active collector.
+
+    Args:
+        name (str): the stage. If None, nothing is recorded.
+        function (str, optional): the function being timed
+
+    Yields:
+        Stage: add the bytes sent and received during the stage to this
+
+    """
+    current = Stage()
+    start = time.monotonic()
+    start_rss = get_rss()
+    try:
+        yield current
+    finally:
+        metrics, path, fmt = _current.get()
+        if name and metrics is not None:
+            rss = get_rss()
+            metrics.record(
+                name,
+                time.monotonic() - start,
+                path=path,
+                fmt=fmt,
+                function=function,
+                max_rss_kb=rss,
+                rss_delta_kb=rss - start_rss,
+                bytes_up=current.bytes_up,
+                bytes_down=current.bytes_down,
+            )
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+"""Persist Apple notarization submission ids across task runs.
+
+Uploading a package to Apple's notary service can take a long time, and
+Apple keeps processing a submission after the task that made it has gone
+away. Each submission id is recorded in a manifest artifact, keyed by the
+digest of what was submitted. A rerun of the same task reads the previous
+run's manifest, and waits on those submissions instead of uploading the same
+packages again.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+import aiohttp
+
+log = logging.getLogger(__name__)
+
+SUBMISSION_MANIFEST = "public/logs/notarization-submissions.json"
+# How many seconds to wait for the previous run's manifest, rather than
+# aiohttp's default of 5 minutes; without it, everything is just resubmitted
+FETCH_TIMEOUT = 30
+
+
+def notarization_digest(path):
+    """Get the sha256 hexdigest of a file, or of the contents of a bundle directory.
+
+    A directory's digest covers the relative path, and the contents or link
+    target, of everything in it.
+
+    Args:
+        path (str): the path that will be submitted for notarization
+
+    Returns:
+        str: the hexdigest
+
+    """
+    h = hashlib.sha256()
+    if not os.path.isdir(path):
+        with open(path, "rb") as f:
+            return hashlib.file_digest(f, "sha256").hexdigest()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files + [d for d in dirs if os.path.islink(os.path.join(root, d))]):
+            full_path = os.path.join(root, name)
+            h.update(os.path.relpath(full_path, path).encode("utf-8") + b"\0")
+            if os.path.islink(full_path):
+                h.update(b"link\0" + os.readlink(full_path).encode("utf-8") + b"\0")
+            else:
+                with open(full_path, "rb") as f:
+                    h.update(hashlib.file_digest(f, "sha256").digest())
+    return h.hexdigest()
+
+
+def get_previous_manifest_url(root_url, task_id, run_id):
+    """Get the url of the previous run's submission manifest.
+
+    Args:
+        root_url (str): the taskcluster root url
+        task_id (str): the task id
+        run_id (int): the current run id
+
+    Returns:
+        str: the url, or None on the first run
+
+    """
+    if not run_id or not task_id or not root_url:
+        return None
+    return f"{root_url.rstrip('/')}/api/queue/v1/task/{task_id}/runs/{run_id - 1}/artifacts/{SUBMISSION_MANIFEST}"
+
+
+async def fetch_previous_submissions(url, timeout=FETCH_TIMEOUT):
+    """Download a previous run's submission manifest.
+
+    A missing or unreadable manifest, or one that takes longer than
+    `timeout` to download, isn't an error; it just means that everything
+    gets submitted again.
+
+    Args:
+        url (str): the url of the manifest
+        timeout (float, optional): how many seconds to wait for it
+
+    Returns:
+        dict: maps digests to submission ids
+
+    """
+    try:
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout)) as session, session.get(url) as resp:
+            if resp.status == 404:
+                log.info(f"No notarization submission manifest at {url}")
+                return {}
+            resp.raise_for_status()
+            manifest = await resp.json(content_type=None)
+        return {digest: entry["submission_id"] for digest, entry in manifest["submissions"].items()}
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError, TypeError) as e:
+        log.warning(f"Can't read notarization submission manifest at {url}: {e}")
+        return {}
+
+
+class SubmissionManifest:
+    """The notarization submissions made, or resumed, by this run.
+
+    The manifest is rewritten after every change, so it's complete even if
+    the task fails part way through.
+
+    Args:
+        path (str): where to write the manifest
+        previous (dict, optional): maps digests to the submission ids of the
+            previous run
+
+    """
+
+    def __init__(self, path, previous=None):
+        self.path = path
+        self.previous = previous or {}
+        self.submissions = {}
+
+    @classmethod
+    async def load(cls, context):
+        """Create the manifest for this run, reading the previous run's on a rerun.
+
+        Args:
+            context (Context): the signing context
+
+        Returns:
+            SubmissionManifest: the manifest
+
+        """
+        previous = {}
+        url = get_previous_manifest_url(
+            os.environ.get("TASKCLUSTER_ROOT_URL"),
+            os.environ.get("TASK_ID"),
+            int(os.environ.get("RUN_ID") or 0),
+        )
+        if url:
+            previous = await fetch_previous_submissions(url)
+            log.info(f"Found {len(previous)} notarization submissions from the previous run")
+        return cls(os.path.join(context.config["artifact_dir"], SUBMISSION_MANIFEST), previous)
+
+    def get_previous(self, digest):
+        """Get the previous run's submission id for `digest`, if any."""
+        return self.previous.get(digest)
+
+    def add(self, digest, submission_id, name):
+        """Record a submission, and rewrite the manifest.
+
+        Args:
+            digest (str): the digest of what was submitted, from `notarization_digest`
+            submission_id (str): the notary submission id
+            name (str): the name of what was submitted, for humans
+
+        """
+        self.submissions[digest] = {"submission_id": submission_id, "name": name}
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=".tmp", dir=os.path.dirname(self.path))
+        try:
+            with os.fdopen(fd, "w") as fh:
+                json.dump({"submissions": self.submissions}, fh, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
@@ -2,23 +2,42 @@
 """Signing script."""
 
 import asyncio
+import contextlib
+import functools
 import json
 import logging
 import os
 import tempfile
 from dataclasses import asdict
 
-import aiohttp
 import scriptworker.client
+from scriptworker.utils import raise_future_exceptions
 
+from signingscript import metrics
+from signingscript.autograph import DEFAULT_BATCH_WINDOW, DEFAULT_LIMIT_PER_HOST, DEFAULT_MAX_BATCH_SIZE, AutographClient, RequestBatcher
+from signingscript.cache import SigningCache
+from signingscript.compression import get_compression_executor
 from signingscript.exceptions import SigningScriptError
 from signingscript.task import apple_notarize_stacked, build_filelist_dict, sign, task_cert_type, task_signing_formats
-from signingscript.utils import copy_to_dir, load_apple_notarization_configs, load_autograph_configs, load_json
+from signingscript.utils import copy_to_dir, get_executor, load_apple_notarization_configs, load_autograph_configs, load_json
+
+# signingscript.sign imports signingscript.task, which imports from it, so
+# it can only be imported once signingscript.task has been
+from signingscript.sign import sign_hash_batch_with_autograph  # isort:skip
 
 log = logging.getLogger(__name__)
 
+DEFAULT_SIGNING_CONCURRENCY = 8
+# How artifacts are staged into `work_dir` and `artifact_dir`: `copy`, or
+# `link` for reflinks or hard links (see `copy_to_dir`), which workers can
+# opt into with `artifact_staging` to save the copies.
+DEFAULT_ARTIFACT_STAGING = "copy"
+
 GPG_FORMATS = {"autograph_gpg", "gcp_prod_autograph_gpg", "stage_autograph_gpg"}
 RPM_FORMATS = {"autograph_rpmsign", "gcp_prod_autograph_rpmsign", "stage_autograph_rpmsign"}
+# These formats share a single `apple_notarize` workdir, so paths using them
+# can't be signed concurrently.
+SERIAL_FORMATS = {"apple_notarization", "apple_notarization_geckodriver", "apple_notarization_openh264_plugin"}
 
 
 # async_main {{{1
@@ -30,7 +49,19 @@ async def async_main(context):
 
     """
     work_dir = context.config["work_dir"]
-    async with aiohttp.ClientSession() as session:
+    context.autograph_configs = load_autograph_configs(context.config["autograph_configs"])
+    async with contextlib.AsyncExitStack() as stack:
+        # Stage timings of everything below, including the tasks it
+        # creates, are written out when the task finishes, even if it fails
+        context.metrics = stack.enter_context(metrics.activate(metrics.SigningMetrics.from_env()))
+        stack.callback(write_metrics, context)
+        # One pooled client is shared by every format, so concurrent signing
+        # reuses the same connections to each autograph server
+        session = await stack.enter_async_context(AutographClient.from_config(context.config, context.autograph_configs))
+        # Blocking archive, hashing and compression helpers run in this pool
+        context.executor = stack.enter_context(get_executor(context.config))
+        # Parallel tarball compression, if enabled, shares one bounded pool
+        context.compression_executor = stack.enter_context(get_compression_executor(context.config))
         all_signing_formats = task_signing_formats(context)
         if GPG_FORMATS.intersection(all_signing_formats):
             check_gpg_pubkey(context, "GPG")
@@ -55,7 +86,13 @@ async def async_main(context):
             setup_apple_notarization_credentials(context)
 
         context.session = session
-        context.autograph_configs = load_autograph_configs(context.config["autograph_configs"])
+        context.signing_cache = SigningCache.from_config(context.config)
+        if context.config.get("autograph_hash_batch_size", DEFAULT_MAX_BATCH_SIZE) > 1:
+            context.hash_batcher = RequestBatcher(
+                functools.partial(sign_hash_batch_with_autograph, session),
+                window=context.config.get("autograph_hash_batch_window", DEFAULT_BATCH_WINDOW),
+                max_batch_size=context.config.get("autograph_hash_batch_size", DEFAULT_MAX_BATCH_SIZE),
+            )
         if "mar_channels" in context.config:
             context.mar_channels = load_json(context.config["mar_channels"])
         else:
@@ -65,18 +102,21 @@ async def async_main(context):
         #       That would likely mean changing all behaviors to accept and deal with multiple files at once.
 
         filelist_dict = build_filelist_dict(context)
+        for path_dict in filelist_dict.values():
+            if path_dict["formats"] != ["apple_notarization_stacked"] and "apple_notarization_stacked" in path_dict["formats"]:
+                raise SigningScriptError("apple_notarization_stacked cannot be mixed with other signing types")
+
+        # Sign each path in its own task; formats within a path are still
+        # applied in order by `sign`.
+        semaphore = asyncio.Semaphore(context.config.get("signing_concurrency", DEFAULT_SIGNING_CONCURRENCY))
+        serial_lock = asyncio.Lock()
+        tasks = []
         for path, path_dict in filelist_dict.items():
             if path_dict["formats"] == ["apple_notarization_stacked"]:
                 # Skip if only format is notarization_stacked - handled below
                 continue
-            if "apple_notarization_stacked" in path_dict["formats"]:
-                raise SigningScriptError("apple_notarization_stacked cannot be mixed with other signing types")
-            copy_to_dir(path_dict["full_path"], context.config["work_dir"], target=path)
-            log.info("signing %s", path)
-            output_files = await sign(context, os.path.join(work_dir, path), path_dict["formats"], authenticode_comment=path_dict.get("comment"))
-            for source in output_files:
-                source = os.path.relpath(source, work_dir)
-                copy_to_dir(os.path.join(work_dir, source), context.config["artifact_dir"], target=source)
+            tasks.append(asyncio.create_task(_sign_path(context, path, path_dict, semaphore, serial_lock)))
+        await raise_future_exceptions(tasks)
 
         # notarization_stacked is a special format that takes in all files at once instead of sequentially like other formats
         # Should be fixed in https://github.com/mozilla-releng/scriptworker-scripts/issues/980
@@ -85,11 +125,61 @@ async def async_main(context):
             output_files = await apple_notarize_stacked(context, notarization_dict)
             for source in output_files:
                 source = os.path.relpath(source, work_dir)
-                copy_to_dir(os.path.join(work_dir, source), context.config["artifact_dir"], target=source)
+                copy_to_dir(
+                    os.path.join(work_dir, source),
+                    context.config["artifact_dir"],
+                    target=source,
+                    method=context.config.get("artifact_staging", DEFAULT_ARTIFACT_STAGING),
+                )
 
     log.info("Done!")
 
 
+async def _sign_path(context, path, path_dict, semaphore, serial_lock):
+    """Stage `path` into `work_dir`, sign it, and stage the outputs into `artifact_dir`.
+
+    Args:
+        context (Context): the signing context.
+        path (str): the relative path of the upstream artifact.
+        path_dict (dict): the `build_filelist_dict` entry for `path`.
+        semaphore (asyncio.Semaphore): bounds the number of paths signed at once.
+        serial_lock (asyncio.Lock): held while signing paths with `SERIAL_FORMATS`.
+
+    """
+    work_dir = context.config["work_dir"]
+    staging = context.config.get("artifact_staging", DEFAULT_ARTIFACT_STAGING)
+    async with semaphore:
+        with metrics.signing(path), metrics.stage("copy", "copy_to_dir"):
+            copy_to_dir(path_dict["full_path"], work_dir, target=path, method=staging)
+        log.info("signing %s", path)
+        if SERIAL_FORMATS.intersection(path_dict["formats"]):
+            async with serial_lock:
+                output_files = await sign(context, os.path.join(work_dir, path), path_dict["formats"], authenticode_comment=path_dict.get("comment"))
+        else:
+            output_files = await sign(context, os.path.join(work_dir, path), path_dict["formats"], authenticode_comment=path_dict.get("comment"))
+        with metrics.signing(path), metrics.stage("copy", "copy_to_dir"):
+            for source in output_files:
+                source = os.path.relpath(source, work_dir)
+                copy_to_dir(os.path.join(work_dir, source), context.config["artifact_dir"], target=source, method=staging)
+
+
+def write_metrics(context):
+    """Write the signing metrics artifact, and the Prometheus textfile if configured.
+
+    Failing to write metrics doesn't fail the task.
+
+    Args:
+        context (Context): the signing context.
+
+    """
+    try:
+        context.metrics.write(context.config["artifact_dir"])
+        if context.config.get("metrics_prometheus_textfile"):
+            context.metrics.write_prometheus(context.config["metrics_prometheus_textfile"])
+    except OSError:
+        log.exception("Couldn't write signing metrics")
+
+
 def check_gpg_pubkey(context, format_name):
     """Make sure the configured gpg pubkey exists.
 
@@ -168,6 +258,9 @@ def get_default_config(base_dir=None):
         "hfsplus": "hfsplus",
         "gpg_pubkey": None,
         "widevine_cert": None,
+        "signing_concurrency": DEFAULT_SIGNING_CONCURRENCY,
+        "autograph_concurrency": DEFAULT_LIMIT_PER_HOST,
+        "artifact_staging": DEFAULT_ARTIFACT_STAGING,
     }
     return default_config
 
@@ -3,6 +3,8 @@
 
 import asyncio
 import base64
+import binascii
+import contextlib
 import difflib
 import fnmatch
 import glob
@@ -10,30 +12,34 @@ import hashlib
 import json
 import logging
 import lzma
+import mmap
 import os
 import pathlib
 import re
-import resource
 import shutil
-import subprocess
+import struct
 import sys
 import tarfile
 import tempfile
 import time
 import zipfile
-from functools import wraps
+from functools import partial, wraps
 from io import BytesIO
 
 import mohawk
-import winsign.sign
-from mardor.reader import MarReader
-from mardor.writer import add_signature_block
+import winsign.osslsigncode
 from scriptworker.utils import get_single_item_from_sequence, makedirs, raise_future_exceptions, retry_async, rm
 from winsign.crypto import load_pem_certs
 
-from signingscript import task, utils
+from signingscript import authenticode, metrics, task, utils
+from signingscript.archive import copy_bytes, seek_zip_member_data, update_zipfile
+from signingscript.authenticode import AuthenticodePool, find_unsigned_zip_members
+from signingscript.compression import DEFAULT_COMPRESSION_WORKERS, create_parallel_tarfile, open_decompressed
 from signingscript.createprecomplete import generate_precomplete
 from signingscript.exceptions import SigningScriptError
+from signingscript.marfile import verify_mar_hash_signature, write_mar_signature, write_unsigned_mar
+from signingscript.metrics import get_rss
+from signingscript.notarization import SubmissionManifest, notarization_digest
 from signingscript.rcodesign import RCodesignError, rcodesign_notarize, rcodesign_notary_wait, rcodesign_staple
 
 log = logging.getLogger(__name__)
@@ -98,24 +104,33 @@ _DEFAULT_MAR_VERIFY_KEYS = {
     },
 }
 
+# How many bytes of input to base64 encode at a time when streaming requests
+# to autograph. This must be a multiple of 3.
+DEFAULT_ENCODE_BLOCK_SIZE = 3 * 1024 * 1024
+
+# How many paths to notarize, or probe for notarization tickets, at once
+DEFAULT_NOTARIZATION_CONCURRENCY = 8
+
 # Langpacks expect the following re to match for addon id
 LANGPACK_RE = re.compile(r"^langpack-[a-zA-Z]+(?:-[a-zA-Z]+){0,2}@(?:firefox|devedition).mozilla.org$")
 
 
-def get_rss():
-    """Return the maximum resident set size for this process."""
-    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+def time_async_function(f=None, *, stage=None):
+    """Time an async function.
 
-
-def time_async_function(f):
-    """Time an async function."""
+    If `stage` is set, the time is also recorded as that stage in the
+    signing metrics. See `signingscript.metrics`.
+    """
+    if f is None:
+        return partial(time_async_function, stage=stage)
 
     @wraps(f)
     async def wrapped(*args, **kwargs):
         start = time.time()
         start_rss = get_rss()
         try:
-            return await f(*args, **kwargs)
+            with metrics.stage(stage, f.__name__):
+                return await f(*args, **kwargs)
         finally:
             rss = get_rss()
             log.debug("%s took %.2fs; RSS:%s (%+d)", f.__name__, time.time() - start, rss, rss - start_rss)
@@ -167,6 +182,11 @@ def get_autograph_config(autograph_configs, cert_type, signing_formats, raise_on
     return None
 
 
+def get_encode_block_size(context):
+    """Return how many bytes of input to encode at a time when streaming requests to autograph."""
+    return context.config.get("autograph_encode_block_size", DEFAULT_ENCODE_BLOCK_SIZE)
+
+
 # sign_file {{{1
 async def sign_file(context, from_, fmt, to=None, **kwargs):
     """Send the file to autograph to be signed.
@@ -250,6 +270,8 @@ async def sign_widevine(context, orig_path, fmt, **kwargs):
         context (Context): the signing context
         orig_path (str): the source file to sign
         fmt (str): the format to sign with
+        archive (ArchiveSession, optional): the session for the archive, if
+            other formats are working on it too
 
     Raises:
         SigningScriptError: on unknown suffix.
@@ -271,60 +293,57 @@ async def sign_widevine(context, orig_path, fmt, **kwargs):
     }
     for ext, signing_func in ext_to_fn.items():
         if orig_path.endswith(ext):
-            return await signing_func(context, orig_path, fmt)
+            return await signing_func(context, orig_path, fmt, archive=kwargs.get("archive"))
     raise SigningScriptError("Unknown widevine file format for {}".format(orig_path))
 
 
 # sign_widevine_zip {{{1
 @time_async_function
-async def sign_widevine_zip(context, orig_path, fmt):
+async def sign_widevine_zip(context, orig_path, fmt, archive=None):
     """Sign the internals of a zipfile with the widevine key.
 
-    Extract the files to sign (see `_WIDEVINE_BLESSED_FILENAMES` and
+    Extract only the files to sign (see `_WIDEVINE_BLESSED_FILENAMES` and
     `_WIDEVINE_UNBLESSED_FILENAMES), skipping already-signed files.
     The blessed files should be signed with the `widevine_blessed` format.
-    Then append the sigfiles to the zipfile.
+    Then append the sigfiles to the zipfile, and replace `precomplete`, which
+    is generated from the zipfile's member names. See `ArchiveSession.close`.
 
     Args:
         context (Context): the signing context
         orig_path (str): the source file to sign
         fmt (str): the format to sign with
+        archive (ArchiveSession, optional): the session for the archive. If
+            None, the archive is opened and re-packed by this function.
 
     Returns:
         str: the path to the signed archive
 
     """
-    # This will get cleaned up when we nuke `work_dir`. Clean up at that point
-    # rather than immediately after `sign_widevine`, to optimize task runtime
-    # speed over disk space.
-    tmp_dir = tempfile.mkdtemp(prefix="wvzip", dir=context.config["work_dir"])
-    # Get file list
-    all_files = await _get_zipfile_files(orig_path)
-    files_to_sign = _get_widevine_signing_files(all_files)
-    log.debug("Widevine files to sign: %s", files_to_sign)
-    if files_to_sign:
-        # Extract all files so we can create `precomplete` with the full
-        # file list
-        all_files = await _extract_zipfile(context, orig_path, tmp_dir=tmp_dir)
-        tasks = []
-        # Sign the appropriate inner files
-        for from_, blessed in files_to_sign.items():
-            from_ = os.path.join(tmp_dir, from_)
-            to = f"{from_}.sig"
-            tasks.append(asyncio.ensure_future(sign_widevine_with_autograph(context, from_, blessed, fmt, to=to)))
-            all_files.append(to)
-        await raise_future_exceptions(tasks)
-        remove_extra_files(tmp_dir, all_files)
-        # Regenerate the `precomplete` file, which is used for cleanup before
-        # applying a complete mar.
-        _run_generate_precomplete(context, tmp_dir)
-        await _create_zipfile(context, orig_path, all_files, mode="w", tmp_dir=tmp_dir)
+    async with _open_archive(context, orig_path, archive) as archive:
+        files_to_sign = _get_widevine_signing_files(await archive.names())
+        log.debug("Widevine files to sign: %s", files_to_sign)
+        if files_to_sign:
+            # `precomplete` is generated from the member names, so only the
+            # files to sign need extracting
+            extracted = await archive.extract(list(files_to_sign))
+            tasks = []
+            changed_files = []
+            # Sign the appropriate inner files
+            for from_, blessed in zip(extracted, files_to_sign.values()):
+                to = f"{from_}.sig"
+                tasks.append(asyncio.ensure_future(sign_widevine_with_autograph(context, from_, blessed, fmt, to=to)))
+                changed_files.append(to)
+            await raise_future_exceptions(tasks)
+            archive.changed(changed_files)
+            # Regenerate the `precomplete` file, which is used for cleanup
+            # before applying a complete mar, when the archive is re-packed.
+            archive.regenerate_precomplete = True
     return orig_path
 
 
 # sign_widevine_tar {{{1
 @time_async_function
-async def sign_widevine_tar(context, orig_path, fmt):
+async def sign_widevine_tar(context, orig_path, fmt, archive=None):
     """Sign the internals of a tarfile with the widevine key.
 
     Extract the entire tarball, but only sign a handful of files (see
@@ -339,43 +358,39 @@ async def sign_widevine_tar(context, orig_path, fmt):
         context (Context): the signing context
         orig_path (str): the source file to sign
         fmt (str): the format to sign with
+        archive (ArchiveSession, optional): the session for the archive. If
+            None, the archive is opened and re-packed by this function.
 
     Returns:
         str: the path to the signed archive
 
     """
-    _, compression = os.path.splitext(orig_path)
-    # This will get cleaned up when we nuke `work_dir`. Clean up at that point
-    # rather than immediately after `sign_widevine`, to optimize task runtime
-    # speed over disk space.
-    tmp_dir = tempfile.mkdtemp(prefix="wvtar", dir=context.config["work_dir"])
-    # Get file list
-    all_files = await _get_tarfile_files(orig_path, compression)
-    files_to_sign = _get_widevine_signing_files(all_files)
-    log.debug("Widevine files to sign: %s", files_to_sign)
-    if files_to_sign:
-        # Extract all files so we can create `precomplete` with the full
-        # file list
-        all_files = await _extract_tarfile(context, orig_path, compression, tmp_dir=tmp_dir)
-        tasks = []
-        # Sign the appropriate inner files
-        for from_, blessed in files_to_sign.items():
-            from_ = os.path.join(tmp_dir, from_)
-            # Don't try to sign directories
-            if not os.path.isfile(from_):
-                continue
-            # Move the sig location on mac. This should be noop on linux.
-            to = _get_mac_sigpath(from_)
-            log.debug("Adding %s to the sigfile paths...", to)
-            makedirs(os.path.dirname(to))
-            tasks.append(asyncio.ensure_future(sign_widevine_with_autograph(context, from_, blessed, fmt, to=to)))
-            all_files.append(to)
-        await raise_future_exceptions(tasks)
-        remove_extra_files(tmp_dir, all_files)
-        # Regenerate the `precomplete` file, which is used for cleanup before
-        # applying a complete mar.
-        _run_generate_precomplete(context, tmp_dir)
-        await _create_tarfile(context, orig_path, all_files, compression, tmp_dir=tmp_dir)
+    async with _open_archive(context, orig_path, archive) as archive:
+        # Extract all files so we can create `precomplete` with the full file
+        # list. Listing the files first would mean decompressing the tarball
+        # twice.
+        all_files = await archive.extract()
+        files_to_sign = _get_widevine_signing_files(all_files)
+        log.debug("Widevine files to sign: %s", files_to_sign)
+        if files_to_sign:
+            tasks = []
+            sigfiles = []
+            # Sign the appropriate inner files
+            for from_, blessed in files_to_sign.items():
+                # Don't try to sign directories
+                if not os.path.isfile(from_):
+                    continue
+                # Move the sig location on mac. This should be noop on linux.
+                to = _get_mac_sigpath(from_)
+                log.debug("Adding %s to the sigfile paths...", to)
+                makedirs(os.path.dirname(to))
+                tasks.append(asyncio.ensure_future(sign_widevine_with_autograph(context, from_, blessed, fmt, to=to)))
+                sigfiles.append(to)
+            await raise_future_exceptions(tasks)
+            archive.changed(sigfiles)
+            # Regenerate the `precomplete` file, which is used for cleanup
+            # before applying a complete mar, when the archive is re-packed.
+            archive.regenerate_precomplete = True
     return orig_path
 
 
@@ -388,6 +403,8 @@ async def sign_omnija(context, orig_path, fmt, **kwargs):
         context (Context): the signing context
         orig_path (str): the source file to sign
         fmt (str): the format to sign with
+        archive (ArchiveSession, optional): the session for the archive, if
+            other formats are working on it too
 
     Raises:
         SigningScriptError: on unknown suffix.
@@ -409,50 +426,47 @@ async def sign_omnija(context, orig_path, fmt, **kwargs):
     }
     for ext, signing_func in ext_to_fn.items():
         if orig_path.endswith(ext):
-            return await signing_func(context, orig_path, fmt)
+            return await signing_func(context, orig_path, fmt, archive=kwargs.get("archive"))
     raise SigningScriptError("Unknown omnija file format for {}".format(orig_path))
 
 
 # sign_omnija_zip {{{1
-async def sign_omnija_zip(context, orig_path, fmt):
+async def sign_omnija_zip(context, orig_path, fmt, archive=None):
     """Sign the internals of a zipfile with the omnija key for all omni.ja files.
 
     Extract the files to sign, then sign them with autograph, recreating the omni.ja
     from the original to preserve performance tweeks but adding signing info,
-    Then append the sigfiles to the zipfile.
+    Then replace them in the zipfile, copying the other members across
+    without recompressing them.
 
     Args:
         context (Context): the signing context
         orig_path (str): the source file to sign
         fmt (str): the format to sign with
+        archive (ArchiveSession, optional): the session for the archive. If
+            None, the archive is opened and re-packed by this function.
 
     Returns:
         str: the path to the signed archive
 
     """
-    # This will get cleaned up when we nuke `work_dir`. Clean up at that point
-    # rather than immediately after `sign_omnija`, to optimize task runtime
-    # speed over disk space.
-    tmp_dir = tempfile.mkdtemp(prefix="ojzip", dir=context.config["work_dir"])
-    # Get file list
-    all_files = await _get_zipfile_files(orig_path)
-    files_to_sign = _get_omnija_signing_files(all_files)
-    log.debug("Omnija files to sign: %s", files_to_sign)
-    if files_to_sign:
-        all_files = await _extract_zipfile(context, orig_path, tmp_dir=tmp_dir)
-        tasks = []
-        # Sign the appropriate inner files
-        for from_, _ in files_to_sign.items():
-            from_ = os.path.join(tmp_dir, from_)
-            tasks.append(asyncio.ensure_future(sign_omnija_with_autograph(context, from_, fmt)))
-        await raise_future_exceptions(tasks)
-        await _create_zipfile(context, orig_path, all_files, mode="w", tmp_dir=tmp_dir)
+    async with _open_archive(context, orig_path, archive) as archive:
+        files_to_sign = _get_omnija_signing_files(await archive.names())
+        log.debug("Omnija files to sign: %s", files_to_sign)
+        if files_to_sign:
+            changed_files = await archive.extract(list(files_to_sign))
+            tasks = []
+            # Sign the appropriate inner files
+            for from_ in changed_files:
+                tasks.append(asyncio.ensure_future(sign_omnija_with_autograph(context, from_, fmt)))
+            await raise_future_exceptions(tasks)
+            archive.changed(changed_files)
     return orig_path
 
 
 # sign_omnija_tar {{{1
 @time_async_function
-async def sign_omnija_tar(context, orig_path, fmt):
+async def sign_omnija_tar(context, orig_path, fmt, archive=None):
     """Sign the internals of a tarfile with the omnija key for all omni.ja files.
 
     Extract the files to sign, then sign them with autograph, recreating the omni.ja
@@ -463,34 +477,31 @@ async def sign_omnija_tar(context, orig_path, fmt):
         context (Context): the signing context
         orig_path (str): the source file to sign
         fmt (str): the format to sign with
+        archive (ArchiveSession, optional): the session for the archive. If
+            None, the archive is opened and re-packed by this function.
 
     Returns:
         str: the path to the signed archive
 
     """
-    _, compression = os.path.splitext(orig_path)
-    # This will get cleaned up when we nuke `work_dir`. Clean up at that point
-    # rather than immediately after `sign_widevine`, to optimize task runtime
-    # speed over disk space.
-    tmp_dir = tempfile.mkdtemp(prefix="ojtar", dir=context.config["work_dir"])
-    # Get file list
-    all_files = await _get_tarfile_files(orig_path, compression)
-    files_to_sign = _get_omnija_signing_files(all_files)
-    log.debug("Omnija files to sign: %s", files_to_sign)
-    if files_to_sign:
-        # Extract all files so we can create `precomplete` with the full
-        # file list
-        all_files = await _extract_tarfile(context, orig_path, compression, tmp_dir=tmp_dir)
-        tasks = []
-        # Sign the appropriate inner files
-        for from_, _ in files_to_sign.items():
-            from_ = os.path.join(tmp_dir, from_)
-            # Don't try to sign directories
-            if not os.path.isfile(from_):
-                continue
-            tasks.append(asyncio.ensure_future(sign_omnija_with_autograph(context, from_, fmt)))
-        await raise_future_exceptions(tasks)
-        await _create_tarfile(context, orig_path, all_files, compression, tmp_dir=tmp_dir)
+    async with _open_archive(context, orig_path, archive) as archive:
+        # Extract all files, since we need them all to recreate the tarball.
+        # Listing the files first would mean decompressing the tarball twice.
+        all_files = await archive.extract()
+        files_to_sign = _get_omnija_signing_files(all_files)
+        log.debug("Omnija files to sign: %s", files_to_sign)
+        if files_to_sign:
+            tasks = []
+            changed_files = []
+            # Sign the appropriate inner files
+            for from_ in files_to_sign:
+                # Don't try to sign directories
+                if not os.path.isfile(from_):
+                    continue
+                tasks.append(asyncio.ensure_future(sign_omnija_with_autograph(context, from_, fmt)))
+                changed_files.append(from_)
+            await raise_future_exceptions(tasks)
+            archive.changed(changed_files)
     return orig_path
 
 
@@ -585,29 +596,63 @@ def _get_omnija_signing_files(file_list):
 
 
 # _run_generate_precomplete {{{1
-def _run_generate_precomplete(context, tmp_dir):
-    """Regenerate `precomplete` file with widevine sig paths for complete mar."""
+def _run_generate_precomplete(context, tmp_dir, names=None, archive_path=None):
+    """Regenerate `precomplete` file with widevine sig paths for complete mar.
+
+    The diff of the old and new `precomplete` is uploaded as
+    `public/logs/precomplete-<archive>.diff`, where `<archive>` is the
+    archive's path in `work_dir`, with slashes replaced by underscores, so
+    that archives signed concurrently don't overwrite each other's diffs.
+
+    Args:
+        context (Context): the signing context
+        tmp_dir (str): the directory the archive is extracted to
+        names (list, optional): the names of the archive's members. If
+            given, `precomplete` lists them, and only `precomplete` itself
+            needs to be extracted. Otherwise, it lists the files in `tmp_dir`.
+        archive_path (str, optional): the path of the archive. If None, the
+            diff is uploaded as `public/logs/precomplete.diff`.
+
+    Returns:
+        str: the path to the regenerated `precomplete` file
+
+    """
     log.info("Generating `precomplete` file...")
-    path = _ensure_one_precomplete(tmp_dir, "before")
+    paths = None
+    if names is not None:
+        # Directory members end with a slash, which abspath would drop
+        paths = [os.path.abspath(os.path.join(tmp_dir, name)) + ("/" if name.endswith("/") else "") for name in names]
+    path = _ensure_one_precomplete(tmp_dir, "before", paths)
     with open(path, "r") as fh:
         before = fh.readlines()
-    generate_precomplete(os.path.dirname(path))
-    path = _ensure_one_precomplete(tmp_dir, "after")
+    generate_precomplete(os.path.dirname(path), paths=paths)
+    path = _ensure_one_precomplete(tmp_dir, "after", paths)
     with open(path, "r") as fh:
         after = fh.readlines()
     # Create diff file
-    diff_path = os.path.join(context.config["work_dir"], "precomplete.diff")
+    diff_name = "precomplete.diff"
+    if archive_path is not None:
+        archive_name = os.path.relpath(os.path.abspath(archive_path), os.path.abspath(context.config["work_dir"]))
+        if archive_name.startswith(os.pardir):
+            archive_name = os.path.basename(archive_path)
+        diff_name = "precomplete-{}.diff".format(archive_name.replace(os.sep, "_"))
+    diff_path = os.path.join(context.config["work_dir"], diff_name)
     with open(diff_path, "w") as fh:
         for line in difflib.ndiff(before, after):
             fh.write(line)
-    utils.copy_to_dir(diff_path, context.config["artifact_dir"], target="public/logs/precomplete.diff")
+    utils.copy_to_dir(diff_path, context.config["artifact_dir"], target=f"public/logs/{diff_name}")
+    return path
 
 
 # _ensure_one_precomplete {{{1
-def _ensure_one_precomplete(tmp_dir, adj):
-    """Ensure we only have one `precomplete` file in `tmp_dir`."""
+def _ensure_one_precomplete(tmp_dir, adj, paths=None):
+    """Ensure we only have one `precomplete` file in `tmp_dir`, or in `paths` if given."""
+    if paths is None:
+        candidates = glob.glob(os.path.join(tmp_dir, "**", "precomplete"), recursive=True)
+    else:
+        candidates = [path for path in paths if os.path.basename(path) == "precomplete"]
     return get_single_item_from_sequence(
-        glob.glob(os.path.join(tmp_dir, "**", "precomplete"), recursive=True),
+        candidates,
         condition=lambda _: True,
         ErrorClass=SigningScriptError,
         no_item_error_message='No `precomplete` file found in "{}"'.format(tmp_dir),
@@ -640,7 +685,15 @@ def remove_extra_files(top_dir, file_list):
 # _convert_dmg_to_tar_gz {{{1
 @time_async_function
 async def _convert_dmg_to_tar_gz(context, from_):
-    """Explode a dmg and tar up its contents. Return the relative tarball path."""
+    """Explode a dmg and tar up its contents. Return the relative tarball path.
+
+    `hfsplus` needs random access to the HFS+ image, and can only extract
+    to a directory, so those two stages still go through disk. The HFS+
+    image is removed as soon as it's been extracted, and the tarball is
+    written in-process with `_create_tarfile`. That's a single gzip stream
+    by default, which stream readers like `tar -xzf -` can read; see
+    `compression` for what opting into `compression_workers` changes.
+    """
     work_dir = context.config["work_dir"]
     abs_from = os.path.join(work_dir, from_)
     # replace .dmg suffix with .tar.gz (case insensitive)
@@ -652,16 +705,184 @@ async def _convert_dmg_to_tar_gz(context, from_):
     with tempfile.TemporaryDirectory() as temp_dir:
         app_dir = os.path.join(temp_dir, "app")
         utils.mkdir(app_dir)
-        undmg_cmd = [dmg_executable_location, "extract", abs_from, "tmp.hfs"]
-        await utils.execute_subprocess(undmg_cmd, cwd=temp_dir, log_level=logging.DEBUG)
-        hfsplus_cmd = [hfsplus_executable_location, "tmp.hfs", "extractall", "/", app_dir]
-        await utils.execute_subprocess(hfsplus_cmd, cwd=temp_dir, log_level=logging.DEBUG)
-        tar_cmd = ["tar", "czf", abs_to, "."]
-        await utils.execute_subprocess(tar_cmd, cwd=app_dir)
+        with metrics.stage("extract", "_convert_dmg_to_tar_gz"):
+            undmg_cmd = [dmg_executable_location, "extract", abs_from, "tmp.hfs"]
+            await utils.execute_subprocess(undmg_cmd, cwd=temp_dir, log_level=logging.DEBUG)
+            hfsplus_cmd = [hfsplus_executable_location, "tmp.hfs", "extractall", "/", app_dir]
+            await utils.execute_subprocess(hfsplus_cmd, cwd=temp_dir, log_level=logging.DEBUG)
+        os.unlink(os.path.join(temp_dir, "tmp.hfs"))
+        await _create_tarfile(context, abs_to, [app_dir], "gz", tmp_dir=app_dir)
 
     return to
 
 
+# ArchiveSession {{{1
+class ArchiveSession:
+    """An archive that several signing formats work on in turn.
+
+    `task.sign` hands one of these to each format that signs the contents of
+    an archive (see `task.ARCHIVE_SIGNING_FUNCTIONS`). The first format to
+    need a member extracts it, and the formats after it work on the same
+    extracted copy, including any changes earlier formats made. The archive
+    is only re-packed when `close` is called, with `precomplete` regenerated
+    then if any format asked for it.
+
+    Tarballs have to be decompressed and recreated as a whole, so they're
+    extracted whole. Zips only have the members that formats ask for
+    extracted, and `close` only writes the changed ones back.
+
+    Args:
+        context (Context): the signing context
+
+    """
+
+    def __init__(self, context):
+        self.context = context
+        self.path = None
+
+    async def open(self, path):
+        """Start working on `path`.
+
+        If a different archive is open, it's re-packed first.
+
+        Args:
+            path (str): the archive
+
+        """
+        if path == self.path:
+            return
+        await self.close()
+        self.path = path
+        self._is_zip = path.endswith(".zip")
+        # This will get cleaned up when we nuke `work_dir`. Clean up at that
+        # point rather than immediately after `close`, to optimize task
+        # runtime speed over disk space.
+        self.tmp_dir = tempfile.mkdtemp(prefix="archive", dir=self.context.config["work_dir"])
+        self.regenerate_precomplete = False
+        # member name: local path, for the members extracted or added so far
+        self._files = {}
+        self._names = None
+        self._changed = []
+
+    async def names(self):
+        """Return the names of the archive's files, including any added since it was opened.
+
+        Listing a tarball means decompressing it, so this extracts it.
+
+        Returns:
+            list: the member names
+
+        """
+        if self._names is None:
+            if self._is_zip:
+                self._names = await _get_zipfile_files(self.path)
+            else:
+                await self.extract()
+        return list(self._names)
+
+    async def extract(self, names=None):
+        """Extract files from the archive, unless they've been extracted already.
+
+        Args:
+            names (list, optional): the members to extract. If None, extract
+                all of them.
+
+        Returns:
+            list: the local paths of the members, in the order of `names`
+
+        """
+        if not self._is_zip:
+            if self._names is None:
+                _, compression = os.path.splitext(self.path)
+                extracted = await _extract_tarfile(self.context, self.path, compression, tmp_dir=self.tmp_dir)
+                self._names = [os.path.relpath(path, self.tmp_dir) for path in extracted]
+                self._files = dict(zip(self._names, extracted))
+        else:
+            if names is None:
+                names = await self.names()
+            missing = [name for name in names if name not in self._files]
+            if missing:
+                await _extract_zipfile(self.context, self.path, files=missing, tmp_dir=self.tmp_dir, clean=False)
+                self._files.update({name: os.path.join(self.tmp_dir, name) for name in missing})
+        if names is None:
+            names = self._names
+        return [self._files[name] for name in names]
+
+    def is_extracted(self, name):
+        """Whether member `name` has been extracted, and may have changed since."""
+        return name in self._files
+
+    def changed(self, paths):
+        """Write `paths` back to the archive when it's re-packed.
+
+        Args:
+            paths (list): local paths under `tmp_dir`, for members that
+                changed or need adding
+
+        """
+        for path in paths:
+            name = os.path.relpath(path, self.tmp_dir)
+            if name not in self._files:
+                self._files[name] = path
+                if self._names is not None:
+                    self._names.append(name)
+            if path not in self._changed:
+                self._changed.append(path)
+
+    async def close(self):
+        """Re-pack the archive, if anything changed.
+
+        Zips are rewritten to a temporary file with the changed members
+        replaced, copying the others without recompressing them, and renamed
+        into place; see `update_zipfile`. Their `precomplete` is generated
+        from the member names, so only `precomplete` itself needs extracting
+        for it.
+
+        Returns:
+            str: the path to the archive, or None if none was open
+
+        """
+        path = self.path
+        if path is None:
+            return None
+        try:
+            if self._changed and self._is_zip:
+                await self._repack_zip()
+            elif self._changed:
+                await self._repack_tar()
+        finally:
+            self.path = None
+        return path
+
+    async def _repack_zip(self):
+        if self.regenerate_precomplete:
+            names = await self.names()
+            await self.extract([name for name in names if os.path.basename(name) == "precomplete"])
+            self._changed.append(_run_generate_precomplete(self.context, self.tmp_dir, names=names, archive_path=self.path))
+        await _update_zipfile(self.context, self.path, self._changed, tmp_dir=self.tmp_dir)
+
+    async def _repack_tar(self):
+        all_files = [self._files[name] for name in self._names]
+        remove_extra_files(self.tmp_dir, all_files)
+        if self.regenerate_precomplete:
+            _run_generate_precomplete(self.context, self.tmp_dir, archive_path=self.path)
+        _, compression = os.path.splitext(self.path)
+        await _create_tarfile(self.context, self.path, all_files, compression, tmp_dir=self.tmp_dir)
+
+
+@contextlib.asynccontextmanager
+async def _open_archive(context, path, archive=None):
+    """Open `path` in `archive`, or in a new ArchiveSession that's re-packed on the way out."""
+    if archive is not None:
+        await archive.open(path)
+        yield archive
+        return
+    archive = ArchiveSession(context)
+    await archive.open(path)
+    yield archive
+    await archive.close()
+
+
 # _get_zipfile_files {{{1
 @time_async_function
 async def _get_zipfile_files(from_):
@@ -671,41 +892,63 @@ async def _get_zipfile_files(from_):
 
 
 # _extract_zipfile {{{1
-@time_async_function
-async def _extract_zipfile(context, from_, files=None, tmp_dir=None):
+def _extract_zipfile_sync(from_, files, tmp_dir, clean=True):
+    extracted_files = []
+    if clean:
+        rm(tmp_dir)
+    utils.mkdir(tmp_dir)
+    with zipfile.ZipFile(from_, mode="r") as z:
+        if files is not None:
+            for name in files:
+                z.extract(name, path=tmp_dir)
+                extracted_files.append(os.path.join(tmp_dir, name))
+        else:
+            for name in z.namelist():
+                extracted_files.append(os.path.join(tmp_dir, name))
+            z.extractall(path=tmp_dir)
+    return extracted_files
+
+
+@time_async_function(stage="extract")
+async def _extract_zipfile(context, from_, files=None, tmp_dir=None, clean=True):
     work_dir = context.config["work_dir"]
     tmp_dir = tmp_dir or os.path.join(work_dir, "unzipped")
     log.debug("Extracting {} from {} to {}...".format(files or "all files", from_, tmp_dir))
     try:
-        extracted_files = []
-        rm(tmp_dir)
-        utils.mkdir(tmp_dir)
-        with zipfile.ZipFile(from_, mode="r") as z:
-            if files is not None:
-                for name in files:
-                    z.extract(name, path=tmp_dir)
-                    extracted_files.append(os.path.join(tmp_dir, name))
-            else:
-                for name in z.namelist():
-                    extracted_files.append(os.path.join(tmp_dir, name))
-                z.extractall(path=tmp_dir)
-        return extracted_files
+        return await utils.run_in_executor(context, _extract_zipfile_sync, from_, files, tmp_dir, clean)
     except Exception as e:
         raise SigningScriptError(e)
 
 
 # _create_zipfile {{{1
-@time_async_function
+def _create_zipfile_sync(to, files, tmp_dir, mode):
+    with zipfile.ZipFile(to, mode=mode, compression=zipfile.ZIP_DEFLATED) as z:
+        for f in files:
+            relpath = os.path.relpath(f, tmp_dir)
+            z.write(f, arcname=relpath)
+    return to
+
+
+@time_async_function(stage="compress")
 async def _create_zipfile(context, to, files, tmp_dir=None, mode="w"):
     work_dir = context.config["work_dir"]
     tmp_dir = tmp_dir or os.path.join(work_dir, "unzipped")
     try:
         log.info("Creating zipfile {}...".format(to))
-        with zipfile.ZipFile(to, mode=mode, compression=zipfile.ZIP_DEFLATED) as z:
-            for f in files:
-                relpath = os.path.relpath(f, tmp_dir)
-                z.write(f, arcname=relpath)
-        return to
+        return await utils.run_in_executor(context, _create_zipfile_sync, to, files, tmp_dir, mode)
+    except Exception as e:
+        raise SigningScriptError(e)
+
+
+# _update_zipfile {{{1
+@time_async_function(stage="compress")
+async def _update_zipfile(context, to, files, tmp_dir=None):
+    """Replace or add `files` in the zipfile `to`, without recompressing its other members."""
+    work_dir = context.config["work_dir"]
+    tmp_dir = tmp_dir or os.path.join(work_dir, "unzipped")
+    try:
+        log.info("Updating zipfile {}...".format(to))
+        return await utils.run_in_executor(context, update_zipfile, to, {os.path.relpath(f, tmp_dir): f for f in files})
     except Exception as e:
         raise SigningScriptError(e)
 
@@ -719,31 +962,27 @@ def _get_tarfile_compression(compression):
     return compression
 
 
-# _get_tarfile_files {{{1
-@time_async_function
-async def _get_tarfile_files(from_, compression):
-    compression = _get_tarfile_compression(compression)
-    with tarfile.open(from_, mode="r:{}".format(compression)) as t:
-        files = t.getmembers()
-        return [f.name for f in files if f.isfile()]
+# _extract_tarfile {{{1
+def _extract_tarfile_sync(from_, compression, tmp_dir):
+    files = []
+    rm(tmp_dir)
+    utils.mkdir(tmp_dir)
+    # Read the tarball as a stream, so it's only decompressed once
+    with open_decompressed(from_, compression) as fh, tarfile.open(mode="r|", fileobj=fh) as t:
+        safe_extract(t, path=tmp_dir)
+        for name in t.getnames():
+            path = os.path.join(tmp_dir, name)
+            os.path.isfile(path) and files.append(path)
+    return files
 
 
-# _extract_tarfile {{{1
-@time_async_function
+@time_async_function(stage="extract")
 async def _extract_tarfile(context, from_, compression, tmp_dir=None):
     work_dir = context.config["work_dir"]
     tmp_dir = tmp_dir or os.path.join(work_dir, "untarred")
     compression = _get_tarfile_compression(compression)
     try:
-        files = []
-        rm(tmp_dir)
-        utils.mkdir(tmp_dir)
-        with tarfile.open(from_, mode="r:{}".format(compression)) as t:
-            safe_extract(t, path=tmp_dir)
-            for name in t.getnames():
-                path = os.path.join(tmp_dir, name)
-                os.path.isfile(path) and files.append(path)
-        return files
+        return await utils.run_in_executor(context, _extract_tarfile_sync, from_, compression, tmp_dir)
     except Exception as e:
         raise SigningScriptError(e)
 
@@ -771,112 +1010,325 @@ def _create_xz_tarfile(to, files, rel_dir):
 
 
 # _create_tarfile {{{1
-@time_async_function
+def _create_tarfile_sync(to, files, compression, tmp_dir):
+    if compression == "xz":
+        return _create_xz_tarfile(to, files, tmp_dir)
+
+    with tarfile.open(to, mode="w:{}".format(compression)) as t:
+        for f in files:
+            relpath = os.path.relpath(f, tmp_dir)
+            t.add(f, arcname=relpath, filter=_owner_filter)
+    return to
+
+
+@time_async_function(stage="compress")
 async def _create_tarfile(context, to, files, compression, tmp_dir=None):
     work_dir = context.config["work_dir"]
     tmp_dir = tmp_dir or os.path.join(work_dir, "untarred")
     compression = _get_tarfile_compression(compression)
+    workers = context.config.get("compression_workers", DEFAULT_COMPRESSION_WORKERS)
+    # The tarball is written from scratch; if `to` is hard linked to the
+    # artifact it was staged from, unlink it rather than truncate the artifact
+    if os.path.exists(to) and os.stat(to).st_nlink > 1:
+        os.unlink(to)
     try:
         log.info("Creating tarfile {}...".format(to))
-        if compression == "xz":
-            return _create_xz_tarfile(to, files, tmp_dir)
-
-        with tarfile.open(to, mode="w:{}".format(compression)) as t:
-            for f in files:
-                relpath = os.path.relpath(f, tmp_dir)
-                t.add(f, arcname=relpath, filter=_owner_filter)
-        return to
+        if workers > 1:
+            block_size = context.config.get("compression_block_size")
+            # create_parallel_tarfile hands the compression out to its own
+            # process pool, so it runs in a thread: `context.executor` may be
+            # a process pool too, and an executor can't be pickled into one
+            return await asyncio.to_thread(
+                create_parallel_tarfile,
+                to,
+                files,
+                tmp_dir,
+                compression,
+                workers=workers,
+                block_size=block_size,
+                filter=_owner_filter,
+                executor=getattr(context, "compression_executor", None),
+            )
+        return await utils.run_in_executor(context, _create_tarfile_sync, to, files, compression, tmp_dir)
     except Exception as e:
         raise SigningScriptError(e)
 
 
-def _encode_single_file(fp, signing_req):
-    """Write signing_req for a single file to fp.
+def _iter_base64_blocks(fp, block_size):
+    """Yield base64 encoded `block_size` chunks of `fp`.
 
-    Does proper base64 and json encoding.
-    Tries not to hold onto a lot of memory.
+    `block_size` must be a multiple of 3, so that the encoded chunks can be
+    concatenated without padding in between them.
     """
-    fp.write(b"[{")
-    for k, v in signing_req.items():
-        fp.write(json.dumps(k).encode("utf8"))
-        fp.write(b":")
-        if hasattr(v, "read"):
-            # Make sure we're always reading from the beginning of the file
-            # Sometimes we have to retry the request
-            v.seek(0)
-            fp.write(b'"')
-            while True:
-                block = v.read(1020)
-                if not block:
-                    break
-                e = b64encode(block).encode("utf8")
-                fp.write(e)
-            fp.write(b'"')
-        else:
-            fp.write(json.dumps(v).encode("utf8"))
-        fp.write(b",")
-    fp.seek(-1, 1)
-    fp.write(b"}]")
+    # Make sure we're always reading from the beginning of the file
+    # Sometimes we have to retry the request
+    fp.seek(0)
+    while True:
+        block = fp.read(block_size)
+        if not block:
+            break
+        yield base64.b64encode(block)
 
 
-def write_signing_req_to_disk(fp, signing_req):
-    """Write signing_req to fp.
+def _encode_single_file(signing_req, block_size=DEFAULT_ENCODE_BLOCK_SIZE):
+    """Yield the encoded signing_req for a single file.
 
     Does proper base64 and json encoding.
     Tries not to hold onto a lot of memory.
     """
-    if "files" in signing_req:
-        _encode_multiple_files(fp, signing_req)
-    else:
-        _encode_single_file(fp, signing_req)
+    yield b"{"
+    for i, (k, v) in enumerate(signing_req.items()):
+        if i > 0:
+            yield b","
+        yield json.dumps(k).encode("utf8")
+        yield b":"
+        if hasattr(v, "read"):
+            yield b'"'
+            yield from _iter_base64_blocks(v, block_size)
+            yield b'"'
+        else:
+            yield json.dumps(v).encode("utf8")
+    yield b"}"
 
 
-def _encode_multiple_files(fp, signing_req):
-    """Write signing_req to fp.
+def _encode_multiple_files(signing_req, block_size=DEFAULT_ENCODE_BLOCK_SIZE):
+    """Yield the encoded signing_req for multiple files.
 
     Does proper base64 and json encoding.
     Tries not to hold onto a lot of memory.
     """
     _signing_req = signing_req.copy()
     input_files = _signing_req.pop("files")
-    fp.write(b"[{")
+    yield b"{"
     for k, v in _signing_req.items():
-        fp.write(json.dumps(k).encode("utf8"))
-        fp.write(b":")
-        fp.write(json.dumps(v).encode("utf8"))
-        fp.write(b",")
-    fp.write(b'"files":[')
+        yield json.dumps(k).encode("utf8")
+        yield b":"
+        yield json.dumps(v).encode("utf8")
+        yield b","
+    yield b'"files":['
     for i, input_file in enumerate(input_files):
         if i > 0:
-            fp.write(b",")
-        fp.write(b'{"name":')
-        fp.write(json.dumps(os.path.basename(input_file["name"])).encode("utf8"))
-        fp.write(b',"content":"')
-        input_file["content"].seek(0)
-        while True:
-            block = input_file["content"].read(1020)
-            if not block:
-                break
-            fp.write(base64.b64encode(block))
-        fp.write(b'"}')
-    fp.write(b"]}]")
+            yield b","
+        yield b'{"name":'
+        yield json.dumps(os.path.basename(input_file["name"])).encode("utf8")
+        yield b',"content":"'
+        yield from _iter_base64_blocks(input_file["content"], block_size)
+        yield b'"}'
+    yield b"]}"
+
+
+def iter_signing_req(signing_req, block_size=DEFAULT_ENCODE_BLOCK_SIZE):
+    """Yield the json encoded request body for signing_req in chunks.
+
+    Args:
+        signing_req (dict or list): the signing request, as returned by
+            `make_signing_req`, or a list of them to send in a single call
+        block_size (int): how many bytes of input to encode per chunk. Must be
+            a multiple of 3.
+
+    Raises:
+        SigningScriptError: if `block_size` isn't a multiple of 3
+
+    """
+    if block_size <= 0 or block_size % 3:
+        raise SigningScriptError(f"Encoding block size must be a positive multiple of 3, not {block_size}")
+    signing_reqs = signing_req if isinstance(signing_req, list) else [signing_req]
+    yield b"["
+    for i, req in enumerate(signing_reqs):
+        if i > 0:
+            yield b","
+        if "files" in req:
+            yield from _encode_multiple_files(req, block_size)
+        else:
+            yield from _encode_single_file(req, block_size)
+    yield b"]"
+
+
+def write_signing_req_to_disk(fp, signing_req, block_size=DEFAULT_ENCODE_BLOCK_SIZE):
+    """Write signing_req to fp.
+
+    Does proper base64 and json encoding.
+    Tries not to hold onto a lot of memory.
+    """
+    for chunk in iter_signing_req(signing_req, block_size):
+        fp.write(chunk)
 
 
 def get_hawk_content_hash(request_body, content_type):
-    """Generate the content hash of the given request."""
+    """Generate the content hash of the given request.
+
+    Args:
+        request_body: a file object, or an iterable of bytes chunks
+        content_type (str): the content type of the request
+
+    """
+    if hasattr(request_body, "read"):
+        chunks = iter(lambda: request_body.read(1024), b"")
+    else:
+        chunks = request_body
     h = hashlib.new("sha256")
     h.update(b"hawk.1.payload\n")
     h.update(content_type.encode("utf8"))
     h.update(b"\n")
-    while True:
-        block = request_body.read(1024)
-        if not block:
-            break
+    for block in chunks:
         h.update(block)
     h.update(b"\n")
     return b64encode(h.digest())
 
 
+class SigningRequestBody:
+    """A streamed autograph request body.
+
+    The body is never written out. `prepare` encodes it once to get its HAWK
+    payload hash and its length, and iterating over it encodes it again as it
+    is being sent.
+
+    Args:
+        signing_req (dict): the signing request, as returned by `make_signing_req`
+        content_type (str): the content type of the request
+        block_size (int): how many bytes of input to encode per chunk
+
+    """
+
+    def __init__(self, signing_req, content_type, block_size=DEFAULT_ENCODE_BLOCK_SIZE):
+        self.signing_req = signing_req
+        self.content_type = content_type
+        self.block_size = block_size
+        self.content_hash = None
+        self.size = None
+
+    def prepare(self):
+        """Compute the HAWK payload hash and length of the body, in a single pass."""
+        self.size = 0
+
+        def counted():
+            for chunk in iter_signing_req(self.signing_req, self.block_size):
+                self.size += len(chunk)
+                yield chunk
+
+        self.content_hash = get_hawk_content_hash(counted(), self.content_type)
+        return self.content_hash
+
+    async def __aiter__(self):
+        for chunk in iter_signing_req(self.signing_req, self.block_size):
+            yield chunk
+
+
+class AutographResponseDecoder:
+    """Incrementally decode an autograph json response.
+
+    The signed file(s) in `signed_file` and `signed_files[*].content` are
+    base64 decoded straight to files in `decode_dir` as the response is fed
+    in, and are replaced by the paths of those files in the decoded response.
+    Everything else is small, and is parsed as json once the response is
+    complete.
+
+    Args:
+        decode_dir (str): the directory to write the signed files to
+
+    """
+
+    STREAMED_KEYS = ("signed_file", "content")
+
+    def __init__(self, decode_dir):
+        self.decode_dir = decode_dir
+        self.paths = []
+        self._skeleton = bytearray()
+        self._in_string = False
+        self._escape = False
+        self._string_start = None
+        self._last_string = None
+        self._key = None
+        self._expect_value = False
+        self._out = None
+        self._remainder = b""
+
+    def feed(self, data):
+        """Feed the next chunk of the response to the decoder."""
+        pos = 0
+        while pos < len(data):
+            if self._out is not None:
+                end = data.find(b'"', pos)
+                self._write_base64(data[pos:] if end == -1 else data[pos:end])
+                if end == -1:
+                    return
+                self._close_file()
+                pos = end + 1
+                continue
+            c = data[pos : pos + 1]
+            pos += 1
+            if self._in_string:
+                self._skeleton += c
+                if self._escape:
+                    self._escape = False
+                elif c == b"\\":
+                    self._escape = True
+                elif c == b'"':
+                    self._in_string = False
+                    self._last_string = json.loads(self._skeleton[self._string_start :])
+                continue
+            if c == b'"':
+                if self._expect_value and self._key in self.STREAMED_KEYS:
+                    self._open_file()
+                else:
+                    self._in_string = True
+                    self._string_start = len(self._skeleton)
+                    self._skeleton += c
+                self._expect_value = False
+                continue
+            if c == b":":
+                self._key = self._last_string
+                self._expect_value = True
+            elif not c.isspace():
+                self._expect_value = False
+            self._skeleton += c
+
+    def result(self):
+        """Return the decoded response.
+
+        Raises:
+            SigningScriptError: if the response is incomplete or isn't valid json
+
+        """
+        if self._out is not None:
+            raise SigningScriptError("Incomplete autograph response")
+        try:
+            return json.loads(self._skeleton)
+        except ValueError as e:
+            raise SigningScriptError(f"Invalid autograph response: {e}")
+
+    def cleanup(self):
+        """Remove any files written by the decoder."""
+        if self._out is not None:
+            self._out.close()
+            self._out = None
+        for path in self.paths:
+            rm(path)
+        self.paths = []
+
+    def _open_file(self):
+        fd, path = tempfile.mkstemp(prefix="autograph", dir=self.decode_dir)
+        self._out = os.fdopen(fd, "wb")
+        self.paths.append(path)
+        self._skeleton += json.dumps(path).encode("utf8")
+
+    def _write_base64(self, chunk):
+        # Autograph may escape `/` as `\/`; no other escapes are valid base64
+        data = self._remainder + chunk.replace(b"\\", b"")
+        cut = len(data) - len(data) % 4
+        self._remainder = data[cut:]
+        try:
+            self._out.write(base64.b64decode(data[:cut]))
+        except binascii.Error as e:
+            raise SigningScriptError(f"Invalid base64 in autograph response: {e}")
+
+    def _close_file(self):
+        if self._remainder:
+            raise SigningScriptError("Invalid base64 in autograph response: truncated data")
+        self._out.close()
+        self._out = None
+
+
 def get_hawk_header(url, user, password, content_type, content_hash):
     """Create a HAWK Authentication header."""
     r = mohawk.base.Resource(credentials={"id": user, "key": password, "algorithm": "sha256"}, url=url, method="POST", content_type=content_type)
@@ -888,33 +1340,43 @@ def get_hawk_header(url, user, password, content_type, content_hash):
 
 
 @time_async_function
-async def call_autograph(session, url, user, password, sign_req):
-    """Call autograph and return the json response."""
-    content_type = "application/json"
+async def call_autograph(session, url, user, password, sign_req, block_size=DEFAULT_ENCODE_BLOCK_SIZE, decode_dir=None):
+    """Call autograph and return the json response.
 
-    request_body = tempfile.TemporaryFile("w+b")
-    write_signing_req_to_disk(request_body, sign_req)
-    request_body.seek(0)
+    If `decode_dir` is set, any signed files in the response are decoded to
+    files in `decode_dir` as they're received, and their paths are returned in
+    place of their contents. See `AutographResponseDecoder`.
+    """
+    content_type = "application/json"
 
-    content_hash = get_hawk_content_hash(request_body, content_type)
+    request_body = SigningRequestBody(sign_req, content_type, block_size)
+    content_hash = request_body.prepare()
 
     auth_header = get_hawk_header(url, user, password, content_type, content_hash)
 
-    request_body.seek(0, 2)
-    req_size = request_body.tell()
+    req_size = request_body.size
     log.debug("req_size: %s", req_size)
-    request_body.seek(0)
 
-    resp = await session.post(url, data=request_body, headers={"Authorization": auth_header, "Content-Type": content_type, "Content-Length": str(req_size)})
-    if resp.ok:
-        log.debug("Autograph response: %s", resp.status)
-    else:
-        log.error("Autograph response: %s, %s", resp.status, await resp.text())
-    resp.raise_for_status()
-    # TODO: Write this out to temporary file. The responses can be large,
-    # especially in the case of APK/omnija signing where the entire file is
-    # being sent and returned.
-    return await resp.json()
+    with metrics.stage("autograph", "call_autograph") as stage:
+        stage.bytes_up = req_size
+        resp = await session.post(url, data=request_body, headers={"Authorization": auth_header, "Content-Type": content_type, "Content-Length": str(req_size)})
+        if resp.ok:
+            log.debug("Autograph response: %s", resp.status)
+        else:
+            log.error("Autograph response: %s, %s", resp.status, await resp.text())
+        resp.raise_for_status()
+        if decode_dir is None:
+            stage.bytes_down = resp.content_length or 0
+            return await resp.json()
+        decoder = AutographResponseDecoder(decode_dir)
+        try:
+            async for chunk in resp.content.iter_chunked(block_size):
+                stage.bytes_down += len(chunk)
+                decoder.feed(chunk)
+            return decoder.result()
+        except BaseException:
+            decoder.cleanup()
+            raise
 
 
 def b64encode(input_bytes):
@@ -950,17 +1412,18 @@ def make_signing_req(input_, fmt, autograph_method, *, keyid=None, extension_id=
     if keyid:
         sign_req["keyid"] = keyid
 
+    signing_format = task.FORMAT_REGISTRY.get(fmt)
     # TODO: Is this the right place to do this?
-    if utils.is_apk_autograph_signing_format(fmt):
+    if signing_format.needs_zip_passthrough:
         # We don't want APKs to have their compression changed
         sign_req["options"] = {"zip": "passthrough"}
 
-        if utils.is_sha1_apk_autograph_signing_format(fmt):
+        if signing_format.is_sha1_apk:
             # We ask for a SHA1 digest from Autograph
             # https://github.com/mozilla-services/autograph/pull/166/files
             sign_req["options"]["pkcs7_digest"] = "SHA1"
 
-    if _is_xpi_format(fmt):
+    if signing_format.is_xpi:
         sign_req.setdefault("options", {})
         # https://bugzilla.mozilla.org/show_bug.cgi?id=1533818#c9
         sign_req["options"]["id"] = extension_id
@@ -987,7 +1450,9 @@ def _xpi_signing_options(fmt):
 
 
 @time_async_function
-async def sign_with_autograph(session, server, input_, fmt, autograph_method, keyid=None, extension_id=None):
+async def sign_with_autograph(
+    session, server, input_, fmt, autograph_method, keyid=None, extension_id=None, block_size=DEFAULT_ENCODE_BLOCK_SIZE, decode_dir=None
+):
     """Signs data with autograph and returns the result.
 
     Args:
@@ -999,6 +1464,10 @@ async def sign_with_autograph(session, server, input_, fmt, autograph_method, ke
                                 one of 'file', 'hash', 'data', or 'files'
         keyid (str): which key to use on autograph (optional)
         extension_id (str): which id to send to autograph for the extension (optional)
+        block_size (int): how many bytes of input to encode at a time (optional)
+        decode_dir (str): if set, signed files are decoded to this directory,
+                          and their paths are returned instead of their
+                          contents (optional)
 
     Raises:
         aiohttp.ClientError: on failure
@@ -1018,7 +1487,11 @@ async def sign_with_autograph(session, server, input_, fmt, autograph_method, ke
 
     log.debug(f"sign_with_autograph: url: {url}, keyid: {keyid}, client_id: {server.client_id}")
     sign_resp = await retry_async(
-        call_autograph, args=(session, url, server.client_id, server.access_key, sign_req), attempts=3, sleeptime_kwargs={"delay_factor": 2.0}
+        call_autograph,
+        args=(session, url, server.client_id, server.access_key, sign_req),
+        kwargs={"block_size": block_size, "decode_dir": decode_dir},
+        attempts=3,
+        sleeptime_kwargs={"delay_factor": 2.0},
     )
 
     if autograph_method == "file":
@@ -1054,10 +1527,20 @@ async def sign_file_with_autograph(context, from_, fmt, to=None, extension_id=No
     a = get_autograph_config(context.autograph_configs, cert_type, [fmt], raise_on_empty=True)
     log.debug(f"got autograph config: url: {a.url}, id: {a.client_id}, formats: {a.formats}, key_id: {a.key_id}")
     to = to or from_
-    input_file = open(from_, "rb")
-    signed_bytes = base64.b64decode(await sign_with_autograph(context.session, a, input_file, fmt, "file", extension_id=extension_id))
-    with open(to, "wb") as fout:
-        fout.write(signed_bytes)
+    with open(from_, "rb") as input_file:
+        signed_path = await sign_with_autograph(
+            context.session,
+            a,
+            input_file,
+            fmt,
+            "file",
+            extension_id=extension_id,
+            block_size=get_encode_block_size(context),
+            decode_dir=os.path.dirname(os.path.abspath(to)),
+        )
+    # The response is decoded to a new 0600 file; keep the original's mode
+    shutil.copymode(from_, signed_path)
+    os.replace(signed_path, to)
     return to
 
 
@@ -1070,6 +1553,13 @@ async def verify_gpg(context, from_, signature):
 async def sign_gpg_with_autograph(context, from_, fmt, **kwargs):
     """Signs file with autograph and writes the results to a file.
 
+    OpenPGP signatures cover a trailer that autograph builds, so unlike
+    `sign_file_detached` this can't sign a local digest; the whole file is
+    streamed to autograph's `data` method.
+
+    If `context.signing_cache` is set, detached signatures are cached by the
+    file's sha256, format, keyid and cert type.
+
     Args:
         context (Context): the signing context
         from_ (str): the source file to sign
@@ -1086,8 +1576,20 @@ async def sign_gpg_with_autograph(context, from_, fmt, **kwargs):
     cert_type = task.task_cert_type(context)
     a = get_autograph_config(context.autograph_configs, cert_type, [fmt], raise_on_empty=True)
     to = f"{from_}.asc"
-    input_file = open(from_, "rb")
-    signature = await sign_with_autograph(context.session, a, input_file, fmt, "data")
+    cache = getattr(context, "signing_cache", None)
+    signature = None
+    if cache is not None:
+        with metrics.stage("hash", "get_hash"):
+            digest = await utils.run_in_executor(context, utils.get_hash, from_, "sha256")
+        cache_key = cache.key(digest, fmt, a.key_id, cert_type)
+        cached = await asyncio.to_thread(cache.get, cache_key)
+        if cached is not None:
+            signature = cached.decode("utf-8")
+    if signature is None:
+        with open(from_, "rb") as input_file:
+            signature = await sign_with_autograph(context.session, a, input_file, fmt, "data", block_size=get_encode_block_size(context))
+        if cache is not None:
+            await asyncio.to_thread(cache.put, cache_key, signature.encode("utf-8"))
     with open(to, "w") as fout:
         fout.write(signature)
     await verify_gpg(context, from_, to)
@@ -1098,6 +1600,12 @@ async def sign_gpg_with_autograph(context, from_, fmt, **kwargs):
 async def sign_hash_with_autograph(context, hash_, fmt, keyid=None):
     """Signs hash with autograph and returns the result.
 
+    If `context.hash_batcher` is set, the hash is batched up with other
+    concurrent requests for the same server, format and keyid.
+
+    If `context.signing_cache` is set, signatures are cached by the hash,
+    format, keyid and cert type.
+
     Args:
         context (Context): the signing context
         hash_ (bytes): the input hash to sign
@@ -1114,18 +1622,64 @@ async def sign_hash_with_autograph(context, hash_, fmt, keyid=None):
     """
     cert_type = task.task_cert_type(context)
     a = get_autograph_config(context.autograph_configs, cert_type, [fmt], raise_on_empty=True)
-    input_file = BytesIO(hash_)
-    signature = base64.b64decode(await sign_with_autograph(context.session, a, input_file, fmt, "hash", keyid))
+    cache = getattr(context, "signing_cache", None)
+    if cache is not None:
+        cache_key = cache.key(hashlib.sha256(hash_).hexdigest(), fmt, keyid or a.key_id, cert_type)
+        signature = await asyncio.to_thread(cache.get, cache_key)
+        if signature is not None:
+            return signature
+    batcher = getattr(context, "hash_batcher", None)
+    if batcher is not None:
+        key = (a.url, a.client_id, a.access_key, fmt, keyid or a.key_id)
+        signature = base64.b64decode(await batcher.submit(key, hash_))
+    else:
+        input_file = BytesIO(hash_)
+        signature = base64.b64decode(await sign_with_autograph(context.session, a, input_file, fmt, "hash", keyid))
+    if cache is not None:
+        await asyncio.to_thread(cache.put, cache_key, signature)
     return signature
 
 
+async def sign_hash_batch_with_autograph(session, key, hashes):
+    """Sign a batch of hashes with a single autograph call.
+
+    This is the `send` function of the `RequestBatcher` used by
+    `sign_hash_with_autograph`.
+
+    Args:
+        session (aiohttp.ClientSession): client session object
+        key (tuple): the (url, client_id, access_key, fmt, keyid) to sign with
+        hashes (list): the hashes to sign
+
+    Raises:
+        aiohttp.ClientError: on failure
+        SigningScriptError: if autograph doesn't return one signature per hash
+
+    Returns:
+        list: the base64 encoded signatures, in the same order as `hashes`
+
+    """
+    server_url, client_id, access_key, fmt, keyid = key
+    sign_reqs = [make_signing_req(BytesIO(hash_), fmt, "hash", keyid=keyid) for hash_ in hashes]
+    url = f"{server_url}/sign/hash"
+    log.debug(f"sign_hash_batch_with_autograph: url: {url}, keyid: {keyid}, client_id: {client_id}, batch size: {len(hashes)}")
+    sign_resp = await retry_async(call_autograph, args=(session, url, client_id, access_key, sign_reqs), attempts=3, sleeptime_kwargs={"delay_factor": 2.0})
+    if len(sign_resp) != len(hashes):
+        raise SigningScriptError(f"Autograph returned {len(sign_resp)} signatures for {len(hashes)} hashes")
+    return [r["signature"] for r in sign_resp]
+
+
 @time_async_function
 async def sign_file_detached(context, file_, fmt, keyid=None, **kwargs):
     """Signs the sha256 hash of a file and returns it along with a detached signature.
 
+    The file is hashed locally, in an executor, and only the digest is sent
+    to autograph, so the size of the request doesn't depend on the size of
+    the file.
+
     Args:
         context (Context): the signing context
-        hash_ (bytes): the input hash to sign
+        file_ (str): the file to sign
         fmt (str): the format to sign with
         keyid (str): which key to use on autograph (optional)
 
@@ -1136,10 +1690,10 @@ async def sign_file_detached(context, file_, fmt, keyid=None, **kwargs):
     Returns:
         list: path to the original file and its detached signature named `file.sig`.
     """
-    with open(file_, "rb") as fh:
-        h = hashlib.file_digest(fh, "sha256")
+    with metrics.stage("hash", "get_hash"):
+        digest = bytes.fromhex(await utils.run_in_executor(context, utils.get_hash, file_, "sha256"))
 
-    signature = await sign_hash_with_autograph(context, h.digest(), fmt, keyid=keyid)
+    signature = await sign_hash_with_autograph(context, digest, fmt, keyid=keyid)
     detached_signature = f"{file_}.sig"
     with open(detached_signature, "wb") as fh:
         fh.write(signature)
@@ -1179,13 +1733,15 @@ def get_mar_verification_key(cert_type, fmt, keyid):
         raise SigningScriptError(f"Can't find mar verify key for {fmt}, {cert_type} ({keyid}):\n{err}")
 
 
-def verify_mar_signature(cert_type, fmt, mar, keyid=None):
-    """Verify a mar signature, via mardor.
+def verify_mar_signature(cert_type, fmt, signature, digest, hash_algo, keyid=None):
+    """Verify a mar signature against the hash it was made from, via mardor.
 
     Args:
         cert_type (str): the cert scope string
         fmt (str): the signing format
-        mar (str): the path to the mar file
+        signature (bytes): the signature
+        digest (bytes): the hash of the signed mar, from `write_unsigned_mar`
+        hash_algo (str): the hash algorithm, e.g. `sha384`
         keyid (str, optional): the key id to use (can be None)
 
     Raises:
@@ -1193,21 +1749,15 @@ def verify_mar_signature(cert_type, fmt, mar, keyid=None):
 
     """
     mar_verify_key = get_mar_verification_key(cert_type, fmt, keyid)
-    try:
-        mar_path = os.path.join(os.path.dirname(sys.executable), "mar")
-        cmd = [mar_path, "-k", mar_verify_key, "-v", mar]
-        log.info("Running %s", cmd)
-        subprocess.check_call(cmd, stdout=sys.stdout, stderr=sys.stderr)
-        log.info("Verified signature.")
-    except subprocess.CalledProcessError as e:
-        raise SigningScriptError(e)
+    verify_mar_hash_signature(mar_verify_key, signature, digest, hash_algo)
+    log.info("Verified signature.")
 
 
-def validate_mar_channel(context, mar):
+def validate_mar_channel(context, productinfo):
     """Verify the mar channel matches an authorized pattern"""
     cert_type = task.task_cert_type(context)
     try:
-        channel_id = mar.productinfo[1]
+        channel_id = productinfo[1]
     except TypeError:
         raise SigningScriptError("Can't find mar channel id")
     allowed_channels = context.mar_channels.get(cert_type, [])
@@ -1243,38 +1793,33 @@ async def sign_mar384_with_autograph_hash(context, from_, fmt, to=None, **kwargs
 
     hash_algo, expected_signature_length = "sha384", 512
 
-    # Add a dummy signature into a temporary file (TODO: dedup with mardor.cli do_hash)
-    with tempfile.TemporaryFile() as tmp:
-        with open(from_, "rb") as f:
-            add_signature_block(f, tmp, hash_algo)
-
-        tmp.seek(0)
-
-        with MarReader(tmp) as m:
-            validate_mar_channel(context, m)
-
-            hashes = m.calculate_hashes()
-        h = hashes[0][1]
-
-    signature = await sign_hash_with_autograph(context, h, fmt, keyid)
-
-    # Add a signature to the MAR file (TODO: dedup with mardor.cli do_add_signature)
-    if len(signature) != expected_signature_length:
-        raise SigningScriptError(
-            "signed mar hash signature has invalid length for hash algo {}. Got {} expected {}.".format(hash_algo, len(signature), expected_signature_length)
-        )
+    to = to or from_
+    # Write to a temporary file alongside `to`, in case `to` is `from_`.
+    # Replacing `to` with it also leaves any artifact `to` was hard linked to
+    # alone.
+    fd, tmp_path = tempfile.mkstemp(prefix="mar", dir=os.path.dirname(os.path.abspath(to)))
+    os.close(fd)
+    try:
+        with metrics.stage("hash", "write_unsigned_mar"):
+            productinfo, h = await utils.run_in_executor(context, write_unsigned_mar, from_, tmp_path, hash_algo)
+        validate_mar_channel(context, productinfo)
 
-    # use the tmp file in case param `to` is `from_` which causes stream errors
-    tmp_dst = tempfile.NamedTemporaryFile(mode="w+b", delete=False)
-    with open(tmp_dst.name, "w+b") as dst:
-        with open(from_, "rb") as src:
-            add_signature_block(src, dst, hash_algo, signature)
+        signature = await sign_hash_with_autograph(context, h, fmt, keyid)
 
-    to = to or from_
-    shutil.copyfile(tmp_dst.name, to)
-    os.unlink(tmp_dst.name)
+        if len(signature) != expected_signature_length:
+            raise SigningScriptError(
+                "signed mar hash signature has invalid length for hash algo {}. Got {} expected {}.".format(
+                    hash_algo, len(signature), expected_signature_length
+                )
+            )
+        verify_mar_signature(cert_type, fmt, signature, h, hash_algo, keyid)
 
-    verify_mar_signature(cert_type, fmt, to, keyid)
+        await utils.run_in_executor(context, write_mar_signature, tmp_path, signature)
+        shutil.copymode(from_, tmp_path)
+        os.replace(tmp_path, to)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
 
     log.info("wrote mar with autograph signed hash %s to %s", from_, to)
     return to
@@ -1308,7 +1853,7 @@ async def sign_widevine_with_autograph(context, from_, blessed, fmt, to=None):
     to = to or f"{from_}.sig"
     flags = 1 if blessed else 0
 
-    h = widevine.generate_widevine_hash(from_, flags)
+    h = await utils.run_in_executor(context, widevine.generate_widevine_hash, from_, flags)
 
     signature = await sign_hash_with_autograph(context, h, fmt)
 
@@ -1339,62 +1884,159 @@ async def sign_omnija_with_autograph(context, from_, fmt):
         str: the path to the signature file
 
     """
-    signed_out = tempfile.mkstemp(prefix="oj_signed", suffix=".ja", dir=context.config["work_dir"])[1]
-    merged_out = tempfile.mkstemp(prefix="oj_merged", suffix=".ja", dir=context.config["work_dir"])[1]
-
-    await sign_file_with_autograph(context, from_, fmt, to=signed_out, extension_id="omni.ja@mozilla.org")
-    await merge_omnija_files(orig=from_, signed=signed_out, to=merged_out)
-    with open(from_, "wb") as fout:
-        with open(merged_out, "rb") as fin:
-            fout.write(fin.read())
+    fd, signed_out = tempfile.mkstemp(prefix="oj_signed", suffix=".ja", dir=context.config["work_dir"])
+    os.close(fd)
+    # Write the merged copy next to from_, so it can be renamed into place
+    fd, merged_out = tempfile.mkstemp(prefix=".oj_merged", suffix=".ja", dir=os.path.dirname(os.path.abspath(from_)))
+    os.close(fd)
+    try:
+        await sign_file_with_autograph(context, from_, fmt, to=signed_out, extension_id="omni.ja@mozilla.org")
+        await merge_omnija_files(orig=from_, signed=signed_out, to=merged_out, context=context)
+        shutil.copymode(from_, merged_out)
+        os.replace(merged_out, from_)
+    finally:
+        for path in (signed_out, merged_out):
+            if os.path.exists(path):
+                os.unlink(path)
     return from_
 
 
-@time_async_function
-async def merge_omnija_files(orig, signed, to):
+@time_async_function(stage="copy")
+async def merge_omnija_files(orig, signed, to, context=None):
     """Merge multiple omnijar files together.
 
-    This takes the original file, and reads it in, including performance
-    characteristics (e.g. jarlog ordering for preloading),
-    then adds data from the "signed" copy (the META-INF folder)
-    and finally writes it all out to a new omni.ja file.
+    The original file's entries, local headers and compressed data are
+    copied byte for byte, in their original order, so performance
+    characteristics (e.g. jarlog ordering for preloading) are kept. The
+    META-INF entries of the "signed" copy are appended, copied without
+    recompressing them, and replace any META-INF entries in the original.
 
     Args:
-        context (Context): the signing context
         orig (str): the source file to sign
         signed (str): the signed file, without optimizations
         to (str): the output path for the merge
+        context (Context, optional): the signing context, to pick the
+            executor the merge runs in
 
     Returns:
         bool: always True if function succeeded.
 
     """
-    orig_jarreader = mozjar.JarReader(orig)
-    with mozjar.JarWriter(to, compress=orig_jarreader.compression) as to_writer:
-        for origjarfile in orig_jarreader:
-            to_writer.add(origjarfile.filename, origjarfile, compress=origjarfile.compress)
+    return await utils.run_in_executor(context, _merge_omnija_files_sync, orig, signed, to)
+
+
+def _read_omnija_entries(orig, fh):
+    """Get the entries to copy from the original omni.ja.
+
+    The jar is mapped rather than read, so only its central directory and
+    local headers are paged in.
+
+    Args:
+        orig (str): the path to the original omni.ja
+        fh (file): the original omni.ja, opened for reading
+
+    Raises:
+        SigningScriptError: if an entry has a data descriptor
+
+    Returns:
+        tuple: a list of (central directory entry, offset, size) tuples, where
+            size is the length of the local header and compressed data, and
+            the name of the last preloaded entry, or None
+
+    """
+    with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as orig_map, memoryview(orig_map) as orig_data:
+        orig_jarreader = mozjar.JarReader(data=orig_data)
+        try:
+            contents = []
+            for name, entry in orig_jarreader.entries.items():
+                if name.startswith("META-INF/"):
+                    continue
+                if entry["general_flag"] & 0x8:
+                    raise SigningScriptError(f"Can't merge {orig}: {name} has a data descriptor")
+                header = mozjar.JarLocalFileHeader(orig_data[entry["offset"] :])
+                contents.append((entry, entry["offset"], header.size + entry["compressed_size"]))
+            return contents, orig_jarreader.last_preloaded
+        finally:
+            # Drop the reader's view of the map, so that it can be closed
+            orig_jarreader.close()
+
+
+def _merge_omnija_files_sync(orig, signed, to):
+    with open(orig, "rb") as orig_fh:
+        orig_contents, last_preloaded = _read_omnija_entries(orig, orig_fh)
+        # (entry, size, offset in the original, or the data to write)
+        contents = [(entry, size, offset) for entry, offset, size in orig_contents]
+
         # Use ZipFile here because mozjar can't read the signed copies
-        signed_zip = zipfile.ZipFile(signed, "r")
-        for fname in signed_zip.namelist():
-            if fname.startswith("META-INF"):
-                to_writer.add(fname, signed_zip.open(fname, "r"))
-        if orig_jarreader.last_preloaded:
-            jarlog = list(orig_jarreader.entries.keys())
-            preloads = jarlog[: jarlog.index(orig_jarreader.last_preloaded) + 1]
-            to_writer.preload(preloads)
+        with zipfile.ZipFile(signed, "r") as signed_zip:
+            for info in signed_zip.infolist():
+                if not info.filename.startswith("META-INF") or info.is_dir():
+                    continue
+                new_info = seek_zip_member_data(signed_zip, info)
+                local_header = new_info.FileHeader()
+                header = mozjar.JarLocalFileHeader(local_header)
+                entry = mozjar.JarCdirEntry()
+                for name in entry.STRUCT:
+                    if name in header:
+                        entry[name] = header[name]
+                entry["creator_version"] = (new_info.create_system << 8) | new_info.create_version
+                entry["internal_attr"] = new_info.internal_attr
+                entry["external_attr"] = new_info.external_attr
+                data = local_header + signed_zip.fp.read(info.compress_size)
+                contents.append((entry, len(data), data))
+
+        # Lay the jar out like mozjar.JarWriter.finish does
+        offset = 0
+        preload_size = 0
+        for entry, size, _ in contents:
+            entry["offset"] = offset
+            offset += size
+            if last_preloaded and entry["filename"] == last_preloaded.encode("utf-8"):
+                preload_size = offset
+        end = mozjar.JarCdirEnd()
+        end["disk_entries"] = end["cdir_entries"] = len(contents)
+        end["cdir_size"] = sum(entry.size for entry, _, _ in contents)
+        with open(to, "wb") as fh:
+            if preload_size:
+                end["cdir_offset"] = 4
+                header_size = end["cdir_offset"] + end["cdir_size"] + end.size
+                fh.write(struct.pack("<I", preload_size + header_size))
+                for entry, _, _ in contents:
+                    entry["offset"] += header_size
+                    fh.write(entry.serialize())
+                fh.write(end.serialize())
+            for _, size, source in contents:
+                if isinstance(source, int):
+                    # Copy the original's local header and data a buffer at a time
+                    orig_fh.seek(source)
+                    copy_bytes(orig_fh, fh, size)
+                else:
+                    fh.write(source)
+            if not preload_size:
+                end["cdir_offset"] = offset
+                for entry, _, _ in contents:
+                    fh.write(entry.serialize())
+            fh.write(end.serialize())
     return True
 
 
 # sign_authenticode_file {{{1
+def _get_authenticode_pool(context):
+    """Get the task's AuthenticodePool, creating it on first use."""
+    if getattr(context, "authenticode_pool", None) is None:
+        context.authenticode_pool = AuthenticodePool.from_config(context.config)
+    return context.authenticode_pool
+
+
 async def _winsign_helper(error_message, *args, **kwargs):
-    """Raise an exception if winsign.sign.sign_file returns False to enable retries."""
-    # winsign.sign.sign_file signature is (infile, outfile, ...), so outfile is args[1].
+    """Raise an exception if authenticode.sign_file returns False to enable retries."""
+    # authenticode.sign_file signature is (infile, outfile, ...), so outfile is args[1].
     # On a prior failed attempt, osslsigncode may have already written outfile to disk;
     # leaving it there makes the next attempt fail with "Overwriting an existing file
     # is not supported." — masking the original transient error.
     outfile = args[1]
     pathlib.Path(outfile).unlink(missing_ok=True)
-    if not await winsign.sign.sign_file(*args, **kwargs):
+    if not await authenticode.sign_file(*args, **kwargs):
         raise SigningScriptError(error_message)
 
 
@@ -1414,7 +2056,8 @@ async def sign_authenticode_file(context, orig_path, fmt, *, authenticode_commen
         True on success, False otherwise
 
     """
-    if winsign.osslsigncode.is_signed(orig_path):
+    pool = _get_authenticode_pool(context)
+    if await pool.run_osslsigncode(winsign.osslsigncode.is_signed, orig_path):
         log.info("%s is already signed", orig_path)
         return True
 
@@ -1481,13 +2124,16 @@ async def sign_authenticode_file(context, orig_path, fmt, *, authenticode_commen
         "timestamp_style": timestamp_style,
         "timestamp_url": timestamp_url,
     }
-    log.info(f"running winsign.sign.sign_file with kwargs {winsign_kwargs}...")
-    # Retry winsign.sign.sign_file, because the timestamp server can hiccup
+    log.info(f"running authenticode.sign_file with kwargs {winsign_kwargs}...")
+    winsign_kwargs["pool"] = pool
+    # Retry authenticode.sign_file, because the timestamp server can hiccup
     await retry_async(
         _winsign_helper,
         args=(f"Couldn't sign {orig_path}", infile, outfile, digest_algo, certs, signer),
         kwargs=winsign_kwargs,
     )
+    # osslsigncode never writes to `infile`, and renaming over it leaves any
+    # artifact it was hard linked to alone
     os.rename(outfile, infile)
 
     return True
@@ -1495,13 +2141,16 @@ async def sign_authenticode_file(context, orig_path, fmt, *, authenticode_commen
 
 # sign_authenticode {{{1
 @time_async_function
-async def sign_authenticode(context, orig_path, fmt, *, authenticode_comment=None, **kwargs):
+async def sign_authenticode(context, orig_path, fmt, *, authenticode_comment=None, archive=None, **kwargs):
     """Sign a file with authenticode, using autograph as a backend.
 
     Supported formats are a single file or a zip.
 
-    If a zip is passed in, extract it and only sign unsigned files that don't
-    match certain patterns (see `_should_sign_windows`). Then recreate the zip.
+    If a zip is passed in, find the files that don't match certain patterns
+    (see `_should_sign_windows`) and aren't signed yet, from their PE headers.
+    Only those are extracted and signed, and then replaced in the zip,
+    copying the other members across without recompressing them. If they're
+    all signed already, the zip is left untouched.
 
     Args:
         context (Context): the signing context
@@ -1510,36 +2159,54 @@ async def sign_authenticode(context, orig_path, fmt, *, authenticode_comment=Non
         comment (str): The authenticode comment to sign with, if present.
                        currently only used for msi files.
                        (Defaults to None)
+        archive (ArchiveSession, optional): the session for the zip, if
+            other formats are working on it too
 
     Returns:
         str: the path to the signed file or re-created zip
 
     """
     _, file_extension = os.path.splitext(orig_path)
-    # This will get cleaned up when we nuke `work_dir`. Clean up at that point
-    # rather than immediately after `sign_signcode`, to optimize task runtime
-    # speed over disk space.
-    tmp_dir = None
-    # Extract the zipfile
-    if file_extension == ".zip":
-        tmp_dir = tempfile.mkdtemp(prefix="zip", dir=context.config["work_dir"])
-        files = await _extract_zipfile(context, orig_path, tmp_dir=tmp_dir)
-    else:
-        files = [orig_path]
-    files_to_sign = [file for file in files if _should_sign_windows(file)]
-    if not files_to_sign:
-        raise SigningScriptError("Did not find any files to sign, all files: {}".format(files))
-
-    # Sign the appropriate inner files
-    tasks = [asyncio.create_task(sign_authenticode_file(context, file_, fmt, authenticode_comment=authenticode_comment)) for file_ in files_to_sign]
-    done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
-    [f.result() for f in done]
-    if file_extension == ".zip":
-        # Recreate the zipfile
-        await _create_zipfile(context, orig_path, files, tmp_dir=tmp_dir)
+    if file_extension != ".zip":
+        if not _should_sign_windows(orig_path):
+            raise SigningScriptError("Did not find any files to sign, all files: {}".format([orig_path]))
+        await _sign_authenticode_files(context, [orig_path], fmt, authenticode_comment)
+        return orig_path
+
+    async with _open_archive(context, orig_path, archive) as archive:
+        files = await archive.names()
+        files_to_sign = [file for file in files if _should_sign_windows(file)]
+        if not files_to_sign:
+            raise SigningScriptError("Did not find any files to sign, all files: {}".format(files))
+        # Members that are already extracted may have changed, so they're
+        # checked by `sign_authenticode_file` instead
+        unsigned = await utils.run_in_executor(
+            context, find_unsigned_zip_members, orig_path, [file for file in files_to_sign if not archive.is_extracted(file)]
+        )
+        files_to_sign = [file for file in files_to_sign if file in unsigned or archive.is_extracted(file)]
+        if not files_to_sign:
+            log.info("Every file in %s is already signed; leaving it untouched", orig_path)
+            return orig_path
+        files_to_sign = await archive.extract(files_to_sign)
+        await _sign_authenticode_files(context, files_to_sign, fmt, authenticode_comment)
+        # Replace the signed files in the zipfile
+        archive.changed(files_to_sign)
     return orig_path
 
 
+async def _sign_authenticode_files(context, files, fmt, authenticode_comment):
+    tasks = [asyncio.create_task(sign_authenticode_file(context, file_, fmt, authenticode_comment=authenticode_comment)) for file_ in files]
+    try:
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        [f.result() for f in done]
+    finally:
+        # On failure or cancellation, stop signing the other files rather
+        # than leaving them running in the background
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
 def _can_notarize(filename, supported_extensions):
     """
     Check if file can be notarized based on extension
@@ -1703,40 +2370,66 @@ async def sign_rpm_pkg(context, path, fmt, **kwargs):
     autograph_config = get_autograph_config(context.autograph_configs, cert_type, [fmt], raise_on_empty=True)
 
     with open(path, "rb") as f:
-        signed_files = await sign_with_autograph(context.session, autograph_config, [f], fmt, "files")
+        signed_files = await sign_with_autograph(
+            context.session,
+            autograph_config,
+            [f],
+            fmt,
+            "files",
+            block_size=get_encode_block_size(context),
+            decode_dir=os.path.dirname(os.path.abspath(path)),
+        )
 
     signed_file = signed_files[0]
-    signed_content = base64.b64decode(signed_file["content"])
-    with open(path, "wb") as f:
-        f.write(signed_content)
+    shutil.copymode(path, signed_file["content"])
+    os.replace(signed_file["content"], path)
 
     return path
 
 
-async def _notarize_wait_staple_batch(context, paths, attempts):
-    """Serial notarize-submit, notary-wait, then staple for a list of paths.
+async def _notarize_wait_staple_path(context, path, attempts, semaphore, manifest=None):
+    """Notarize-submit, notary-wait, then staple a single path.
 
-    No-op on empty list. Each step wraps the rcodesign call in retry_async
-    with the given attempt budget, raising RCodesignError on exhaustion.
+    Each step wraps the rcodesign call in retry_async with the given attempt
+    budget, raising RCodesignError on exhaustion. If `manifest` has a
+    submission for `path` from the previous run, that submission is waited on
+    instead of uploading `path` again; should that wait fail, `path` is
+    submitted again.
     """
-    if not paths:
-        return
-    submissions_map = {}
-    for path in paths:
-        submissions_map[path] = await retry_async(
-            func=rcodesign_notarize,
-            args=(path, context.apple_credentials_path),
-            attempts=attempts,
-            retry_exceptions=RCodesignError,
-        )
-    for path, submission_id in submissions_map.items():
-        await retry_async(
-            func=rcodesign_notary_wait,
-            args=(submission_id, context.apple_credentials_path),
-            attempts=attempts,
-            retry_exceptions=RCodesignError,
-        )
-    for path in submissions_map.keys():
+    async with semaphore:
+        digest = submission_id = None
+        if manifest is not None:
+            with metrics.stage("hash", "notarization_digest"):
+                digest = await utils.run_in_executor(context, notarization_digest, path)
+            submission_id = manifest.get_previous(digest)
+        if submission_id:
+            log.info(f"Resuming notarization submission {submission_id} for {path} from the previous run")
+            manifest.add(digest, submission_id, os.path.basename(path))
+            try:
+                await retry_async(
+                    func=rcodesign_notary_wait,
+                    args=(submission_id, context.apple_credentials_path),
+                    attempts=attempts,
+                    retry_exceptions=RCodesignError,
+                )
+            except RCodesignError as e:
+                log.warning(f"Previous submission {submission_id} for {path} failed, submitting again: {e}")
+                submission_id = None
+        if not submission_id:
+            submission_id = await retry_async(
+                func=rcodesign_notarize,
+                args=(path, context.apple_credentials_path),
+                attempts=attempts,
+                retry_exceptions=RCodesignError,
+            )
+            if manifest is not None:
+                manifest.add(digest, submission_id, os.path.basename(path))
+            await retry_async(
+                func=rcodesign_notary_wait,
+                args=(submission_id, context.apple_credentials_path),
+                attempts=attempts,
+                retry_exceptions=RCodesignError,
+            )
         await retry_async(
             func=rcodesign_staple,
             args=[path],
@@ -1745,25 +2438,58 @@ async def _notarize_wait_staple_batch(context, paths, attempts):
         )
 
 
-async def _probe_staple_collect_failures(paths, probe_kwargs):
+async def _notarize_wait_staple_batch(context, paths, attempts, manifest=None):
+    """Concurrent notarize-submit, notary-wait, then staple for a list of paths.
+
+    No-op on empty list. Apple processes submissions in parallel, so each path
+    goes through the whole pipeline independently, with at most
+    `notarization_concurrency` paths in flight at once. Every path is given
+    the chance to finish before any failure is raised. Submissions are
+    recorded in, and resumed from, `manifest` if given.
+
+    Raises:
+        RCodesignError: listing every path that failed
+    """
+    if not paths:
+        return
+    semaphore = asyncio.Semaphore(context.config.get("notarization_concurrency", DEFAULT_NOTARIZATION_CONCURRENCY))
+    results = await asyncio.gather(*[_notarize_wait_staple_path(context, path, attempts, semaphore, manifest) for path in paths], return_exceptions=True)
+    failures = []
+    for path, result in zip(paths, results):
+        if isinstance(result, BaseException):
+            if not isinstance(result, Exception):
+                raise result
+            log.error(f"Notarization failed for {path}: {result}")
+            failures.append(f"{path}: {result}")
+    if failures:
+        raise RCodesignError("Notarization failed for {} of {} paths:\n{}".format(len(failures), len(paths), "\n".join(failures)))
+
+
+async def _probe_staple_collect_failures(paths, probe_kwargs, concurrency=DEFAULT_NOTARIZATION_CONCURRENCY):
     """Staple-probe each path; return the subset whose probe raised RCodesignError.
 
     A successful probe means the notarization ticket already exists server-side
     (transitively via a parent .pkg, a prior run, or a sibling task), so the path
     needs no fresh notarization. ``probe_kwargs`` is forwarded to retry_async.
+    Up to ``concurrency`` paths are probed at once.
     """
-    needs_notarization = []
-    for path in paths:
-        try:
-            await retry_async(
-                func=rcodesign_staple,
-                args=[path],
-                retry_exceptions=RCodesignError,
-                **probe_kwargs,
-            )
-        except RCodesignError:
-            needs_notarization.append(path)
-    return needs_notarization
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def probe(path):
+        async with semaphore:
+            try:
+                await retry_async(
+                    func=rcodesign_staple,
+                    args=[path],
+                    retry_exceptions=RCodesignError,
+                    **probe_kwargs,
+                )
+            except RCodesignError:
+                return False
+            return True
+
+    results = await asyncio.gather(*[probe(path) for path in paths])
+    return [path for path, stapled in zip(paths, results) if not stapled]
 
 
 @time_async_function
@@ -1779,13 +2505,19 @@ async def apple_notarize_stacked(context, filelist_dict):
     On a rerun (RUN_ID != 0) the .pkgs were likely already submitted to Apple by
     a prior run, so their notarization tickets already exist server-side; we
     probe-staple each .pkg first and only re-notarize the ones whose probe fails.
+
+    Every submission id is written to the `SUBMISSION_MANIFEST` artifact. A
+    rerun waits on the previous run's submissions for anything it would
+    otherwise submit again.
     """
     ATTEMPTS = 5
     STAPLE_PROBE_RETRY_KWARGS = {"attempts": 3, "sleeptime_kwargs": {"delay_factor": 15}}
+    concurrency = context.config.get("notarization_concurrency", DEFAULT_NOTARIZATION_CONCURRENCY)
 
     # Cast RUN_ID
     run_id = int(os.environ.get("RUN_ID") or 0)
     log.info(f"apple_notarize_stacked run_id={run_id}")
+    manifest = await SubmissionManifest.load(context)
 
     relpath_index_map = {}
     paths_to_notarize = []
@@ -1824,13 +2556,13 @@ async def apple_notarize_stacked(context, filelist_dict):
     # and only re-notarize the ones whose probe fails.
     # The probe only succeeds for submissions Apple has already finished
     # processing (Accepted); a .pkg still in flight from the prior run can't be
-    # stapled yet, so it falls through and gets re-submitted. In order to fix this
-    # corner case we'd need to persist submission ids across runs.
+    # stapled yet, so it falls through, and we wait on the prior run's
+    # submission from the manifest rather than re-submitting it.
     if run_id != 0:
-        pkgs_needing_notarization = await _probe_staple_collect_failures(pkg_paths, {"attempts": 1})
-        await _notarize_wait_staple_batch(context, pkgs_needing_notarization, ATTEMPTS)
+        pkgs_needing_notarization = await _probe_staple_collect_failures(pkg_paths, {"attempts": 1}, concurrency)
+        await _notarize_wait_staple_batch(context, pkgs_needing_notarization, ATTEMPTS, manifest)
     else:
-        await _notarize_wait_staple_batch(context, pkg_paths, ATTEMPTS)
+        await _notarize_wait_staple_batch(context, pkg_paths, ATTEMPTS, manifest)
 
     # Phase B: staple probe per .app; success means the .app was transitively
     # validated by its parent .pkg in Phase A. When no .pkg ran in Phase A,
@@ -1843,10 +2575,10 @@ async def apple_notarize_stacked(context, filelist_dict):
     # where every .pkg probe succeeds, the apps still have a parent ticket and
     # so still warrant the longer retry budget.
     probe_kwargs = STAPLE_PROBE_RETRY_KWARGS if pkg_paths else {"attempts": 1}
-    apps_needing_notarization = await _probe_staple_collect_failures(app_paths, probe_kwargs)
+    apps_needing_notarization = await _probe_staple_collect_failures(app_paths, probe_kwargs, concurrency)
 
     # Phase C: full pipeline fallback for .apps that failed the probe
-    await _notarize_wait_staple_batch(context, apps_needing_notarization, ATTEMPTS)
+    await _notarize_wait_staple_batch(context, apps_needing_notarization, ATTEMPTS, manifest)
 
     # Wrap up
     stapled_files = []
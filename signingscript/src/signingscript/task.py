@@ -5,17 +5,29 @@ Attributes:
     FORMAT_TO_SIGNING_FUNCTION (immutabledict): a mapping between signing format
         and signing function. If not specified, use the `default` signing
         function.
+    LAST_FORMATS (tuple): the formats that need to happen after all others, in
+        the order they need to happen in.
+    LINK_SAFE_SIGNING_FUNCTIONS (tuple): the signing functions that never
+        modify their input file in place.
+    ARCHIVE_SIGNING_FUNCTIONS (tuple): the signing functions that sign the
+        contents of an archive, and can share an `ArchiveSession`.
+    FORMAT_REGISTRY (FormatRegistry): how to sign with each signing format.
 
 """
 
 import logging
 import os
+from dataclasses import dataclass
+from typing import Callable
 
 from immutabledict import immutabledict
 from scriptworker.exceptions import TaskVerificationError
 from scriptworker.utils import get_single_item_from_sequence
 
+from signingscript import metrics, utils
 from signingscript.sign import (
+    ArchiveSession,
+    _is_xpi_format,
     apple_notarize,
     apple_notarize_geckodriver,
     apple_notarize_openh264_plugin,
@@ -31,7 +43,7 @@ from signingscript.sign import (
     sign_widevine,
     sign_xpi,
 )
-from signingscript.utils import split_autograph_format
+from signingscript.utils import is_apk_autograph_signing_format, is_sha1_apk_autograph_signing_format, split_autograph_format
 
 log = logging.getLogger(__name__)
 
@@ -66,6 +78,165 @@ FORMAT_TO_SIGNING_FUNCTION = immutabledict(
     }
 )
 
+# Widevine formats must be after other formats other than macapp; GPG must
+# be last. Only these exact formats are moved, so e.g. formats with a keyid
+# keep their place.
+LAST_FORMATS = (
+    "widevine",
+    "autograph_widevine",
+    "gcp_prod_autograph_widevine",
+    "stage_autograph_widevine",
+    "autograph_omnija",
+    "gcp_prod_autograph_omnija",
+    "stage_autograph_omnija",
+    "macapp",
+    "autograph_rsa",
+    "gcp_prod_autograph_rsa",
+    "stage_autograph_rsa",
+    "autograph_gpg",
+    "gcp_prod_autograph_gpg",
+    "stage_autograph_gpg",
+)
+
+# These leave their input alone, or write a new file and rename it over their
+# input, so a hard linked input doesn't need unlinking before signing it.
+# `ArchiveSession` takes care of archives that are re-packed.
+LINK_SAFE_SIGNING_FUNCTIONS = (
+    sign_authenticode,
+    sign_file,
+    sign_file_detached,
+    sign_gpg_with_autograph,
+    sign_mar384_with_autograph_hash,
+    sign_omnija,
+    sign_widevine,
+    sign_xpi,
+)
+
+# Consecutive formats signed with these share one extraction of the archive
+ARCHIVE_SIGNING_FUNCTIONS = (
+    sign_authenticode,
+    sign_omnija,
+    sign_widevine,
+)
+
+# Formats with these prefixes are signed like the format without the prefix,
+# on a different autograph instance.
+FORMAT_PREFIXES = ("stage_", "gcp_prod_")
+XPI_FORMAT_PREFIXES = tuple(f"{prefix}autograph_xpi" for prefix in ("",) + FORMAT_PREFIXES)
+
+
+@dataclass(frozen=True)
+class SigningFormat:
+    """How to sign with a signing format.
+
+    Attributes:
+        name (str): the format, as given in the task, including any keyid
+        keyid (str): the autograph keyid, or None
+        signing_function (Callable): the function to sign with
+        priority (int): where the format goes when ordering formats; formats
+            with a higher priority happen later
+        is_xpi (bool): whether autograph signs it as an extension
+        is_apk (bool): whether autograph signs it as an APK
+        is_sha1_apk (bool): whether autograph signs it as an APK with a SHA1 digest
+        modifies_in_place (bool): whether signing may write to the input file
+            in place, so it needs `utils.break_link` first
+        uses_archive_session (bool): whether it signs the contents of an
+            archive through an `ArchiveSession`
+
+    """
+
+    name: str
+    keyid: str
+    signing_function: Callable
+    priority: int
+    is_xpi: bool
+    is_apk: bool
+    is_sha1_apk: bool
+    modifies_in_place: bool
+    uses_archive_session: bool
+
+    @property
+    def needs_zip_passthrough(self):
+        """Whether autograph needs to leave the compression of the signed zip alone."""
+        return self.is_apk
+
+
+class FormatRegistry:
+    """Look up how to sign with a signing format.
+
+    Every known format, with and without the `stage_` and `gcp_prod_`
+    prefixes, is resolved up front. Anything else, like formats with a keyid,
+    is resolved the first time it's looked up, so looking up a format is a
+    single dict lookup after that.
+
+    Args:
+        signing_functions (dict): maps formats to signing functions, with a
+            `default` for formats that aren't in it
+        last_formats (tuple): the formats that need to happen after all others,
+            in order
+
+    """
+
+    def __init__(self, signing_functions=FORMAT_TO_SIGNING_FUNCTION, last_formats=LAST_FORMATS):
+        self._signing_functions = signing_functions
+        self._priorities = {fmt: priority for priority, fmt in enumerate(last_formats, 1)}
+        self._formats = {}
+        for fmt in signing_functions:
+            for prefix in ("",) + FORMAT_PREFIXES:
+                self.get(f"{prefix}{fmt}")
+        for fmt in last_formats:
+            self.get(fmt)
+
+    def get(self, fmt):
+        """Get how to sign with `fmt`.
+
+        Args:
+            fmt (str): the format, optionally with a `:keyid` suffix
+
+        Returns:
+            SigningFormat: how to sign with it
+
+        """
+        signing_format = self._formats.get(fmt)
+        if signing_format is None:
+            signing_format = self._formats[fmt] = self._resolve(fmt)
+        return signing_format
+
+    def _resolve(self, fmt_and_key_id):
+        fmt, keyid = split_autograph_format(fmt_and_key_id)
+        unprefixed = fmt.removeprefix("stage_").removeprefix("gcp_prod_")
+        if fmt.startswith(XPI_FORMAT_PREFIXES):
+            signing_function = sign_xpi
+        else:
+            signing_function = self._signing_functions.get(fmt) or self._signing_functions.get(unprefixed) or self._signing_functions["default"]
+        return SigningFormat(
+            name=fmt_and_key_id,
+            keyid=keyid,
+            signing_function=signing_function,
+            priority=self._priorities.get(fmt_and_key_id, 0),
+            is_xpi=_is_xpi_format(fmt_and_key_id),
+            is_apk=bool(is_apk_autograph_signing_format(fmt_and_key_id)),
+            is_sha1_apk=bool(is_sha1_apk_autograph_signing_format(fmt_and_key_id)),
+            modifies_in_place=signing_function not in LINK_SAFE_SIGNING_FUNCTIONS,
+            uses_archive_session=signing_function in ARCHIVE_SIGNING_FUNCTIONS,
+        )
+
+    def sort(self, formats):
+        """Order signing formats in place, keeping the order of formats with the same priority.
+
+        Args:
+            formats (list): the formats to order
+
+        Returns:
+            list: `formats`
+
+        """
+        formats.sort(key=lambda fmt: self.get(fmt).priority)
+        return formats
+
+
+FORMAT_REGISTRY = FormatRegistry()
+
 
 # task_cert_type {{{1
 def task_cert_type(context):
@@ -140,6 +311,10 @@ def _check_scopes_exist_and_all_have_the_same_prefix(scopes, prefixes):
 async def sign(context, path, signing_formats, **kwargs):
     """Call the appropriate signing function per format, for a single file.
 
+    Consecutive formats that sign the contents of an archive share an
+    `ArchiveSession`, so the archive is extracted and re-packed once between
+    them, rather than once per format.
+
     Args:
         context (Context): the signing context
         path (str): the source file to sign
@@ -151,15 +326,31 @@ async def sign(context, path, signing_formats, **kwargs):
 
     """
     output = path
+    rel_path = os.path.relpath(path, context.config["work_dir"])
+    archive = ArchiveSession(context)
     # Loop through the formats and sign one by one.
     for fmt in signing_formats:
-        signing_func = _get_signing_function_from_format(fmt)
+        signing_format = FORMAT_REGISTRY.get(fmt)
+        signing_func = signing_format.signing_function
+        format_kwargs = kwargs
+        if signing_format.uses_archive_session:
+            format_kwargs = dict(kwargs, archive=archive)
+        else:
+            # Other formats sign the archive itself, so it has to be re-packed first
+            with metrics.signing(rel_path, fmt):
+                await archive.close()
+        if signing_format.modifies_in_place and isinstance(output, str) and os.path.exists(output):
+            # `output` may be hard linked to the upstream artifact it was staged from
+            utils.break_link(output)
         try:
             size = os.path.getsize(output)
         except OSError:
             size = "??"
         log.info("sign(): Signing %s bytes in %s with %s...", size, output, fmt)
-        output = await signing_func(context, output, fmt, **kwargs)
+        with metrics.signing(rel_path, fmt), metrics.stage("sign", signing_func.__name__):
+            output = await signing_func(context, output, fmt, **format_kwargs)
+    with metrics.signing(rel_path):
+        await archive.close()
     # We want to return a list
     if not isinstance(output, (tuple, list)):
         output = [output]
@@ -167,16 +358,7 @@ async def sign(context, path, signing_formats, **kwargs):
 
 
 def _get_signing_function_from_format(fmt_and_key_id):
-    fmt, _ = split_autograph_format(fmt_and_key_id)
-
-    if fmt.startswith(("autograph_xpi", "gcp_prod_autograph_xpi", "stage_autograph_xpi")):
-        return sign_xpi
-    if fn := FORMAT_TO_SIGNING_FUNCTION.get(fmt):
-        return fn
-    if fn := FORMAT_TO_SIGNING_FUNCTION.get(fmt.removeprefix("stage_").removeprefix("gcp_prod_")):
-        return fn
-
-    return FORMAT_TO_SIGNING_FUNCTION["default"]
+    return FORMAT_REGISTRY.get(fmt_and_key_id).signing_function
 
 
 # _sort_formats {{{1
@@ -184,7 +366,7 @@ def _sort_formats(formats):
     """Order the signing formats.
 
     Certain formats need to happen before or after others, e.g. gpg after
-    any format that modifies the binary.
+    any format that modifies the binary. See `LAST_FORMATS`.
 
     Args:
         formats (list): the formats to order.
@@ -193,28 +375,7 @@ def _sort_formats(formats):
         list: the ordered formats.
 
     """
-    # Widevine formats must be after other formats other than macapp; GPG must
-    # be last.
-    for fmt in (
-        "widevine",
-        "autograph_widevine",
-        "gcp_prod_autograph_widevine",
-        "stage_autograph_widevine",
-        "autograph_omnija",
-        "gcp_prod_autograph_omnija",
-        "stage_autograph_omnija",
-        "macapp",
-        "autograph_rsa",
-        "gcp_prod_autograph_rsa",
-        "stage_autograph_rsa",
-        "autograph_gpg",
-        "gcp_prod_autograph_gpg",
-        "stage_autograph_gpg",
-    ):
-        if fmt in formats:
-            formats.remove(fmt)
-            formats.append(fmt)
-    return formats
+    return FORMAT_REGISTRY.sort(formats)
 
 
 # build_filelist_dict {{{1
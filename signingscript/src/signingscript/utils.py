@@ -1,18 +1,31 @@
 """Signingscript general utility functions."""
 
 import asyncio
+import errno
+import functools
 import hashlib
 import json
 import logging
 import os
+import tempfile
 from asyncio.subprocess import PIPE, STDOUT
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from dataclasses import dataclass
-from shutil import copyfile
+from shutil import copyfile, copymode
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
 
 from signingscript.exceptions import FailedSubprocess, SigningScriptError, SigningServerError
 
 log = logging.getLogger(__name__)
 
+# ioctl(2) request to share a file's extents with another file, on Linux
+# filesystems that support it (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
 
 @dataclass
 class Autograph:
@@ -145,14 +158,21 @@ async def log_output(fh, log_level=logging.INFO):
             break
 
 
-def copy_to_dir(source, parent_dir, target=None):
+def copy_to_dir(source, parent_dir, target=None, method="copy"):
     """Copy `source` to `parent_dir`, optionally renaming.
 
+    With `method="link"`, the copy shares its data with `source` instead of
+    duplicating it: it's a reflink where the filesystem supports them, or a
+    hard link otherwise, and a plain copy if neither works (e.g. across
+    filesystems). Hard linked copies must go through `break_link` before
+    being modified in place.
+
     Args:
         source (str): the source path
         parent_dir (str): the target parent dir. This doesn't have to exist
         target (str, optional): the basename of the target file.  If None,
             use the basename of `source`. Defaults to None.
+        method (str, optional): `copy` or `link`. Defaults to `copy`.
 
     Raises:
         SigningServerError: on failure
@@ -164,8 +184,12 @@ def copy_to_dir(source, parent_dir, target=None):
         parent_dir = os.path.dirname(target_path)
         mkdir(parent_dir)
         if source != target_path:
-            log.info("Copying %s to %s" % (source, target_path))
-            copyfile(source, target_path)
+            if method == "link":
+                log.info("Linking %s to %s" % (source, target_path))
+                _link_or_copy(source, target_path)
+            else:
+                log.info("Copying %s to %s" % (source, target_path))
+                copyfile(source, target_path)
             return target_path
         else:
             log.info("Not copying %s to itself" % (source))
@@ -174,6 +198,71 @@ def copy_to_dir(source, parent_dir, target=None):
         raise SigningServerError("Can't copy {} to {}!".format(source, target_path))
 
 
+def _reflink(source, target):
+    """Make `target` a copy-on-write clone of `source`, if the filesystem supports it.
+
+    Returns:
+        bool: whether `target` was cloned. If not, it doesn't exist.
+
+    """
+    if fcntl is None:
+        return False
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return True
+        except OSError:
+            pass
+    os.unlink(target)
+    return False
+
+
+def _link_or_copy(source, target):
+    if os.path.lexists(target):
+        os.unlink(target)
+    if _reflink(source, target):
+        return
+    try:
+        os.link(source, target)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP, errno.EOPNOTSUPP):
+            raise
+        log.info("Can't link %s to %s (%s), copying instead", source, target, e.strerror)
+        copyfile(source, target)
+
+
+def break_link(path):
+    """Give `path` its own copy of its data if it's hard linked elsewhere.
+
+    Call this before modifying a file in place that may have been staged
+    with `copy_to_dir(..., method="link")`, so the change doesn't show up in
+    the file it was staged from. Writing a new file and renaming it over
+    `path` doesn't need this.
+
+    Args:
+        path (str): the file about to be modified
+
+    Returns:
+        bool: whether `path` was linked, and now has its own copy
+
+    """
+    if os.stat(path).st_nlink < 2:
+        return False
+    log.info("Unlinking %s before modifying it", path)
+    fd, tmp_path = tempfile.mkstemp(prefix=".unlink", dir=os.path.dirname(os.path.abspath(path)))
+    os.close(fd)
+    try:
+        if not _reflink(path, tmp_path):
+            copyfile(path, tmp_path)
+        copymode(path, tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return True
+
+
 async def execute_subprocess(command, log_level=logging.INFO, **kwargs):
     """Execute a command in a subprocess.
 
@@ -200,6 +289,54 @@ async def execute_subprocess(command, log_level=logging.INFO, **kwargs):
         raise FailedSubprocess("Command `{}` failed".format(" ".join(command)))
 
 
+def get_executor(config):
+    """Create the pool that blocking signing helpers run in.
+
+    `executor_type` is `thread` (the default) or `process`, and
+    `executor_workers` sets the pool size. Threads are enough for the
+    helpers that spend their time in zlib, lzma, hashlib or file i/o, which
+    release the GIL; a process pool also parallelizes pure python work, but
+    the functions and arguments it runs must be picklable.
+
+    Args:
+        config (dict): the signingscript config
+
+    Raises:
+        SigningScriptError: on an unknown `executor_type`
+
+    Returns:
+        concurrent.futures.Executor: the pool
+
+    """
+    executor_type = config.get("executor_type", "thread")
+    max_workers = config.get("executor_workers")
+    if executor_type == "thread":
+        return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="signingscript")
+    if executor_type == "process":
+        return ProcessPoolExecutor(max_workers=max_workers)
+    raise SigningScriptError(f"Unknown executor_type {executor_type}")
+
+
+async def run_in_executor(context, func, *args, **kwargs):
+    """Run a blocking function without blocking the event loop.
+
+    The function runs in `context.executor` if it's set, and in the event
+    loop's default executor otherwise.
+
+    Args:
+        context (Context): the signing context
+        func (callable): the function to run
+        *args: the args to pass to `func`
+        **kwargs: the kwargs to pass to `func`
+
+    Returns:
+        the return value of `func`
+
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(getattr(context, "executor", None), functools.partial(func, *args, **kwargs))
+
+
 def is_apk_autograph_signing_format(format_):
     """Return bool of whether a signing format is an APK.
 
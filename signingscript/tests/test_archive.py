@@ -0,0 +1,97 @@
+import io
+import os
+import stat
+import zipfile
+
+import pytest
+
+import signingscript.archive as archive
+from signingscript.exceptions import SigningScriptError
+
+
+class UnseekableBytesIO(io.BytesIO):
+    def seek(self, *args):
+        raise io.UnsupportedOperation("seek")
+
+    def seekable(self):
+        return False
+
+
+def _make_zip(path):
+    with zipfile.ZipFile(path, "w") as z:
+        z.writestr("a.dll", b"a" * 1000, compress_type=zipfile.ZIP_DEFLATED)
+        z.writestr("dir/", b"")
+        z.writestr("dir/b.txt", b"b" * 1000, compress_type=zipfile.ZIP_STORED)
+        z.writestr("dir/c.txt", b"c" * 1000, compress_type=zipfile.ZIP_BZIP2)
+    # Add a member with a data descriptor, by writing to an unseekable file
+    buf = UnseekableBytesIO()
+    with zipfile.ZipFile(buf, "w") as z:
+        with z.open("d.txt", "w") as f:
+            f.write(b"d" * 1000)
+    stream = io.BytesIO(buf.getvalue())
+    with zipfile.ZipFile(stream) as zin, zipfile.ZipFile(path, "a") as zout:
+        info = zin.getinfo("d.txt")
+        assert info.flag_bits & 0x8
+        archive.copy_zip_member(zin, zout, info)
+
+
+def test_update_zipfile(tmp_path):
+    path = tmp_path / "test.zip"
+    _make_zip(path)
+    os.chmod(path, 0o644)
+    with zipfile.ZipFile(path) as z:
+        before = {i.filename: (i.compress_type, i.compress_size, i.CRC) for i in z.infolist()}
+    new_a = tmp_path / "a.dll"
+    new_a.write_bytes(b"signed a")
+    sig = tmp_path / "a.dll.sig"
+    sig.write_bytes(b"sig")
+
+    assert archive.update_zipfile(path, {"a.dll": new_a, "a.dll.sig": sig}) == path
+
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o644
+    assert not [f for f in os.listdir(tmp_path) if f.startswith("zip")]
+    with zipfile.ZipFile(path) as z:
+        assert z.testzip() is None
+        assert z.namelist() == ["a.dll", "dir/", "dir/b.txt", "dir/c.txt", "d.txt", "a.dll.sig"]
+        assert z.read("a.dll") == b"signed a"
+        assert z.read("a.dll.sig") == b"sig"
+        assert z.read("dir/b.txt") == b"b" * 1000
+        assert z.read("dir/c.txt") == b"c" * 1000
+        assert z.read("d.txt") == b"d" * 1000
+        assert z.getinfo("a.dll").compress_type == zipfile.ZIP_DEFLATED
+        for name in ("dir/", "dir/b.txt", "dir/c.txt", "d.txt"):
+            info = z.getinfo(name)
+            assert (info.compress_type, info.compress_size, info.CRC) == before[name]
+            assert not info.flag_bits & 0x8
+
+
+def test_update_zipfile_error(tmp_path):
+    path = tmp_path / "test.zip"
+    _make_zip(path)
+    with open(path, "rb") as f:
+        orig = f.read()
+    with pytest.raises(FileNotFoundError):
+        archive.update_zipfile(path, {"a.dll": tmp_path / "missing"})
+    with open(path, "rb") as f:
+        assert f.read() == orig
+    assert os.listdir(tmp_path) == ["test.zip"]
+
+
+def test_copy_zip_member_encrypted(tmp_path):
+    path = tmp_path / "test.zip"
+    _make_zip(path)
+    with zipfile.ZipFile(path) as zin, zipfile.ZipFile(tmp_path / "out.zip", "w") as zout:
+        info = zin.getinfo("a.dll")
+        info.flag_bits |= 0x1
+        with pytest.raises(SigningScriptError):
+            archive.copy_zip_member(zin, zout, info)
+
+
+def test_copy_zip_member_bad_header(tmp_path):
+    path = tmp_path / "test.zip"
+    _make_zip(path)
+    with zipfile.ZipFile(path) as zin, zipfile.ZipFile(tmp_path / "out.zip", "w") as zout:
+        info = zin.getinfo("dir/b.txt")
+        info.header_offset += 1
+        with pytest.raises(SigningScriptError):
+            archive.copy_zip_member(zin, zout, info)
@@ -0,0 +1,257 @@
+import asyncio
+import io
+import struct
+import threading
+import time
+import zipfile
+
+import pytest
+import winsign.makemsix
+import winsign.osslsigncode
+import winsign.timestamp
+from pyasn1_modules.rfc2315 import data
+from winsign.asn1 import ContentInfo, SignedData, der_decode, der_encode, id_signedData
+
+import signingscript.authenticode as authenticode
+
+
+def make_signed_data(version=1):
+    sig = SignedData()
+    sig["version"] = version
+    sig["contentInfo"]["contentType"] = data
+    return sig
+
+
+def make_content_info(sig):
+    ci = ContentInfo()
+    ci["contentType"] = id_signedData
+    ci["content"] = sig
+    return der_encode(ci)
+
+
+class Counter:
+    """Track the max number of concurrent calls."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.now = 0
+        self.max = 0
+
+    def __enter__(self):
+        with self.lock:
+            self.now += 1
+            self.max = max(self.max, self.now)
+
+    def __exit__(self, *args):
+        with self.lock:
+            self.now -= 1
+
+
+# AuthenticodePool {{{1
+def test_from_config():
+    pool = authenticode.AuthenticodePool.from_config(
+        {"authenticode_hash_concurrency": 1, "authenticode_sign_concurrency": 2, "authenticode_timestamp_concurrency": 3}
+    )
+    assert (pool.hash_semaphore._value, pool.sign_semaphore._value, pool.timestamp_semaphore._value) == (1, 2, 3)
+    pool = authenticode.AuthenticodePool.from_config({})
+    assert pool.hash_semaphore._value == authenticode.DEFAULT_HASH_CONCURRENCY
+    assert pool.sign_semaphore._value == authenticode.DEFAULT_SIGN_CONCURRENCY
+    assert pool.timestamp_semaphore._value == authenticode.DEFAULT_TIMESTAMP_CONCURRENCY
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("style", ("old", "rfc3161"))
+async def test_add_timestamp_cached(mocker, style):
+    calls = []
+    counter = Counter()
+
+    async def add_timestamp(sig, *args):
+        calls.append(args)
+        with counter:
+            await asyncio.sleep(0.01)
+        timestamped = make_signed_data(sig["version"] + 10)
+        return timestamped
+
+    mocker.patch.object(winsign.timestamp, "add_old_timestamp", add_timestamp)
+    mocker.patch.object(winsign.timestamp, "add_rfc3161_timestamp", add_timestamp)
+    pool = authenticode.AuthenticodePool(timestamp_concurrency=1)
+
+    results = await asyncio.gather(
+        pool.add_timestamp(make_signed_data(1), style, "sha256", "http://ts"),
+        pool.add_timestamp(make_signed_data(1), style, "sha256", "http://ts"),
+        pool.add_timestamp(make_signed_data(2), style, "sha256", "http://ts"),
+    )
+    assert [int(r["version"]) for r in results] == [11, 11, 12]
+    assert len(calls) == 2
+    assert calls[0] == (("http://ts",) if style == "old" else ("sha256", "http://ts"))
+    assert counter.max == 1
+
+    # A different timestamp server gets its own request
+    await pool.add_timestamp(make_signed_data(1), style, "sha256", "http://other")
+    assert len(calls) == 3
+
+
+@pytest.mark.asyncio
+async def test_add_timestamp_failure_not_cached(mocker):
+    attempts = []
+
+    async def add_timestamp(sig, digest_algo, url):
+        attempts.append(url)
+        if len(attempts) == 1:
+            raise OSError("Failed to get timestamp")
+        return sig
+
+    mocker.patch.object(winsign.timestamp, "add_rfc3161_timestamp", add_timestamp)
+    pool = authenticode.AuthenticodePool()
+    with pytest.raises(OSError):
+        await pool.add_timestamp(make_signed_data(), "rfc3161", "sha256", "http://ts")
+    assert int((await pool.add_timestamp(make_signed_data(), "rfc3161", "sha256", "http://ts"))["version"]) == 1
+    assert len(attempts) == 2
+
+
+# sign_file {{{1
+@pytest.fixture
+def fake_winsign(mocker, tmp_path):
+    """Replace osslsigncode and autograph with fakes that record how many run at once."""
+    fakes = {"osslsigncode": Counter(), "signer": Counter(), "written": [], "cafile": str(tmp_path / "ca.crt")}
+    (tmp_path / "ca.crt").write_text("ca")
+
+    def get_dummy_signature(infile, digest_algo, url=None, comment=None, crosscert=None):
+        with fakes["osslsigncode"]:
+            time.sleep(0.01)
+        return b"dummy", False
+
+    def write_signature(infile, outfile, sig, certs, cafile, timestampfile, wrap_sig):
+        with fakes["osslsigncode"]:
+            time.sleep(0.01)
+        fakes["written"].append((str(infile), str(outfile), sig))
+
+    async def resign(old_sig, certs, signer):
+        await signer(b"digest", "sha256")
+        return make_content_info(make_signed_data())
+
+    async def signer(digest, digest_algo):
+        with fakes["signer"]:
+            await asyncio.sleep(0.01)
+        return b"signature"
+
+    mocker.patch.object(winsign.makemsix, "is_msixfile", return_value=False)
+    mocker.patch.object(winsign.osslsigncode, "get_dummy_signature", get_dummy_signature)
+    mocker.patch.object(winsign.osslsigncode, "write_signature", write_signature)
+    mocker.patch.object(authenticode, "get_signeddata", lambda sig: sig)
+    mocker.patch.object(authenticode, "resign", resign)
+    fakes["signer_func"] = signer
+    return fakes
+
+
+@pytest.mark.asyncio
+async def test_sign_file_limits(fake_winsign):
+    pool = authenticode.AuthenticodePool(hash_concurrency=2, sign_concurrency=1)
+    results = await asyncio.gather(
+        *[authenticode.sign_file(f"in{i}", f"out{i}", "sha256", [], fake_winsign["signer_func"], cafile=fake_winsign["cafile"], pool=pool) for i in range(6)]
+    )
+    assert results == [True] * 6
+    assert fake_winsign["osslsigncode"].max == 2
+    assert fake_winsign["signer"].max == 1
+    assert sorted(w[1] for w in fake_winsign["written"]) == [f"out{i}" for i in range(6)]
+
+
+@pytest.mark.asyncio
+async def test_sign_file_timestamp(mocker, fake_winsign):
+    async def add_timestamp(sig, digest_algo, url):
+        sig["version"] = 5
+        return sig
+
+    mocker.patch.object(winsign.timestamp, "add_rfc3161_timestamp", add_timestamp)
+    assert await authenticode.sign_file(
+        "in", "out", "sha256", [], fake_winsign["signer_func"], cafile=fake_winsign["cafile"], timestamp_style="rfc3161", timestamp_url="http://ts"
+    )
+    ci = der_decode(fake_winsign["written"][0][2], ContentInfo())[0]
+    assert int(der_decode(ci["content"], SignedData())[0]["version"]) == 5
+
+
+@pytest.mark.asyncio
+async def test_sign_file_crosscert(mocker, tmp_path, fake_winsign):
+    crosscert = tmp_path / "cross.pem"
+    crosscert.write_bytes(b"pem")
+    mocker.patch.object(authenticode, "load_pem_certs", return_value=["crosscert"])
+    write_signature = mocker.patch.object(winsign.osslsigncode, "write_signature")
+    certs = ["cert"]
+    for _ in range(2):
+        assert await authenticode.sign_file("in", "out", "sha256", certs, fake_winsign["signer_func"], cafile=fake_winsign["cafile"], crosscert=str(crosscert))
+        assert write_signature.call_args[0][3] == ["cert", "crosscert"]
+    # retries pass the same list, so it mustn't grow
+    assert certs == ["cert"]
+
+
+@pytest.mark.asyncio
+async def test_sign_file_failures(mocker, fake_winsign):
+    signer = fake_winsign["signer_func"]
+    # No cafile
+    assert not await authenticode.sign_file("in", "out", "sha256", [], signer, cafile=None)
+    assert not await authenticode.sign_file("in", "out", "sha256", [], signer, cafile="/does/not/exist")
+
+    # osslsigncode failures
+    mocker.patch.object(winsign.osslsigncode, "write_signature", side_effect=OSError("boom"))
+    assert not await authenticode.sign_file("in", "out", "sha256", [], signer, cafile=fake_winsign["cafile"])
+    mocker.patch.object(winsign.osslsigncode, "get_dummy_signature", side_effect=OSError("boom"))
+    assert not await authenticode.sign_file("in", "out", "sha256", [], signer, cafile=fake_winsign["cafile"])
+
+
+@pytest.mark.asyncio
+async def test_sign_file_signer_failure(fake_winsign):
+    async def signer(digest, digest_algo):
+        raise Exception("autograph is down")
+
+    assert not await authenticode.sign_file("in", "out", "sha256", [], signer, cafile=fake_winsign["cafile"])
+    assert fake_winsign["written"] == []
+
+
+# pe_is_signed {{{1
+def make_pe(magic=0x20B, signed=False, ndirectories=16, pe_offset=0x80):
+    """Make the headers of a PE file, optionally with a certificate table."""
+    count_offset, directory_offset = {0x10B: (92, 128), 0x20B: (108, 144)}[magic]
+    optional_header = bytearray(directory_offset + 8 * (ndirectories - 4))
+    struct.pack_into("<H", optional_header, 0, magic)
+    struct.pack_into("<I", optional_header, count_offset, ndirectories)
+    if signed and ndirectories >= 5:
+        struct.pack_into("<II", optional_header, directory_offset, 0x4000, 0x2000)
+    dos_header = bytearray(pe_offset)
+    dos_header[:2] = b"MZ"
+    struct.pack_into("<I", dos_header, 0x3C, pe_offset)
+    coff_header = struct.pack("<HHIIIHH", 0x8664, 0, 0, 0, 0, len(optional_header), 0)
+    return bytes(dos_header) + b"PE\0\0" + coff_header + bytes(optional_header) + b"\0" * 1000
+
+
+@pytest.mark.parametrize(
+    "data,expected",
+    (
+        (make_pe(0x20B, signed=True), True),
+        (make_pe(0x20B, signed=False), False),
+        (make_pe(0x10B, signed=True), True),
+        (make_pe(0x10B, signed=False), False),
+        (make_pe(0x10B, signed=True, ndirectories=4), False),
+        (make_pe(signed=True, pe_offset=0x1000), True),
+        (make_pe(signed=True, pe_offset=0x100000), None),
+        (make_pe(0x10B, signed=True)[:200], None),
+        (b"MZ" + make_pe(signed=True)[2:0x80] + b"NE\0\0" + make_pe(signed=True)[0x84:], None),
+        (make_pe(0x10B)[:0x98] + b"\x07\x01" + make_pe(0x10B)[0x9A:], None),
+        (b"MZ", None),
+        (b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1" + b"\0" * 1000, None),
+    ),
+)
+def test_pe_is_signed(data, expected):
+    assert authenticode.pe_is_signed(io.BytesIO(data)) is expected
+
+
+def test_find_unsigned_zip_members(tmp_path):
+    path = tmp_path / "windows.zip"
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as z:
+        z.writestr("firefox/firefox.exe", make_pe(signed=False))
+        z.writestr("firefox/xul.dll", make_pe(signed=True))
+        z.writestr("firefox/setup.msi", b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1")
+        z.writestr("firefox/omni.ja", b"omni")
+    assert authenticode.find_unsigned_zip_members(str(path), ["firefox/firefox.exe", "firefox/xul.dll", "firefox/setup.msi"]) == [
+        "firefox/firefox.exe",
+        "firefox/setup.msi",
+    ]
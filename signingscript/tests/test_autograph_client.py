@@ -0,0 +1,201 @@
+import asyncio
+
+import aiohttp
+import aiohttp.test_utils
+import aiohttp.web
+import pytest
+from conftest import SERVER_CONFIG_PATH
+
+import signingscript.autograph as autograph
+from signingscript.exceptions import SigningServerError
+from signingscript.utils import load_autograph_configs
+
+
+async def _server(statuses):
+    """Start a server that responds with `statuses` in turn, and records the peer of each request."""
+    peers = []
+
+    async def handler(request):
+        peers.append(request.transport.get_extra_info("peername"))
+        await request.read()
+        return aiohttp.web.json_response([{"signature": "c2ln"}], status=statuses.pop(0) if statuses else 200)
+
+    app = aiohttp.web.Application()
+    app.router.add_post("/sign/hash", handler)
+    server = aiohttp.test_utils.TestServer(app)
+    await server.start_server()
+    return server, peers
+
+
+@pytest.mark.asyncio
+async def test_client_creates_sessions_per_server():
+    async with autograph.AutographClient(load_autograph_configs(SERVER_CONFIG_PATH), limit_per_host=3) as client:
+        origins = {str(origin) for origin in client._sessions}
+        assert origins == {"https://127.0.0.1", "https://127.0.0.2", "https://127.0.0.3"}
+        for session in client._sessions.values():
+            assert session.connector.limit_per_host == 3
+            assert session.connector.use_dns_cache
+    assert client._sessions == {}
+
+
+def test_client_from_config():
+    config = {"autograph_concurrency": 2, "autograph_dns_cache_ttl": 10, "autograph_failure_threshold": 1, "autograph_reset_timeout": 3}
+    client = autograph.AutographClient.from_config(config, {})
+    assert client.limit_per_host == 2
+    assert client.dns_cache_ttl == 10
+    assert client.keepalive_timeout == autograph.DEFAULT_KEEPALIVE_TIMEOUT
+    assert client.failure_threshold == 1
+    assert client.reset_timeout == 3
+
+
+@pytest.mark.asyncio
+async def test_client_reuses_connections():
+    server, peers = await _server([])
+    try:
+        async with autograph.AutographClient() as client:
+            for _ in range(3):
+                resp = await client.post(str(server.make_url("/sign/hash")), data=b"{}")
+                assert await resp.json() == [{"signature": "c2ln"}]
+            assert len(client._sessions) == 1
+    finally:
+        await server.close()
+    assert len(peers) == 3
+    assert len(set(peers)) == 1
+
+
+@pytest.mark.asyncio
+async def test_client_no_circuit_breaker_by_default():
+    server, peers = await _server([500] * 10)
+    url = str(server.make_url("/sign/hash"))
+    try:
+        async with autograph.AutographClient() as client:
+            for _ in range(10):
+                resp = await client.post(url, data=b"{}")
+                assert resp.status == 500
+            assert client._breakers == {}
+    finally:
+        await server.close()
+    assert len(peers) == 10
+
+
+@pytest.mark.asyncio
+async def test_client_circuit_breaker():
+    server, peers = await _server([500, 503, 500, 200])
+    url = str(server.make_url("/sign/hash"))
+    loop = asyncio.get_running_loop()
+    try:
+        async with autograph.AutographClient(failure_threshold=2, reset_timeout=0.2) as client:
+            for _ in range(2):
+                resp = await client.post(url, data=b"{}")
+                assert resp.status >= 500
+            # The breaker is open; the request waits for it rather than failing,
+            # and a failure reopens it...
+            start = loop.time()
+            resp = await client.post(url, data=b"{}")
+            assert resp.status == 500
+            assert loop.time() - start >= 0.2
+            # ...and a success closes it
+            start = loop.time()
+            resp = await client.post(url, data=b"{}")
+            assert resp.status == 200
+            assert loop.time() - start >= 0.2
+            start = loop.time()
+            resp = await client.post(url, data=b"{}")
+            assert resp.status == 200
+            assert loop.time() - start < 0.2
+    finally:
+        await server.close()
+    assert len(peers) == 5
+
+
+@pytest.mark.asyncio
+async def test_client_circuit_breaker_single_probe():
+    statuses = [500]
+    spans = []
+
+    async def handler(request):
+        start = asyncio.get_running_loop().time()
+        await request.read()
+        await asyncio.sleep(0.05)
+        spans.append((start, asyncio.get_running_loop().time()))
+        return aiohttp.web.json_response([], status=statuses.pop(0) if statuses else 200)
+
+    app = aiohttp.web.Application()
+    app.router.add_post("/sign/hash", handler)
+    server = aiohttp.test_utils.TestServer(app)
+    await server.start_server()
+    url = str(server.make_url("/sign/hash"))
+    try:
+        async with autograph.AutographClient(failure_threshold=1, reset_timeout=0.1) as client:
+            assert (await client.post(url, data=b"{}")).status == 500
+            responses = await asyncio.gather(*(client.post(url, data=b"{}") for _ in range(4)))
+            assert [resp.status for resp in responses] == [200] * 4
+    finally:
+        await server.close()
+    # Only the probe was sent until it succeeded
+    probe = spans[1]
+    assert all(start >= probe[1] for start, _ in spans[2:])
+
+
+@pytest.mark.asyncio
+async def test_client_circuit_breaker_connection_errors(unused_tcp_port):
+    async with autograph.AutographClient(failure_threshold=1, reset_timeout=0.05) as client:
+        for _ in range(2):
+            with pytest.raises(aiohttp.ClientError):
+                await client.post(f"http://127.0.0.1:{unused_tcp_port}/sign/hash", data=b"{}")
+        assert next(iter(client._breakers.values())).opened_at is not None
+
+
+@pytest.mark.asyncio
+async def test_batcher_batches_by_key():
+    calls = []
+
+    async def send(key, items):
+        calls.append((key, items))
+        return [f"{key}:{item}" for item in items]
+
+    batcher = autograph.RequestBatcher(send, window=0.01)
+    results = await asyncio.gather(batcher.submit("a", 1), batcher.submit("b", 2), batcher.submit("a", 3))
+    assert results == ["a:1", "b:2", "a:3"]
+    assert sorted(calls) == [("a", [1, 3]), ("b", [2])]
+
+
+@pytest.mark.asyncio
+async def test_batcher_max_batch_size():
+    calls = []
+
+    async def send(key, items):
+        calls.append(items)
+        return items
+
+    batcher = autograph.RequestBatcher(send, window=60, max_batch_size=2)
+    assert await asyncio.wait_for(asyncio.gather(batcher.submit("a", 1), batcher.submit("a", 2)), timeout=5) == [1, 2]
+    assert calls == [[1, 2]]
+    assert batcher._timers == {}
+
+
+@pytest.mark.asyncio
+async def test_batcher_failure():
+    async def send(key, items):
+        raise SigningServerError("boom")
+
+    batcher = autograph.RequestBatcher(send, window=0)
+    results = await asyncio.gather(batcher.submit("a", 1), batcher.submit("a", 2), return_exceptions=True)
+    assert all(isinstance(r, SigningServerError) for r in results)
+
+
+@pytest.mark.asyncio
+async def test_batcher_send_cancelled():
+    sending = asyncio.Event()
+
+    async def send(key, items):
+        sending.set()
+        await asyncio.sleep(60)
+
+    batcher = autograph.RequestBatcher(send, window=0)
+    submits = asyncio.gather(batcher.submit("a", 1), batcher.submit("a", 2), return_exceptions=True)
+    await sending.wait()
+    for task in batcher._tasks:
+        task.cancel()
+    results = await asyncio.wait_for(submits, timeout=5)
+    assert all(isinstance(r, asyncio.CancelledError) for r in results)
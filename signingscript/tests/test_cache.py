@@ -0,0 +1,75 @@
+import os
+
+import pytest
+
+from signingscript.cache import DEFAULT_MAX_SIZE, SigningCache
+
+
+def test_from_config(tmp_path):
+    assert SigningCache.from_config({}) is None
+    cache = SigningCache.from_config({"signing_cache_dir": str(tmp_path / "cache")})
+    assert cache.path == str(tmp_path / "cache")
+    assert cache.max_size == DEFAULT_MAX_SIZE
+    assert os.path.isdir(cache.path)
+    assert SigningCache.from_config({"signing_cache_dir": str(tmp_path), "signing_cache_max_size": 10}).max_size == 10
+
+
+@pytest.mark.parametrize(
+    "other",
+    (
+        ("digest", "fmt2", "keyid", "cert"),
+        ("digest", "fmt", None, "cert"),
+        ("digest", "fmt", "keyid", "cert2"),
+        ("digest2", "fmt", "keyid", "cert"),
+        ("digest", "fmt", "keyid", "cert", "extra"),
+    ),
+)
+def test_key(other):
+    key = SigningCache.key("digest", "fmt", "keyid", "cert")
+    assert key == SigningCache.key("digest", "fmt", "keyid", "cert")
+    assert key != SigningCache.key(*other)
+
+
+def test_get_put(tmp_path):
+    cache = SigningCache(str(tmp_path))
+    key = SigningCache.key("digest", "fmt", "keyid", "cert")
+    assert cache.get(key) is None
+    cache.put(key, b"signature")
+    assert cache.get(key) == b"signature"
+    cache.put(key, b"signature2")
+    assert cache.get(key) == b"signature2"
+    assert [f for _, _, files in os.walk(tmp_path) for f in files] == [key]
+
+
+def test_evict_lru(tmp_path):
+    cache = SigningCache(str(tmp_path), max_size=20)
+    keys = [SigningCache.key(str(i), "fmt", None, "cert") for i in range(3)]
+    for i, key in enumerate(keys[:2]):
+        cache.put(key, b"x" * 10)
+        os.utime(cache._entry_path(key), (i, i))
+    # Reading the oldest entry makes it the most recently used
+    assert cache.get(keys[0]) == b"x" * 10
+    cache.put(keys[2], b"x" * 10)
+    assert cache.get(keys[0]) == b"x" * 10
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[2]) == b"x" * 10
+
+
+def test_put_tracks_size(tmp_path, mocker):
+    SigningCache(str(tmp_path)).put(SigningCache.key("old", "fmt", None, "cert"), b"x" * 10)
+    cache = SigningCache(str(tmp_path), max_size=35)
+    walk = mocker.spy(os, "walk")
+    keys = [SigningCache.key(str(i), "fmt", None, "cert") for i in range(3)]
+    # The first put counts what's already there
+    cache.put(keys[0], b"x" * 10)
+    assert walk.call_count == 1
+    assert cache._size == 20
+    # Later ones don't walk the cache while it's under max_size
+    cache.put(keys[1], b"x" * 10)
+    cache.put(keys[1], b"x" * 5)
+    assert walk.call_count == 1
+    assert cache._size == 25
+    cache.put(keys[2], b"x" * 20)
+    assert walk.call_count == 2
+    assert cache._size <= 35
+    assert cache._size == sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(tmp_path) for f in files)
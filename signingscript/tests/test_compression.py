@@ -0,0 +1,107 @@
+import bz2
+import gzip
+import io
+import lzma
+import os
+import shutil
+import subprocess
+import tarfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import pytest
+
+import signingscript.compression as compression
+
+DECOMPRESS = {
+    "gz": gzip.decompress,
+    "bz2": bz2.decompress,
+    "xz": lzma.decompress,
+}
+COMMANDS = {
+    "gz": "gzip",
+    "bz2": "bzip2",
+    "xz": "xz",
+}
+
+
+@pytest.mark.parametrize("comp", ("gz", "bz2", "xz"))
+@pytest.mark.parametrize("size", (0, 1000, 2500))
+def test_parallel_compressor(comp, size):
+    data = os.urandom(size // 2) * 2
+    out = io.BytesIO()
+    with ThreadPoolExecutor(2) as executor:
+        with compression.ParallelCompressor(out, comp, executor, block_size=1000, max_pending=1) as dest:
+            for i in range(0, size, 300):
+                dest.write(data[i : i + 300])
+    assert DECOMPRESS[comp](out.getvalue()) == data
+    if shutil.which(COMMANDS[comp]):
+        assert subprocess.run([COMMANDS[comp], "-dc"], input=out.getvalue(), capture_output=True, check=True).stdout == data
+
+
+@pytest.mark.parametrize("comp", ("gz", "bz2", "xz"))
+def test_open_decompressed(tmp_path, comp):
+    path = tmp_path / "data"
+    path.write_bytes(compression.compress_block(comp, b"one") + compression.compress_block(comp, b"two"))
+    with compression.open_decompressed(path, comp) as f:
+        assert f.read() == b"onetwo"
+
+
+def test_parallel_compressor_unknown():
+    with pytest.raises(ValueError):
+        compression.ParallelCompressor(io.BytesIO(), "zst", None)
+    with pytest.raises(ValueError):
+        compression.open_decompressed("foo", "zst")
+    with pytest.raises(ValueError):
+        compression.compress_block("zst", b"")
+
+
+def test_parallel_compressor_error():
+    out = io.BytesIO()
+    with ThreadPoolExecutor(1) as executor:
+        with pytest.raises(RuntimeError):
+            with compression.ParallelCompressor(out, "gz", executor, block_size=10) as dest:
+                dest.write(b"x" * 5)
+                raise RuntimeError("boom")
+    assert dest.closed
+    assert out.getvalue() == b""
+
+
+@pytest.mark.parametrize("comp", ("gz", "bz2", "xz"))
+def test_create_parallel_tarfile(tmp_path, comp):
+    src = tmp_path / "src"
+    (src / "dir").mkdir(parents=True)
+    files = []
+    for i in range(5):
+        path = src / "dir" / f"file{i}"
+        path.write_bytes(os.urandom(3000))
+        files.append(str(path))
+    to = str(tmp_path / f"out.tar.{comp}")
+    assert compression.create_parallel_tarfile(to, files, str(src), comp, workers=2, block_size=4096) == to
+    with tarfile.open(to, mode=f"r:{comp}") as t:
+        assert t.getnames() == [f"dir/file{i}" for i in range(5)]
+        for i, path in enumerate(files):
+            with open(path, "rb") as f:
+                assert t.extractfile(f"dir/file{i}").read() == f.read()
+
+
+def test_create_parallel_tarfile_executor(tmp_path):
+    src = tmp_path / "src"
+    src.mkdir()
+    (src / "file").write_bytes(os.urandom(10000))
+    to = str(tmp_path / "out.tar.gz")
+    with ThreadPoolExecutor(2) as executor:
+        compression.create_parallel_tarfile(to, [str(src / "file")], str(src), "gz", block_size=4096, executor=executor)
+    with tarfile.open(to, mode="r:gz") as t:
+        assert t.extractfile("file").read() == (src / "file").read_bytes()
+
+
+@pytest.mark.parametrize("workers,expected", ((None, type(None)), (1, type(None)), (2, ProcessPoolExecutor)))
+def test_get_compression_executor(workers, expected):
+    config = {} if workers is None else {"compression_workers": workers}
+    with compression.get_compression_executor(config) as executor:
+        assert isinstance(executor, expected)
+
+
+def test_process_pool_compress_block():
+    with ProcessPoolExecutor(1) as executor:
+        assert gzip.decompress(executor.submit(compression.compress_block, "gz", b"data").result()) == b"data"
@@ -0,0 +1,97 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+import signingscript.metrics as metrics
+
+
+# stage {{{1
+def test_stage_without_collector():
+    with metrics.stage("hash") as stage:
+        stage.bytes_up = 10
+    # Nothing to record to, and nothing breaks
+
+
+@pytest.mark.asyncio
+async def test_stage_attribution():
+    collector = metrics.SigningMetrics(task_id="abc", run_id="0")
+
+    async def sign_one(path, fmt):
+        with metrics.signing(path, fmt):
+            await asyncio.sleep(0)
+            with metrics.stage("autograph", "call_autograph") as stage:
+                stage.bytes_up = 100
+                stage.bytes_down = 10
+            with metrics.stage(None):
+                pass
+
+    with metrics.activate(collector):
+        await asyncio.gather(sign_one("a.zip", "autograph_gpg"), sign_one("b.zip", "autograph_rsa"))
+        with metrics.stage("copy"):
+            pass
+    with metrics.stage("copy"):
+        pass
+
+    assert [(s["path"], s["format"], s["stage"], s["function"]) for s in collector.samples] == [
+        ("a.zip", "autograph_gpg", "autograph", "call_autograph"),
+        ("b.zip", "autograph_rsa", "autograph", "call_autograph"),
+        (None, None, "copy", None),
+    ]
+    sample = collector.samples[0]
+    assert sample["seconds"] >= 0
+    assert sample["max_rss_kb"] > 0
+    assert sample["rss_delta_kb"] >= 0
+
+
+def test_stage_records_on_error():
+    collector = metrics.SigningMetrics()
+    with metrics.activate(collector), pytest.raises(ValueError):
+        with metrics.signing("a.zip", "autograph_gpg"), metrics.stage("extract"):
+            raise ValueError("bad zip")
+    assert [s["stage"] for s in collector.samples] == ["extract"]
+
+
+# SigningMetrics {{{1
+def test_summary():
+    collector = metrics.SigningMetrics()
+    collector.record("autograph", 1.0, path="a", fmt="autograph_gpg", bytes_up=100, bytes_down=10)
+    collector.record("autograph", 3.0, path="b", fmt="autograph_gpg", bytes_up=200, bytes_down=20)
+    collector.record("extract", 2.0, path="b", fmt="autograph_rsa")
+    collector.record("copy", 0.5, path="b")
+    summary = collector.summary()
+    assert summary["by_stage"]["autograph"] == {"count": 2, "seconds": 4.0, "max_seconds": 3.0, "bytes_up": 300, "bytes_down": 30}
+    assert summary["by_stage"]["extract"]["count"] == 1
+    assert sorted(summary["by_format"]) == ["", "autograph_gpg", "autograph_rsa"]
+    assert summary["by_format"][""]["copy"]["seconds"] == 0.5
+
+
+def test_write(tmp_path, monkeypatch):
+    monkeypatch.setenv("TASK_ID", "abc")
+    monkeypatch.setenv("RUN_ID", "1")
+    collector = metrics.SigningMetrics.from_env()
+    collector.record("hash", 1.5, path="a", fmt="autograph_rsa")
+    path = collector.write(str(tmp_path))
+    assert path == os.path.join(tmp_path, metrics.METRICS_ARTIFACT)
+    with open(path) as fh:
+        data = json.load(fh)
+    assert (data["task_id"], data["run_id"]) == ("abc", "1")
+    assert data["samples"][0]["stage"] == "hash"
+    assert data["summary"]["by_stage"]["hash"]["seconds"] == 1.5
+    assert data["max_rss_kb"] > 0
+    assert os.listdir(os.path.dirname(path)) == [os.path.basename(metrics.METRICS_ARTIFACT)]
+
+
+def test_write_prometheus(tmp_path):
+    collector = metrics.SigningMetrics()
+    collector.record("autograph", 1.25, fmt='weird"fmt\\', bytes_up=100)
+    collector.record("copy", 0.5)
+    path = tmp_path / "textfile" / "signingscript.prom"
+    collector.write_prometheus(str(path))
+    lines = path.read_text().splitlines()
+    assert "# TYPE signingscript_stage_seconds gauge" in lines
+    assert 'signingscript_stage_seconds{format="weird\\"fmt\\\\",stage="autograph"} 1.25' in lines
+    assert 'signingscript_stage_seconds{format="",stage="copy"} 0.5' in lines
+    assert 'signingscript_stage_bytes_sent{format="weird\\"fmt\\\\",stage="autograph"} 100' in lines
+    assert any(line.startswith("signingscript_max_rss_bytes ") for line in lines)
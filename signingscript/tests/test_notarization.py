@@ -0,0 +1,114 @@
+import asyncio
+import hashlib
+import json
+import os
+
+import aiohttp.test_utils
+import aiohttp.web
+import pytest
+
+import signingscript.notarization as notarization
+
+
+# notarization_digest {{{1
+def test_notarization_digest_file(tmp_path):
+    path = tmp_path / "foo.pkg"
+    path.write_bytes(b"pkg")
+    assert notarization.notarization_digest(str(path)) == hashlib.sha256(b"pkg").hexdigest()
+
+
+def test_notarization_digest_dir(tmp_path):
+    def make_app(root):
+        (root / "Contents" / "MacOS").mkdir(parents=True)
+        (root / "Contents" / "MacOS" / "firefox").write_bytes(b"binary")
+        (root / "Contents" / "Info.plist").write_bytes(b"plist")
+        os.symlink("MacOS/firefox", root / "Contents" / "link")
+        return str(root)
+
+    one = make_app(tmp_path / "one.app")
+    two = make_app(tmp_path / "two.app")
+    assert notarization.notarization_digest(one) == notarization.notarization_digest(two)
+
+    os.unlink(os.path.join(two, "Contents", "link"))
+    os.symlink("Info.plist", os.path.join(two, "Contents", "link"))
+    assert notarization.notarization_digest(one) != notarization.notarization_digest(two)
+
+    os.rename(os.path.join(one, "Contents", "Info.plist"), os.path.join(one, "Contents", "Other.plist"))
+    assert notarization.notarization_digest(one) != notarization.notarization_digest(make_app(tmp_path / "three.app"))
+
+
+# get_previous_manifest_url {{{1
+@pytest.mark.parametrize(
+    "root_url,task_id,run_id,expected",
+    (
+        ("https://tc", "abc", 0, None),
+        ("https://tc", None, 1, None),
+        (None, "abc", 1, None),
+        ("https://tc/", "abc", 2, f"https://tc/api/queue/v1/task/abc/runs/1/artifacts/{notarization.SUBMISSION_MANIFEST}"),
+    ),
+)
+def test_get_previous_manifest_url(root_url, task_id, run_id, expected):
+    assert notarization.get_previous_manifest_url(root_url, task_id, run_id) == expected
+
+
+# fetch_previous_submissions {{{1
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "status,body,expected",
+    (
+        (200, json.dumps({"submissions": {"digest1": {"submission_id": "id1", "name": "foo.pkg"}}}), {"digest1": "id1"}),
+        (404, "", {}),
+        (500, "", {}),
+        (200, "not json", {}),
+        (200, json.dumps({"unexpected": []}), {}),
+    ),
+)
+async def test_fetch_previous_submissions(status, body, expected):
+    async def handler(request):
+        return aiohttp.web.Response(status=status, text=body)
+
+    app = aiohttp.web.Application()
+    app.router.add_get("/manifest.json", handler)
+    async with aiohttp.test_utils.TestServer(app) as server:
+        assert await notarization.fetch_previous_submissions(str(server.make_url("/manifest.json"))) == expected
+
+
+@pytest.mark.asyncio
+async def test_fetch_previous_submissions_timeout():
+    async def handler(request):
+        await asyncio.sleep(10)
+        return aiohttp.web.Response(text="{}")
+
+    app = aiohttp.web.Application()
+    app.router.add_get("/manifest.json", handler)
+    async with aiohttp.test_utils.TestServer(app) as server:
+        assert await notarization.fetch_previous_submissions(str(server.make_url("/manifest.json")), timeout=0.1) == {}
+
+
+# SubmissionManifest {{{1
+@pytest.mark.asyncio
+@pytest.mark.parametrize("run_id", ("0", "2"))
+async def test_submission_manifest(context, mocker, monkeypatch, run_id):
+    monkeypatch.setenv("TASKCLUSTER_ROOT_URL", "https://tc")
+    monkeypatch.setenv("TASK_ID", "abc")
+    monkeypatch.setenv("RUN_ID", run_id)
+    fetch = mocker.patch.object(notarization, "fetch_previous_submissions", return_value={"digest1": "id1"})
+
+    manifest = await notarization.SubmissionManifest.load(context)
+    if run_id == "0":
+        fetch.assert_not_called()
+        assert manifest.get_previous("digest1") is None
+    else:
+        fetch.assert_called_once_with(f"https://tc/api/queue/v1/task/abc/runs/1/artifacts/{notarization.SUBMISSION_MANIFEST}")
+        assert manifest.get_previous("digest1") == "id1"
+
+    manifest.add("digest1", "id2", "foo.pkg")
+    manifest.add("digest2", "id3", "bar.pkg")
+    with open(os.path.join(context.config["artifact_dir"], notarization.SUBMISSION_MANIFEST)) as f:
+        assert json.load(f) == {
+            "submissions": {
+                "digest1": {"submission_id": "id2", "name": "foo.pkg"},
+                "digest2": {"submission_id": "id3", "name": "bar.pkg"},
+            }
+        }
+    assert os.listdir(os.path.dirname(manifest.path)) == [os.path.basename(notarization.SUBMISSION_MANIFEST)]
@@ -1,3 +1,5 @@
+import asyncio
+import json
 import os
 import shutil
 from unittest import mock
@@ -5,10 +7,15 @@ from unittest import mock
 import pytest
 from conftest import TEST_DATA_DIR, noop_async, noop_sync
 
+import signingscript.notarization as notarization
 import signingscript.sign as sign
 from signingscript.exceptions import SigningScriptError
 
+
 # notarization {{{1
+@pytest.fixture
+def fake_notarization_digest(mocker):
+    mocker.patch.object(sign, "notarization_digest", lambda path: f"digest-{path}")
 
 
 @pytest.mark.asyncio
@@ -118,10 +125,89 @@ async def test_probe_staple_collect_failures(mocker):
 
 
 @pytest.mark.asyncio
+async def test_probe_staple_collect_failures_concurrent(mocker):
+    running = {"now": 0, "max": 0}
+
+    async def staple(path):
+        running["now"] += 1
+        running["max"] = max(running["max"], running["now"])
+        await asyncio.sleep(0.01)
+        running["now"] -= 1
+        if path.endswith(".fail"):
+            raise sign.RCodesignError("simulated probe failure")
+
+    mocker.patch.object(sign, "rcodesign_staple", staple)
+    paths = [f"/{i}.{'fail' if i % 2 else 'ok'}" for i in range(6)]
+    assert await sign._probe_staple_collect_failures(paths, {"attempts": 1}, concurrency=3) == ["/1.fail", "/3.fail", "/5.fail"]
+    assert running["max"] == 3
+
+
+@pytest.mark.asyncio
+async def test_notarize_wait_staple_batch(mocker, context):
+    """Each path goes from submit to wait to staple on its own, bounded by notarization_concurrency."""
+    context.apple_credentials_path = "/creds"
+    context.config["notarization_concurrency"] = 2
+    events = []
+    running = {"now": 0, "max": 0}
+
+    async def notarize(path, creds_path):
+        running["now"] += 1
+        running["max"] = max(running["max"], running["now"])
+        events.append(("submit", path))
+        return f"id-{path}"
+
+    async def wait(submission_id, creds_path):
+        # the first path takes longer to be processed than the others
+        await asyncio.sleep(0.05 if submission_id == "id-/a.pkg" else 0.01)
+        events.append(("wait", submission_id))
+
+    async def staple(path):
+        events.append(("staple", path))
+        running["now"] -= 1
+
+    mocker.patch.object(sign, "rcodesign_notarize", notarize)
+    mocker.patch.object(sign, "rcodesign_notary_wait", wait)
+    mocker.patch.object(sign, "rcodesign_staple", staple)
+
+    await sign._notarize_wait_staple_batch(context, ["/a.pkg", "/b.pkg", "/c.pkg"], 1)
+    assert running["max"] == 2
+    assert events.index(("staple", "/b.pkg")) < events.index(("wait", "id-/a.pkg"))
+    assert events.index(("staple", "/c.pkg")) < events.index(("wait", "id-/a.pkg"))
+    assert events[-1] == ("staple", "/a.pkg")
+
+
+@pytest.mark.asyncio
+async def test_notarize_wait_staple_batch_failures(mocker, context):
+    """Every path is attempted, and all of the failures are reported together."""
+    context.apple_credentials_path = "/creds"
+
+    async def notarize(path, creds_path):
+        if path == "/a.pkg":
+            raise sign.RCodesignError("upload failed")
+        return f"id-{path}"
+
+    async def wait(submission_id, creds_path):
+        if submission_id == "id-/c.pkg":
+            raise sign.RCodesignError("Notarization failed!")
+
+    staple = mock.AsyncMock()
+    mocker.patch.object(sign, "rcodesign_notarize", notarize)
+    mocker.patch.object(sign, "rcodesign_notary_wait", wait)
+    mocker.patch.object(sign, "rcodesign_staple", staple)
+
+    with pytest.raises(sign.RCodesignError, match="2 of 3 paths") as excinfo:
+        await sign._notarize_wait_staple_batch(context, ["/a.pkg", "/b.pkg", "/c.pkg"], 1)
+    assert "/a.pkg: upload failed" in str(excinfo.value)
+    assert "/c.pkg: Notarization failed!" in str(excinfo.value)
+    staple.assert_awaited_once_with("/b.pkg")
+
+
+@pytest.mark.asyncio
+@pytest.mark.usefixtures("fake_notarization_digest")
 async def test_apple_notarize_stacked(mocker, context, monkeypatch):
     # First-run path: RUN_ID unset -> no .pkg probe, full notarize for every .pkg.
     monkeypatch.delenv("RUN_ID", raising=False)
-    notarize_mock = mock.AsyncMock()
+    notarize_mock = mock.AsyncMock(return_value="submission-id")
     mocker.patch.object(sign, "rcodesign_notarize", notarize_mock)
     wait = mock.AsyncMock()
     mocker.patch.object(sign, "rcodesign_notary_wait", wait)
@@ -151,6 +237,7 @@ async def test_apple_notarize_stacked(mocker, context, monkeypatch):
 
 
 @pytest.mark.asyncio
+@pytest.mark.usefixtures("fake_notarization_digest")
 async def test_apple_notarize_stacked_probe_fallback(mocker, context, monkeypatch):
     """.app staple probe fails -> fall back to full notarize/wait/staple."""
     monkeypatch.delenv("RUN_ID", raising=False)
@@ -161,7 +248,7 @@ async def test_apple_notarize_stacked_probe_fallback(mocker, context, monkeypatc
 
     mocker.patch.object(sign, "retry_async", new=no_retry)
 
-    notarize_mock = mock.AsyncMock()
+    notarize_mock = mock.AsyncMock(return_value="submission-id")
     mocker.patch.object(sign, "rcodesign_notarize", notarize_mock)
     wait = mock.AsyncMock()
     mocker.patch.object(sign, "rcodesign_notary_wait", wait)
@@ -203,10 +290,11 @@ async def test_apple_notarize_stacked_probe_fallback(mocker, context, monkeypatc
 
 
 @pytest.mark.asyncio
+@pytest.mark.usefixtures("fake_notarization_digest")
 async def test_apple_notarize_stacked_no_pkg_single_probe(mocker, context, monkeypatch):
     """When no .pkg is in the batch, .apps get a single-attempt probe, then Phase C."""
     monkeypatch.delenv("RUN_ID", raising=False)
-    notarize_mock = mock.AsyncMock()
+    notarize_mock = mock.AsyncMock(return_value="submission-id")
     mocker.patch.object(sign, "rcodesign_notarize", notarize_mock)
     wait = mock.AsyncMock()
     mocker.patch.object(sign, "rcodesign_notary_wait", wait)
@@ -244,10 +332,11 @@ async def test_apple_notarize_stacked_no_pkg_single_probe(mocker, context, monke
 
 
 @pytest.mark.asyncio
+@pytest.mark.usefixtures("fake_notarization_digest")
 async def test_apple_notarize_stacked_rerun_pkg_probe_succeeds(mocker, context, monkeypatch):
     """Rerun (RUN_ID != 0): .pkg staple probes succeed, so .pkgs are NOT re-notarized."""
     monkeypatch.setenv("RUN_ID", "1")
-    notarize_mock = mock.AsyncMock()
+    notarize_mock = mock.AsyncMock(return_value="submission-id")
     mocker.patch.object(sign, "rcodesign_notarize", notarize_mock)
     wait = mock.AsyncMock()
     mocker.patch.object(sign, "rcodesign_notary_wait", wait)
@@ -277,10 +366,11 @@ async def test_apple_notarize_stacked_rerun_pkg_probe_succeeds(mocker, context,
 
 
 @pytest.mark.asyncio
+@pytest.mark.usefixtures("fake_notarization_digest")
 async def test_apple_notarize_stacked_rerun_pkg_probe_fails(mocker, context, monkeypatch):
     """Rerun (RUN_ID != 0): a .pkg probe fails -> that .pkg gets the full pipeline."""
     monkeypatch.setenv("RUN_ID", "1")
-    notarize_mock = mock.AsyncMock()
+    notarize_mock = mock.AsyncMock(return_value="submission-id")
     mocker.patch.object(sign, "rcodesign_notarize", notarize_mock)
     wait = mock.AsyncMock()
     mocker.patch.object(sign, "rcodesign_notary_wait", wait)
@@ -323,6 +413,7 @@ async def test_apple_notarize_stacked_rerun_pkg_probe_fails(mocker, context, mon
 
 
 @pytest.mark.asyncio
+@pytest.mark.usefixtures("fake_notarization_digest")
 async def test_apple_notarize_stacked_unsupported(mocker, context):
     """Test unsupported file extensions"""
 
@@ -351,3 +442,82 @@ async def test_apple_notarize_stacked_unsupported(mocker, context):
                 "/app.bbb": {"full_path": "/app.bbb", "formats": ["apple_notarize_stacked"]},
             },
         )
+
+
+RCODESIGN_STUB = """#!/bin/sh
+# Records its arguments, and pretends that Apple accepts every submission.
+# Stapling only works once a submission has been waited on.
+echo "$@" >> "$RCODESIGN_LOG"
+case "$1" in
+    notary-submit)
+        echo "created submission ID: new-$(basename "$4")"
+        ;;
+    notary-wait)
+        echo "poll state after 1s InProgress"
+        echo "poll state after 2s Accepted"
+        ;;
+    staple)
+        grep -q "^notary-wait" "$RCODESIGN_LOG" || exit 1
+        ;;
+esac
+"""
+
+
+@pytest.fixture
+def rcodesign_stub(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    stub = bin_dir / "rcodesign"
+    stub.write_text(RCODESIGN_STUB)
+    stub.chmod(0o755)
+    log = tmp_path / "rcodesign.log"
+    log.touch()
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv("RCODESIGN_LOG", str(log))
+    return log
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("previous", (True, False))
+async def test_apple_notarize_stacked_resumes_submission(mocker, context, monkeypatch, tmp_path, rcodesign_stub, previous):
+    """Rerun: a .pkg still in flight from the previous run is waited on, not re-submitted."""
+    monkeypatch.setenv("TASKCLUSTER_ROOT_URL", "https://tc")
+    monkeypatch.setenv("TASK_ID", "abc")
+    monkeypatch.setenv("RUN_ID", "1")
+    pkg = tmp_path / "foo.pkg"
+    pkg.write_bytes(b"pkg contents")
+    previous_submissions = {notarization.notarization_digest(str(pkg)): "old-foo.pkg"} if previous else {}
+    fetch = mocker.patch.object(notarization, "fetch_previous_submissions", return_value=previous_submissions)
+
+    await sign.apple_notarize_stacked(context, {"foo.pkg": {"full_path": str(pkg), "formats": ["apple_notarize_stacked"]}})
+
+    fetch.assert_called_once_with(f"https://tc/api/queue/v1/task/abc/runs/0/artifacts/{notarization.SUBMISSION_MANIFEST}")
+    calls = [line.split()[0] for line in rcodesign_stub.read_text().splitlines()]
+    submission_id = "old-foo.pkg" if previous else "new-foo.pkg"
+    # The first staple is the rerun probe, which fails as nothing has been waited on yet
+    assert calls == (["staple", "notary-wait", "staple"] if previous else ["staple", "notary-submit", "notary-wait", "staple"])
+    assert f"notary-wait --api-key-path fakepath {submission_id}" in rcodesign_stub.read_text()
+    with open(os.path.join(context.config["artifact_dir"], notarization.SUBMISSION_MANIFEST)) as f:
+        assert json.load(f) == {"submissions": {notarization.notarization_digest(str(pkg)): {"submission_id": submission_id, "name": "foo.pkg"}}}
+    with open(os.path.join(context.config["work_dir"], "foo.pkg"), "rb") as f:
+        assert f.read() == b"pkg contents"
+
+
+@pytest.mark.asyncio
+async def test_notarize_wait_staple_batch_resubmits_failed_resume(mocker, context):
+    """A previous submission that fails is submitted again."""
+
+    async def wait(submission_id, creds_path):
+        if submission_id == "old-id":
+            raise sign.RCodesignError("Notarization failed!")
+
+    notarize = mock.AsyncMock(return_value="new-id")
+    mocker.patch.object(sign, "rcodesign_notarize", notarize)
+    mocker.patch.object(sign, "rcodesign_notary_wait", wait)
+    mocker.patch.object(sign, "rcodesign_staple", mock.AsyncMock())
+    mocker.patch.object(sign, "notarization_digest", lambda path: "digest")
+    manifest = notarization.SubmissionManifest(os.path.join(context.config["artifact_dir"], "manifest.json"), {"digest": "old-id"})
+
+    await sign._notarize_wait_staple_batch(context, ["/foo.pkg"], 1, manifest)
+    notarize.assert_awaited_once_with("/foo.pkg", "fakepath")
+    assert manifest.submissions == {"digest": {"submission_id": "new-id", "name": "foo.pkg"}}
@@ -1,4 +1,6 @@
+import asyncio
 import builtins
+import json
 import os
 import subprocess
 from unittest.mock import MagicMock, mock_open
@@ -66,6 +68,27 @@ async def test_async_main_gpg(tmpdir, tmpfile, mocker):
     script.set_up_gpg_keyring.assert_called_once()
 
 
+@pytest.mark.asyncio
+async def test_async_main_writes_metrics(tmpdir, mocker):
+    mocker.patch.object(script, "copy_to_dir")
+    prom = os.path.join(tmpdir, "textfile", "signingscript.prom")
+    await async_main_helper(tmpdir, mocker, ["autograph_mar384"], {"metrics_prometheus_textfile": prom})
+    with open(os.path.join(tmpdir, "public/logs/signing-metrics.json")) as fh:
+        data = json.load(fh)
+    assert data["summary"]["by_stage"]["copy"]["count"] == 2
+    assert {s["path"] for s in data["samples"]} == {"path1"}
+    assert os.path.exists(prom)
+
+
+@pytest.mark.asyncio
+async def test_async_main_metrics_written_on_failure(tmpdir, mocker):
+    mocker.patch.object(script, "copy_to_dir", side_effect=OSError("disk full"))
+    with pytest.raises(OSError):
+        await async_main_helper(tmpdir, mocker, ["autograph_mar384"])
+    with open(os.path.join(tmpdir, "public/logs/signing-metrics.json")) as fh:
+        assert json.load(fh)["samples"][0]["stage"] == "copy"
+
+
 @pytest.mark.asyncio
 async def test_async_main_gpg_no_pubkey_defined(tmpdir, mocker):
     formats = ["autograph_gpg"]
@@ -212,6 +235,100 @@ async def test_async_main_autograph_authenticode(tmpdir, mocker, use_comment):
     await async_main_helper(tmpdir, mocker, formats, {}, "autograph", use_comment=use_comment)
 
 
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "formats,concurrency,expected_max",
+    (
+        (["autograph_mar"], 2, 2),
+        (["autograph_mar"], 1, 1),
+        (["apple_notarization"], 4, 1),
+    ),
+)
+async def test_async_main_concurrency(tmpdir, mocker, formats, concurrency, expected_max):
+    in_flight = 0
+    max_in_flight = 0
+    signed = []
+
+    def fake_filelist_dict(*args, **kwargs):
+        return {f"path{i}": {"full_path": f"full_path{i}", "formats": formats} for i in range(5)}
+
+    async def fake_sign(_, val, *args, **kwargs):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        signed.append(val)
+        return [val]
+
+    mocker.patch.object(script, "load_autograph_configs", new=noop_sync)
+    mocker.patch.object(script, "setup_apple_notarization_credentials", new=noop_sync)
+    mocker.patch.object(script, "task_signing_formats", return_value=formats)
+    mocker.patch.object(script, "build_filelist_dict", new=fake_filelist_dict)
+    mocker.patch.object(script, "sign", new=fake_sign)
+    mocker.patch.object(script, "copy_to_dir", new=noop_sync)
+    context = mock.MagicMock()
+    context.config = {
+        "work_dir": tmpdir,
+        "artifact_dir": tmpdir,
+        "autograph_configs": {},
+        "apple_notarization_configs": "fake",
+        "signing_concurrency": concurrency,
+    }
+    await script.async_main(context)
+    assert max_in_flight == expected_max
+    assert sorted(signed) == [os.path.join(tmpdir, f"path{i}") for i in range(5)]
+
+
+@pytest.mark.asyncio
+async def test_async_main_sign_failure(tmpdir, mocker):
+    formats = ["autograph_mar"]
+
+    def fake_filelist_dict(*args, **kwargs):
+        return {"path1": {"full_path": "full_path1", "formats": formats}, "path2": {"full_path": "full_path2", "formats": formats}}
+
+    async def fake_sign(_, val, *args, **kwargs):
+        if val.endswith("path2"):
+            raise SigningScriptError("dying!")
+        return [val]
+
+    mocker.patch.object(script, "load_autograph_configs", new=noop_sync)
+    mocker.patch.object(script, "task_signing_formats", return_value=formats)
+    mocker.patch.object(script, "build_filelist_dict", new=fake_filelist_dict)
+    mocker.patch.object(script, "sign", new=fake_sign)
+    mocker.patch.object(script, "copy_to_dir", new=noop_sync)
+    context = mock.MagicMock()
+    context.config = {"work_dir": tmpdir, "artifact_dir": tmpdir, "autograph_configs": {}}
+    with pytest.raises(SigningScriptError):
+        await script.async_main(context)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("staging, linked", ((None, False), ("link", True), ("copy", False)))
+async def test_async_main_artifact_staging(tmp_path, mocker, staging, linked):
+    formats = ["autograph_mar"]
+    upstream = tmp_path / "cot" / "upstream-task" / "path1"
+    upstream.parent.mkdir(parents=True)
+    upstream.write_bytes(b"unsigned")
+
+    async def fake_sign(_, val, *args, **kwargs):
+        return [val]
+
+    mocker.patch.object(script, "load_autograph_configs", new=noop_sync)
+    mocker.patch.object(script, "task_signing_formats", return_value=formats)
+    mocker.patch.object(script, "build_filelist_dict", return_value={"path1": {"full_path": str(upstream), "formats": formats}})
+    mocker.patch.object(script, "sign", new=fake_sign)
+    mocker.patch("signingscript.utils._reflink", return_value=False)
+    context = mock.MagicMock()
+    context.config = {"work_dir": str(tmp_path / "work"), "artifact_dir": str(tmp_path / "artifact"), "autograph_configs": {}}
+    if staging:
+        context.config["artifact_staging"] = staging
+    await script.async_main(context)
+    for staged in (tmp_path / "work" / "path1", tmp_path / "artifact" / "path1"):
+        assert staged.read_bytes() == b"unsigned"
+        assert os.path.samefile(upstream, staged) is linked
+
+
 def test_get_default_config():
     parent_dir = os.path.dirname(os.getcwd())
     c = script.get_default_config()
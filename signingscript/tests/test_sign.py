@@ -1,31 +1,48 @@
 import asyncio
 import base64
+import functools
 import json
 import os
 import os.path
 import re
 import shutil
-import subprocess
 import sys
+import stat
 import tarfile
 import tempfile
+import threading
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from hashlib import file_digest, sha256
 from io import BufferedRandom, BytesIO
 from unittest import mock
 
 import aiohttp
+import aiohttp.test_utils
+import aiohttp.web
+import mohawk
 import pytest
-import winsign.sign
+import winsign.osslsigncode
+from mardor.reader import MarReader
+from mardor.signing import make_rsa_keypair, sign_hash
+from mardor.writer import MarWriter, add_signature_block
 from conftest import BASE_DIR, SERVER_CONFIG_PATH, TEST_CERT_TYPE, TEST_DATA_DIR, die, does_not_raise, noop_async, noop_sync
 from scriptworker.utils import makedirs
 
+import signingscript.authenticode as authenticode
+import signingscript.marfile as marfile
+import signingscript.metrics as metrics
 import signingscript.sign as sign
+import signingscript.task as stask
 import signingscript.utils as utils
+from signingscript.autograph import RequestBatcher
+from signingscript.cache import SigningCache
+from signingscript.compression import get_compression_executor
 from signingscript.exceptions import SigningScriptError
 from signingscript.script import set_up_gpg_keyring
 from signingscript.utils import get_hash
+from test_authenticode import make_pe
 
 # helper constants, fixtures, functions {{{1
 
@@ -63,24 +80,47 @@ def is_tarfile(archive):
     return True
 
 
+def mocked_response(payload=None, exception=None):
+    """Return a mocked aiohttp response with the json `payload`."""
+    resp = mock.MagicMock()
+    resp.status = 200
+    resp.ok = True
+    resp.json.return_value = asyncio.Future()
+
+    async def iter_chunked(n):
+        if exception:
+            raise exception
+        body = json.dumps(payload).encode()
+        for i in range(0, len(body), n):
+            yield body[i : i + n]
+
+    if exception:
+        resp.json.side_effect = exception
+    else:
+        resp.json.return_value.set_result(payload)
+    resp.content.iter_chunked = iter_chunked
+    resp.content_length = len(json.dumps(payload))
+    return resp
+
+
 class MockedSession:
     def __init__(self, signed_file=None, signature=None, exception=None):
         self.signed_file = signed_file
         self.exception = exception
         self.signature = signature
+        self.body = None
         self.post = mock.MagicMock(wraps=self.post)
 
     async def post(self, *args, **kwargs):
-        resp = mock.MagicMock()
-        resp.status = 200
-        resp.json.return_value = asyncio.Future()
+        self.body = b"".join([chunk async for chunk in kwargs["data"]])
+        assert len(self.body) == int(kwargs["headers"]["Content-Length"])
+        payload = None
         if self.signed_file:
-            resp.json.return_value.set_result([{"signed_file": self.signed_file}])
+            payload = [{"signed_file": self.signed_file}]
         if self.signature:
-            resp.json.return_value.set_result([{"signature": self.signature}])
-        if self.exception:
-            resp.json.side_effect = self.exception
-        return resp
+            signature = self.signature.decode() if isinstance(self.signature, bytes) else self.signature
+            payload = [{"signature": signature}]
+        return mocked_response(payload, self.exception)
 
 
 async def assert_file_permissions(archive):
@@ -152,9 +192,15 @@ async def test_sign_file_autograph(context, mocker, to, expected):
         ("to", "to", "autograph_apk_sha1", {"pkcs7_digest": "SHA1", "zip": "passthrough"}),
     ),
 )
-async def test_sign_file_with_autograph(context, mocker, to, expected, format, options):
-    open_mock = mocker.mock_open(read_data=b"0xdeadbeef")
-    mocker.patch("builtins.open", open_mock, create=True)
+async def test_sign_file_with_autograph(context, mocker, tmp_path, to, expected, format, options):
+    from_ = tmp_path / "from"
+    from_.write_bytes(b"0xdeadbeef")
+    from_.chmod(0o755)
+    if to:
+        to = tmp_path / to
+        expected = tmp_path / expected
+    else:
+        expected = from_
 
     mocked_session = MockedSession(signed_file="bW96aWxsYQ==")
     mocker.patch.object(context, "session", new=mocked_session)
@@ -162,15 +208,14 @@ async def test_sign_file_with_autograph(context, mocker, to, expected, format, o
     context.autograph_configs = {
         TEST_CERT_TYPE: [utils.Autograph(*["https://autograph-hsm.dev.mozaws.net", "alice", "fs5wgcer9qj819kfptdlp8gm227ewxnzvsuj9ztycsx08hfhzu", [format]])]
     }
-    assert await sign.sign_file_with_autograph(context, "from", format, to=to) == expected
-    open_mock.assert_called()
+    assert await sign.sign_file_with_autograph(context, from_, format, to=to) == expected
+    assert expected.read_bytes() == b"mozilla"
+    assert stat.S_IMODE(expected.stat().st_mode) == 0o755
     kwargs = {"input": "MHhkZWFkYmVlZg=="}
     if options:
         kwargs["options"] = options
     mocked_session.post.assert_called_with("https://autograph-hsm.dev.mozaws.net/sign/file", headers=mocker.ANY, data=mocker.ANY)
-    data = mocked_session.post.call_args[1]["data"]
-    data.seek(0)
-    assert json.load(data) == [kwargs]
+    assert json.loads(mocked_session.body) == [kwargs]
 
 
 @pytest.mark.asyncio
@@ -191,9 +236,9 @@ async def test_sign_file_with_autograph_no_suitable_servers_errors(context, mock
 
 @pytest.mark.asyncio
 @pytest.mark.parametrize("to,expected", ((None, "from"), ("to", "to")))
-async def test_sign_file_with_autograph_raises_http_error(context, mocker, to, expected):
-    open_mock = mocker.mock_open(read_data=b"0xdeadbeef")
-    mocker.patch("builtins.open", open_mock, create=True)
+async def test_sign_file_with_autograph_raises_http_error(context, mocker, tmp_path, to, expected):
+    from_ = tmp_path / "from"
+    from_.write_bytes(b"0xdeadbeef")
 
     mocked_session = MockedSession(signed_file="bW96aWxsYQ==", exception=aiohttp.ClientError)
     mocker.patch.object(context, "session", new=mocked_session)
@@ -205,8 +250,55 @@ async def test_sign_file_with_autograph_raises_http_error(context, mocker, to, e
         ]
     }
     with pytest.raises(aiohttp.ClientError):
-        await sign.sign_file_with_autograph(context, "from", "autograph_mar", to=to)
-    open_mock.assert_called()
+        await sign.sign_file_with_autograph(context, from_, "autograph_mar", to=to)
+    assert from_.read_bytes() == b"0xdeadbeef"
+
+
+# AutographResponseDecoder {{{1
+@pytest.mark.parametrize("chunk_size", (1, 3, 1024))
+def test_autograph_response_decoder(tmp_path, chunk_size):
+    signed = os.urandom(1000)
+    encoded = base64.b64encode(signed).decode()
+    response = [
+        {
+            "ref": 'some"ref',
+            "signed_file": encoded,
+            "signed_files": [{"name": "a", "content": encoded[:400]}, {"name": "b", "content": encoded[400:].replace("/", "\\/")}],
+            "signature": "c2ln",
+        }
+    ]
+    body = json.dumps(response, indent=1).replace("\\\\/", "\\/").encode()
+    decoder = sign.AutographResponseDecoder(tmp_path)
+    for i in range(0, len(body), chunk_size):
+        decoder.feed(body[i : i + chunk_size])
+    result = decoder.result()
+    assert result[0]["ref"] == 'some"ref'
+    assert result[0]["signature"] == "c2ln"
+    with open(result[0]["signed_file"], "rb") as f:
+        assert f.read() == signed
+    assert [f["name"] for f in result[0]["signed_files"]] == ["a", "b"]
+    with open(result[0]["signed_files"][0]["content"], "rb") as f:
+        assert f.read() == base64.b64decode(encoded[:400])
+    with open(result[0]["signed_files"][1]["content"], "rb") as f:
+        assert f.read() == base64.b64decode(encoded[400:])
+    assert len(decoder.paths) == 3
+
+
+@pytest.mark.parametrize(
+    "body",
+    (
+        b'[{"signed_file": "Zm9v',
+        b'[{"signed_file": "Zm9"}]',
+        b'[{"signed_file": "Zm9v"}',
+    ),
+)
+def test_autograph_response_decoder_bad_response(tmp_path, body):
+    decoder = sign.AutographResponseDecoder(tmp_path)
+    with pytest.raises(SigningScriptError):
+        decoder.feed(body)
+        decoder.result()
+    decoder.cleanup()
+    assert os.listdir(tmp_path) == []
 
 
 # sign_file_detached {{{1
@@ -238,8 +330,7 @@ async def test_sign_file_detached(context, mocker):
     assert result == [path, f"{path}.sig"]
 
     mocked_session.post.assert_called_with("https://autograph-hsm.dev.mozaws.net/sign/hash", headers=mocker.ANY, data=mocker.ANY)
-    called_with_data = mocked_session.post.call_args[1]["data"]
-    assert json.loads(called_with_data.read())[0]["input"] == expected_hash
+    assert json.loads(mocked_session.body)[0]["input"] == expected_hash
 
     open_mock.assert_called_with(f"{path}.sig", "wb")
     fh_mock = open_mock.return_value.__enter__.return_value
@@ -267,41 +358,54 @@ def test_get_mar_verification_key(format, cert_type, keyid, raises, expected):
 
 
 # verify_mar_signature {{{1
-@pytest.mark.parametrize("raises", (True, False))
-def test_verify_mar_signature(mocker, raises):
-    def fake_check_call(*args, **kwargs):
-        if raises:
-            raise subprocess.CalledProcessError("x", "foo")
-
-    mocker.patch.object(subprocess, "check_call", new=fake_check_call)
-    if raises:
-        with pytest.raises(SigningScriptError):
-            sign.verify_mar_signature("dep-signing", "autograph_stage_mar384", "foo")
+@pytest.mark.parametrize("valid", (True, False))
+def test_verify_mar_signature(mocker, valid):
+    verify = mocker.patch("signingscript.marfile.verify_signature", return_value=valid)
+    if valid:
+        sign.verify_mar_signature("dep-signing", "autograph_stage_mar384", b"sig", b"hash", "sha384")
     else:
-        sign.verify_mar_signature("dep-signing", "autograph_stage_mar384", "foo")
+        with pytest.raises(SigningScriptError):
+            sign.verify_mar_signature("dep-signing", "autograph_stage_mar384", b"sig", b"hash", "sha384")
+    with open(os.path.join(INSTALL_DIR, "data", "autograph_stage.pem"), "rb") as f:
+        verify.assert_called_once_with(f.read(), b"sig", b"hash", "sha384")
 
 
 # sign_mar384_with_autograph_hash {{{1
+def make_mar(path, channel="firefox-mozilla-central"):
+    """Write a MAR with a couple of files to `path`."""
+    src = os.path.join(os.path.dirname(path), "mar-src")
+    makedirs(src)
+    for name in ("a", "b"):
+        with open(os.path.join(src, name), "wb") as f:
+            f.write(os.urandom(1000))
+    with open(path, "w+b") as f, MarWriter(f, productversion="149.0a1", channel=channel) as m:
+        for name in ("a", "b"):
+            m.add(os.path.join(src, name))
+    return path
+
+
+@pytest.fixture
+def mar_dir(tmp_path):
+    path = tmp_path / "mar"
+    path.mkdir()
+    return path
+
+
+def read_mar(path):
+    with MarReader(open(path, "rb")) as m:
+        return m.productinfo, m.mardata.signatures, [(e.name, e.size) for e in m.mardata.index.entries]
+
+
 @pytest.mark.asyncio
-@pytest.mark.parametrize("to,expected", ((None, "from"), ("to", "to")))
-async def test_sign_mar384_with_autograph_hash(context, mocker, to, expected):
-    open_mock = mocker.mock_open(read_data=b"0xdeadbeef")
-    mocker.patch("builtins.open", open_mock, create=True)
+@pytest.mark.parametrize("to", (None, "to.mar"))
+async def test_sign_mar384_with_autograph_hash(context, mocker, mar_dir, to):
+    from_ = make_mar(str(mar_dir / "from.mar"))
+    to = to and str(mar_dir / to)
+    orig = read_mar(from_)
 
     mocked_session = MockedSession(signature=base64.b64encode(b"0" * 512))
     mocker.patch.object(context, "session", new=mocked_session)
-
-    add_signature_mock = mocker.Mock()
-    mocker.patch("signingscript.sign.add_signature_block", add_signature_mock, create=True)
-
-    m_mock = mocker.MagicMock()
-    m_mock.calculate_hashes.return_value = [[None, b"b64marhash"]]
-    m_mock.productinfo = ("149.0a1", "firefox-mozilla-central")
-    MarReader_mock = mocker.Mock()
-    MarReader_mock.return_value.__enter__ = mocker.Mock(return_value=m_mock)
-    MarReader_mock.return_value.__exit__ = mocker.Mock(return_value=None)
-    mocker.patch("signingscript.sign.MarReader", MarReader_mock, create=True)
-    mocker.patch("signingscript.sign.verify_mar_signature")
+    verify = mocker.patch("signingscript.sign.verify_mar_signature")
 
     context.autograph_configs = {
         TEST_CERT_TYPE: [
@@ -310,17 +414,79 @@ async def test_sign_mar384_with_autograph_hash(context, mocker, to, expected):
             )
         ]
     }
-    assert await sign.sign_mar384_with_autograph_hash(context, "from", "autograph_hash_only_mar384", to=to) == expected
-    open_mock.assert_called()
-    add_signature_mock.assert_called()
-    MarReader_mock.assert_called()
-    m_mock.calculate_hashes.assert_called()
+    assert await sign.sign_mar384_with_autograph_hash(context, from_, "autograph_hash_only_mar384", to=to) == (to or from_)
+    productinfo, sigs, entries = read_mar(to or from_)
+    assert (productinfo, entries) == (orig[0], orig[2])
+    assert [(s.algorithm_id, s.signature) for s in sigs.sigs] == [(2, b"0" * 512)]
+    with MarReader(open(to or from_, "rb")) as m:
+        h = m.calculate_hashes()[0][1]
+    verify.assert_called_once_with(TEST_CERT_TYPE, "autograph_hash_only_mar384", b"0" * 512, h, "sha384", None)
     mocked_session.post.assert_called_with("https://autograph-hsm.dev.mozaws.net/sign/hash", headers=mocker.ANY, data=mocker.ANY)
-    assert json.load(mocked_session.post.call_args[1]["data"]) == [{"input": "YjY0bWFyaGFzaA=="}]
+    assert json.loads(mocked_session.body) == [{"input": base64.b64encode(h).decode()}]
+    assert sorted(os.listdir(mar_dir)) == sorted(["from.mar", "mar-src"] + ([os.path.basename(to)] if to else []))
 
 
 @pytest.mark.asyncio
-async def test_sign_mar384_with_autograph_hash_keyid(context, mocker):
+async def test_sign_mar384_with_autograph_hash_verifies(context, mocker, mar_dir):
+    private_key, public_key = make_rsa_keypair(4096)
+    key_path = mar_dir / "key.pem"
+    key_path.write_bytes(public_key)
+    from_ = make_mar(str(mar_dir / "from.mar"))
+
+    async def fake_sign_hash(context, h, fmt, keyid):
+        return sign_hash(private_key, h, "sha384")
+
+    mocker.patch("signingscript.sign.sign_hash_with_autograph", fake_sign_hash)
+    mocker.patch("signingscript.sign.get_mar_verification_key", return_value=str(key_path))
+    context.autograph_configs = {TEST_CERT_TYPE: [utils.Autograph("https://autograph", "alice", "secret", ["autograph_hash_only_mar384"])]}
+
+    assert await sign.sign_mar384_with_autograph_hash(context, from_, "autograph_hash_only_mar384") == from_
+    with MarReader(open(from_, "rb")) as m:
+        assert m.verify(public_key)
+
+    # Resigning replaces the existing signature
+    assert await sign.sign_mar384_with_autograph_hash(context, from_, "autograph_hash_only_mar384") == from_
+    with MarReader(open(from_, "rb")) as m:
+        assert len(m.mardata.signatures.sigs) == 1
+        assert m.verify(public_key)
+
+    # A signature from another key doesn't verify, and leaves the mar alone
+    other_key, _ = make_rsa_keypair(4096)
+    orig = open(from_, "rb").read()
+
+    async def bad_sign_hash(context, h, fmt, keyid):
+        return sign_hash(other_key, h, "sha384")
+
+    mocker.patch("signingscript.sign.sign_hash_with_autograph", bad_sign_hash)
+    with pytest.raises(SigningScriptError):
+        await sign.sign_mar384_with_autograph_hash(context, from_, "autograph_hash_only_mar384")
+    assert open(from_, "rb").read() == orig
+    assert sorted(os.listdir(mar_dir)) == ["from.mar", "key.pem", "mar-src"]
+
+
+@pytest.mark.parametrize("hash_algo", ("sha1", "sha384"))
+def test_write_unsigned_mar_matches_mardor(mar_dir, hash_algo):
+    from_ = make_mar(str(mar_dir / "from.mar"))
+    expected = mar_dir / "expected.mar"
+    with open(from_, "rb") as src, open(expected, "w+b") as dest:
+        add_signature_block(src, dest, hash_algo)
+    with MarReader(open(expected, "rb")) as m:
+        expected_hash = m.calculate_hashes()[0][1]
+
+    to = str(mar_dir / "to.mar")
+    assert marfile.write_unsigned_mar(from_, to, hash_algo) == (("149.0a1", "firefox-mozilla-central"), expected_hash)
+    assert open(to, "rb").read() == expected.read_bytes()
+
+
+def test_write_unsigned_mar_bad_mar(mar_dir):
+    from_ = mar_dir / "from.mar"
+    from_.write_bytes(b"not a mar")
+    with pytest.raises(SigningScriptError):
+        marfile.write_unsigned_mar(str(from_), str(mar_dir / "to.mar"), "sha384")
+
+
+@pytest.mark.asyncio
+async def test_sign_mar384_with_autograph_hash_keyid(context, mocker, mar_dir):
     context.autograph_configs = {
         TEST_CERT_TYPE: [
             utils.Autograph(
@@ -332,13 +498,8 @@ async def test_sign_mar384_with_autograph_hash_keyid(context, mocker):
             )
         ]
     }
-
-    open_mock = mocker.mock_open(read_data=b"0xdeadbeef")
-    mocker.patch("builtins.open", open_mock, create=True)
-    mocker.patch("signingscript.sign.add_signature_block")
-    mar_reader = mocker.patch("signingscript.sign.MarReader")
-    mar_reader.calculate_hashes.return_value = [[None, b"b64marhash"]]
-    mocker.patch("signingscript.sign.verify_mar_signature")
+    from_ = make_mar(str(mar_dir / "from.mar"))
+    verify = mocker.patch("signingscript.sign.verify_mar_signature")
 
     async def fake_sign_hash(context, h, fmt, keyid):
         return b"#" * 512
@@ -346,8 +507,9 @@ async def test_sign_mar384_with_autograph_hash_keyid(context, mocker):
     fake_sign_hash = mock.MagicMock(wraps=fake_sign_hash)
     mocker.patch("signingscript.sign.sign_hash_with_autograph", fake_sign_hash)
 
-    assert await sign.sign_mar384_with_autograph_hash(context, "from", "autograph_hash_only_mar384:keyid1") == "from"
+    assert await sign.sign_mar384_with_autograph_hash(context, from_, "autograph_hash_only_mar384:keyid1") == from_
     fake_sign_hash.assert_called_with(mocker.ANY, mocker.ANY, "autograph_hash_only_mar384", "keyid1")
+    verify.assert_called_with(mocker.ANY, mocker.ANY, mocker.ANY, mocker.ANY, mocker.ANY, "keyid1")
 
 
 @pytest.mark.asyncio
@@ -367,24 +529,14 @@ async def test_sign_mar384_with_autograph_hash_no_suitable_servers_errors(contex
 
 
 @pytest.mark.asyncio
-@pytest.mark.parametrize("to,expected", ((None, "from"), ("to", "to")))
-async def test_sign_mar384_with_autograph_hash_returns_invalid_signature_length(context, mocker, to, expected):
-    open_mock = mocker.mock_open(read_data=b"0xdeadbeef")
-    mocker.patch("builtins.open", open_mock, create=True)
+@pytest.mark.parametrize("to", (None, "to.mar"))
+async def test_sign_mar384_with_autograph_hash_returns_invalid_signature_length(context, mocker, mar_dir, to):
+    from_ = make_mar(str(mar_dir / "from.mar"))
+    orig = open(from_, "rb").read()
 
     mocked_session = MockedSession(signature=base64.b64encode(b"0"))
     mocker.patch.object(context, "session", new=mocked_session)
 
-    add_signature_mock = mocker.Mock()
-    mocker.patch("signingscript.sign.add_signature_block", add_signature_mock, create=True)
-
-    m_mock = mocker.MagicMock()
-    m_mock.calculate_hashes.return_value = [[None, b"b64marhash"]]
-    MarReader_mock = mocker.Mock()
-    MarReader_mock.return_value.__enter__ = mocker.Mock(return_value=m_mock)
-    MarReader_mock.return_value.__exit__ = mocker.Mock(return_value=None)
-    mocker.patch("signingscript.sign.MarReader", MarReader_mock, create=True)
-
     context.autograph_configs = {
         TEST_CERT_TYPE: [
             utils.Autograph(
@@ -393,35 +545,22 @@ async def test_sign_mar384_with_autograph_hash_returns_invalid_signature_length(
         ]
     }
     with pytest.raises(SigningScriptError):
-        assert await sign.sign_mar384_with_autograph_hash(context, "from", "autograph_hash_only_mar384", to=to) == expected
+        await sign.sign_mar384_with_autograph_hash(context, from_, "autograph_hash_only_mar384", to=to and str(mar_dir / to))
 
-    open_mock.assert_called()
-    add_signature_mock.assert_called()
-    MarReader_mock.assert_called()
-    m_mock.calculate_hashes.assert_called()
     mocked_session.post.assert_called_with("https://autograph-hsm.dev.mozaws.net/sign/hash", headers=mocker.ANY, data=mocker.ANY)
-    assert json.load(mocked_session.post.call_args[1]["data"]) == [{"input": "YjY0bWFyaGFzaA=="}]
+    assert open(from_, "rb").read() == orig
+    assert sorted(os.listdir(mar_dir)) == ["from.mar", "mar-src"]
 
 
 @pytest.mark.asyncio
-@pytest.mark.parametrize("channel,raises", (("firefox-mozilla-central", False), ("firefox-nightly-pine", False), ("firefox-mozilla-beta", True), ("firefox-mozilla-release", True)))
-async def test_sign_mar384_with_autograph_hash_channel(context, mocker, channel, raises):
-    open_mock = mocker.mock_open(read_data=b"0xdeadbeef")
-    mocker.patch("builtins.open", open_mock, create=True)
+@pytest.mark.parametrize(
+    "channel,raises", (("firefox-mozilla-central", False), ("firefox-nightly-pine", False), ("firefox-mozilla-beta", True), ("firefox-mozilla-release", True))
+)
+async def test_sign_mar384_with_autograph_hash_channel(context, mocker, mar_dir, channel, raises):
+    from_ = make_mar(str(mar_dir / "from.mar"), channel=channel)
 
     mocked_session = MockedSession(signature=base64.b64encode(b"0" * 512))
     mocker.patch.object(context, "session", new=mocked_session)
-
-    add_signature_mock = mocker.Mock()
-    mocker.patch("signingscript.sign.add_signature_block", add_signature_mock, create=True)
-
-    m_mock = mocker.MagicMock()
-    m_mock.calculate_hashes.return_value = [[None, b"b64marhash"]]
-    m_mock.productinfo = ("149.0a1", channel)
-    MarReader_mock = mocker.Mock()
-    MarReader_mock.return_value.__enter__ = mocker.Mock(return_value=m_mock)
-    MarReader_mock.return_value.__exit__ = mocker.Mock(return_value=None)
-    mocker.patch("signingscript.sign.MarReader", MarReader_mock, create=True)
     mocker.patch("signingscript.sign.verify_mar_signature")
 
     context.autograph_configs = {
@@ -437,9 +576,10 @@ async def test_sign_mar384_with_autograph_hash_channel(context, mocker, channel,
 
     if raises:
         with pytest.raises(SigningScriptError):
-            await sign.sign_mar384_with_autograph_hash(context, "from", "autograph_hash_only_mar384")
+            await sign.sign_mar384_with_autograph_hash(context, from_, "autograph_hash_only_mar384")
+        mocked_session.post.assert_not_called()
     else:
-        assert await sign.sign_mar384_with_autograph_hash(context, "from", "autograph_hash_only_mar384") == "from"
+        assert await sign.sign_mar384_with_autograph_hash(context, from_, "autograph_hash_only_mar384") == from_
 
 
 # sign_macapp {{{1
@@ -557,7 +697,6 @@ async def test_sign_widevine(context, mocker, filename, fmt, raises, should_sign
     def fake_isfile(path):
         return "isdir" not in path
 
-    mocker.patch.object(sign, "_get_tarfile_files", new=fake_filelist)
     mocker.patch.object(sign, "_extract_tarfile", new=fake_untar)
     mocker.patch.object(sign, "_get_zipfile_files", new=fake_filelist)
     mocker.patch.object(sign, "_extract_zipfile", new=fake_unzip)
@@ -567,7 +706,7 @@ async def test_sign_widevine(context, mocker, filename, fmt, raises, should_sign
     mocker.patch.object(sign, "makedirs", new=noop_sync)
     mocker.patch.object(sign, "generate_precomplete", new=noop_sync)
     mocker.patch.object(sign, "_create_tarfile", new=noop_async)
-    mocker.patch.object(sign, "_create_zipfile", new=noop_async)
+    mocker.patch.object(sign, "_update_zipfile", new=noop_async)
     mocker.patch.object(sign, "_run_generate_precomplete", new=noop_sync)
     mocker.patch.object(os.path, "isfile", new=fake_isfile)
 
@@ -578,6 +717,136 @@ async def test_sign_widevine(context, mocker, filename, fmt, raises, should_sign
         await sign.sign_widevine(context, filename, fmt)
 
 
+@pytest.mark.asyncio
+@pytest.mark.parametrize("compression", ("gz", "bz2", "xz"))
+async def test_sign_widevine_tar_decompresses_once(context, mocker, tmp_path, compression):
+    src = tmp_path / "src"
+    (src / "firefox").mkdir(parents=True)
+    (src / "firefox" / "firefox").write_bytes(b"firefox")
+    (src / "firefox" / "omni.ja").write_bytes(b"omni")
+    orig_path = str(tmp_path / f"target.tar.{compression}")
+    with tarfile.open(orig_path, mode=f"w:{compression}") as t:
+        t.add(src / "firefox", arcname="firefox")
+    signed = []
+
+    async def fake_sign(context, from_, blessed, fmt, to=None):
+        signed.append(os.path.basename(from_))
+        with open(to, "wb") as f:
+            f.write(b"sig")
+
+    mocker.patch.object(sign, "sign_widevine_with_autograph", new=fake_sign)
+    mocker.patch.object(sign, "_run_generate_precomplete", new=noop_sync)
+    mocker.patch.object(sign, "_create_tarfile", new=noop_async)
+    tarfile_open = mocker.spy(tarfile, "open")
+    assert await sign.sign_widevine_tar(context, orig_path, "autograph_widevine") == orig_path
+    assert signed == ["firefox"]
+    assert tarfile_open.call_count == 1
+    assert tarfile_open.call_args.kwargs["mode"] == "r|"
+
+
+# ArchiveSession {{{1
+@pytest.mark.asyncio
+@pytest.mark.parametrize("filename", ("target.tar.gz", "target.zip"))
+async def test_archive_shared_by_formats(context, mocker, tmp_path, filename):
+    src = tmp_path / "src"
+    (src / "firefox").mkdir(parents=True)
+    (src / "firefox" / "firefox").write_bytes(b"firefox")
+    (src / "firefox" / "omni.ja").write_bytes(b"omni")
+    (src / "firefox" / "precomplete").write_text('remove "firefox"\n')
+    orig_path = os.path.join(context.config["work_dir"], filename)
+    if filename.endswith(".zip"):
+        with zipfile.ZipFile(orig_path, "w") as z:
+            for name in ("firefox", "omni.ja", "precomplete"):
+                z.write(src / "firefox" / name, arcname=f"firefox/{name}")
+    else:
+        with tarfile.open(orig_path, mode="w:gz") as t:
+            t.add(src / "firefox", arcname="firefox")
+
+    async def fake_widevine(context, from_, blessed, fmt, to=None):
+        with open(to, "wb") as f:
+            f.write(b"sig")
+
+    async def fake_omnija(context, from_, fmt):
+        with open(from_, "wb") as f:
+            f.write(b"signed omni")
+
+    mocker.patch.object(sign, "sign_widevine_with_autograph", new=fake_widevine)
+    mocker.patch.object(sign, "sign_omnija_with_autograph", new=fake_omnija)
+    extract_zipfile = mocker.spy(sign, "_extract_zipfile_sync")
+    extract_tarfile = mocker.spy(sign, "_extract_tarfile_sync")
+    update_zipfile = mocker.spy(sign, "update_zipfile")
+    create_tarfile = mocker.spy(sign, "_create_tarfile")
+    generate_precomplete = mocker.spy(sign, "generate_precomplete")
+
+    assert await stask.sign(context, orig_path, ["autograph_widevine", "autograph_omnija"]) == [orig_path]
+
+    assert update_zipfile.call_count + create_tarfile.call_count == 1
+    assert generate_precomplete.call_count == 1
+    if filename.endswith(".zip"):
+        # Only the members that are needed are extracted, each of them once
+        extracted = [name for call in extract_zipfile.call_args_list for name in call.args[1]]
+        assert sorted(extracted) == ["firefox/firefox", "firefox/omni.ja", "firefox/precomplete"]
+    else:
+        assert extract_tarfile.call_count == 1
+    if filename.endswith(".zip"):
+        with zipfile.ZipFile(orig_path) as z:
+            contents = {name: z.read(name) for name in z.namelist()}
+    else:
+        with tarfile.open(orig_path) as t:
+            contents = {m.name: t.extractfile(m).read() for m in t.getmembers() if m.isfile()}
+    assert contents["firefox/firefox.sig"] == b"sig"
+    assert contents["firefox/omni.ja"] == b"signed omni"
+    assert b"firefox.sig" in contents["firefox/precomplete"]
+
+
+@pytest.mark.asyncio
+async def test_archive_session_zip_replaced_atomically(context, tmp_path):
+    path = os.path.join(context.config["work_dir"], "target.zip")
+    with zipfile.ZipFile(path, "w") as z:
+        z.writestr("firefox/omni.ja", b"unsigned omni.ja " * 100, compress_type=zipfile.ZIP_STORED)
+        z.writestr("firefox/firefox", b"firefox")
+    inode = os.stat(path).st_ino
+    archive = sign.ArchiveSession(context)
+    await archive.open(path)
+    (local,) = await archive.extract(["firefox/omni.ja"])
+    with open(local, "wb") as f:
+        f.write(b"signed")
+    archive.changed([local])
+    await archive.close()
+    # The zip was written to a new file and renamed into place, and none of
+    # the replaced member's data was left behind in it
+    assert os.stat(path).st_ino != inode
+    with open(path, "rb") as f:
+        assert b"unsigned omni.ja" not in f.read()
+    with zipfile.ZipFile(path) as z:
+        assert z.testzip() is None
+        assert z.read("firefox/omni.ja") == b"signed"
+        assert z.read("firefox/firefox") == b"firefox"
+
+
+@pytest.mark.asyncio
+async def test_archive_session_reopen(context, mocker, tmp_path):
+    paths = []
+    for name in ("a.zip", "b.zip"):
+        paths.append(os.path.join(context.config["work_dir"], name))
+        with zipfile.ZipFile(paths[-1], "w") as z:
+            z.writestr("omni.ja", b"omni")
+    update_zipfile = mocker.spy(sign, "update_zipfile")
+    archive = sign.ArchiveSession(context)
+    for path in paths:
+        await archive.open(path)
+        (local,) = await archive.extract(["omni.ja"])
+        with open(local, "wb") as f:
+            f.write(b"signed " + os.path.basename(path).encode())
+        archive.changed([local])
+    assert [call.args[0] for call in update_zipfile.call_args_list] == paths[:1]
+    assert await archive.close() == paths[1]
+    assert await archive.close() is None
+    for path in paths:
+        with zipfile.ZipFile(path) as z:
+            assert z.read("omni.ja") == b"signed " + os.path.basename(path).encode()
+
+
 # _should_sign_windows {{{1
 @pytest.mark.parametrize(
     "filenames,expected", ((("firefox", "libclearkey.dylib", "D3DCompiler_42.dll", "msvcblah.dll"), False), (("firefox.dll", "foo.exe"), True))
@@ -604,6 +873,72 @@ def test_run_generate_precomplete(context, num_precomplete, raises, mocker):
         sign._run_generate_precomplete(context, work_dir)
 
 
+@pytest.mark.parametrize(
+    "archive_path,diff_name",
+    (
+        (None, "precomplete.diff"),
+        ("public/build/de/target.tar.gz", "precomplete-public_build_de_target.tar.gz.diff"),
+        ("/elsewhere/target.zip", "precomplete-target.zip.diff"),
+    ),
+)
+def test_run_generate_precomplete_diff_name(context, tmp_path, archive_path, diff_name):
+    work_dir = context.config["work_dir"]
+    (tmp_path / "firefox").mkdir()
+    (tmp_path / "firefox" / "precomplete").write_text('remove "firefox"\n')
+    (tmp_path / "firefox" / "firefox").write_text("firefox")
+    if archive_path and not os.path.isabs(archive_path):
+        archive_path = os.path.join(work_dir, archive_path)
+    sign._run_generate_precomplete(context, str(tmp_path), archive_path=archive_path)
+    assert os.listdir(os.path.join(context.config["artifact_dir"], "public", "logs")) == [diff_name]
+    with open(os.path.join(context.config["artifact_dir"], "public", "logs", diff_name)) as fh:
+        assert '  remove "firefox"\n' in fh.read()
+
+
+@pytest.mark.parametrize(
+    "names",
+    (
+        (
+            "firefox/",
+            "firefox/precomplete",
+            "firefox/firefox",
+            "firefox/firefox.sig",
+            "firefox/defaults/pref/channel-prefs.js",
+            "firefox/distribution/policies.json",
+            "firefox/fonts/",
+            "firefox/browser/features/a.xpi",
+        ),
+        (
+            "Firefox.app/Contents/MacOS/firefox",
+            "Firefox.app/Contents/Resources/precomplete",
+            "Firefox.app/Contents/Resources/update-settings.ini",
+            "Firefox.app/Contents/Frameworks/ChannelPrefs.framework/ChannelPrefs",
+            "Firefox.app/Contents/Resources/browser/omni.ja",
+        ),
+    ),
+)
+def test_run_generate_precomplete_from_names(context, tmp_path, names):
+    walked = tmp_path / "walked"
+    listed = tmp_path / "listed"
+    for name in names:
+        (walked / name).parent.mkdir(parents=True, exist_ok=True)
+        if name.endswith("/"):
+            (walked / name).mkdir(exist_ok=True)
+        else:
+            (walked / name).write_text("old")
+        if name.endswith("precomplete"):
+            (listed / name).parent.mkdir(parents=True)
+            (listed / name).write_text("old")
+
+    walked_path = sign._run_generate_precomplete(context, str(walked))
+    listed_path = sign._run_generate_precomplete(context, str(listed), names=names)
+
+    assert os.path.relpath(listed_path, listed) == os.path.relpath(walked_path, walked)
+    with open(walked_path) as walked_fh, open(listed_path) as listed_fh:
+        assert listed_fh.read() == walked_fh.read()
+    # Only `precomplete` was extracted, and nothing else was written
+    assert [os.path.relpath(os.path.join(root, f), listed) for root, _, files in os.walk(listed) for f in files] == [os.path.relpath(listed_path, listed)]
+
+
 # remove_extra_files {{{1
 def test_remove_extra_files(context):
     extra = ["a", "b/c"]
@@ -630,27 +965,68 @@ def test_remove_extra_files(context):
 
 # _convert_dmg_to_tar_gz {{{1
 @pytest.mark.asyncio
-async def test_convert_dmg_to_tar_gz(context, monkeypatch, tmpdir):
+@pytest.mark.parametrize("workers", (None, 4))
+async def test_convert_dmg_to_tar_gz(context, monkeypatch, tmpdir, workers):
     dmg_path = "path/to/foo.dmg"
     abs_dmg_path = os.path.join(context.config["work_dir"], dmg_path)
     tarball_path = "path/to/foo.tar.gz"
     abs_tarball_path = os.path.join(context.config["work_dir"], tarball_path)
+    os.makedirs(os.path.dirname(abs_tarball_path))
+    if workers:
+        context.config["compression_workers"] = workers
+    temp_dir = os.path.join(tmpdir, "dmg")
+    os.mkdir(temp_dir)
+    app_dir = os.path.join(temp_dir, "app")
+    commands = []
 
     async def execute_subprocess_mock(command, **kwargs):
-        assert command in (
-            ["dmg", "extract", abs_dmg_path, "tmp.hfs"],
-            ["hfsplus", "tmp.hfs", "extractall", "/", "{}/app".format(tmpdir)],
-            ["tar", "czf", abs_tarball_path, "."],
-        )
+        commands.append(command)
+        if command[0] == "dmg":
+            open(os.path.join(temp_dir, "tmp.hfs"), "wb").close()
+        else:
+            assert os.path.exists(os.path.join(temp_dir, "tmp.hfs"))
+            os.makedirs(os.path.join(app_dir, "Foo.app", "Contents", "MacOS"))
+            with open(os.path.join(app_dir, "Foo.app", "Contents", "MacOS", "foo"), "w") as fh:
+                fh.write("foo")
+            os.symlink("MacOS/foo", os.path.join(app_dir, "Foo.app", "Contents", "link"))
 
     @contextmanager
     def fake_tmpdir():
-        yield tmpdir
+        yield temp_dir
 
     monkeypatch.setattr("signingscript.utils.execute_subprocess", execute_subprocess_mock)
     monkeypatch.setattr("tempfile.TemporaryDirectory", fake_tmpdir)
 
-    await sign._convert_dmg_to_tar_gz(context, dmg_path)
+    assert await sign._convert_dmg_to_tar_gz(context, dmg_path) == tarball_path
+    assert commands == [
+        ["dmg", "extract", abs_dmg_path, "tmp.hfs"],
+        ["hfsplus", "tmp.hfs", "extractall", "/", app_dir],
+    ]
+    assert not os.path.exists(os.path.join(temp_dir, "tmp.hfs"))
+    if not workers:
+        # By default the tarball is a single gzip stream, which stream readers can read
+        with tarfile.open(abs_tarball_path, "r|gz") as t:
+            assert [m.name for m in t] == [
+                ".",
+                "./Foo.app",
+                "./Foo.app/Contents",
+                "./Foo.app/Contents/MacOS",
+                "./Foo.app/Contents/MacOS/foo",
+                "./Foo.app/Contents/link",
+            ]
+    with tarfile.open(abs_tarball_path, "r:gz") as t:
+        members = {m.name: m for m in t.getmembers()}
+        assert sorted(members) == [
+            ".",
+            "./Foo.app",
+            "./Foo.app/Contents",
+            "./Foo.app/Contents/MacOS",
+            "./Foo.app/Contents/MacOS/foo",
+            "./Foo.app/Contents/link",
+        ]
+        assert t.extractfile("./Foo.app/Contents/MacOS/foo").read() == b"foo"
+        assert members["./Foo.app/Contents/link"].issym()
+        assert all(m.uid == 0 and m.gid == 0 for m in members.values())
 
 
 # _extract_zipfile _create_zipfile {{{1
@@ -670,6 +1046,19 @@ async def test_working_zipfile(context):
         assert os.path.exists(f)
 
 
+@pytest.mark.asyncio
+async def test_zipfile_runs_in_executor(context, tmp_path):
+    threads = set()
+
+    def record_thread(*args):
+        threads.add(threading.current_thread().name)
+
+    with ThreadPoolExecutor(1, thread_name_prefix="test-executor", initializer=record_thread) as executor:
+        context.executor = executor
+        await helper_archive(context, "foo.zip", sign._create_zipfile, sign._extract_zipfile)
+    assert threads == {"test-executor_0"}
+
+
 @pytest.mark.asyncio
 async def test_bad_create_zipfile(context, mocker):
     mocker.patch.object(zipfile, "ZipFile", new=context_die)
@@ -677,6 +1066,27 @@ async def test_bad_create_zipfile(context, mocker):
         await sign._create_zipfile(context, "foo.zip", [])
 
 
+@pytest.mark.asyncio
+async def test_update_zipfile(context, tmp_path):
+    to = tmp_path / "foo.zip"
+    shutil.copyfile(os.path.join(TEST_DATA_DIR, "test.zip"), to)
+    (tmp_path / "c").mkdir()
+    (tmp_path / "c" / "d").write_bytes(b"new d")
+    (tmp_path / "g").write_bytes(b"new g")
+    assert await sign._update_zipfile(context, to, [tmp_path / "c" / "d", tmp_path / "g"], tmp_dir=tmp_path) == to
+    with zipfile.ZipFile(to) as z:
+        assert z.namelist() == ["a", "b", "c/", "c/d", "c/e/", "c/e/f", "g"]
+        assert z.read("c/d") == b"new d"
+        assert z.read("g") == b"new g"
+
+
+@pytest.mark.asyncio
+async def test_bad_update_zipfile(context, mocker):
+    mocker.patch.object(sign, "update_zipfile", new=die)
+    with pytest.raises(SigningScriptError):
+        await sign._update_zipfile(context, "foo.zip", [])
+
+
 @pytest.mark.asyncio
 async def test_bad_extract_zipfile(context, mocker):
     mocker.patch.object(sign, "rm", new=die)
@@ -704,19 +1114,6 @@ async def test_zipfile_append_write(context):
 
 
 # tarfile {{{1
-@pytest.mark.asyncio
-@pytest.mark.parametrize(
-    "path,compression",
-    (
-        (os.path.join(TEST_DATA_DIR, "test.tar.bz2"), "bz2"),
-        (os.path.join(TEST_DATA_DIR, "test.tar.gz"), "gz"),
-        (os.path.join(TEST_DATA_DIR, "test.tar.xz"), "xz"),
-    ),
-)
-async def test_get_tarfile_files(path, compression):
-    assert sorted(await sign._get_tarfile_files(path, compression)) == ["./a", "./b", "./c/d", "./c/e/f"]
-
-
 @pytest.mark.parametrize(
     "compression,expected,raises",
     (
@@ -739,6 +1136,61 @@ async def test_working_tarfile(context):
     await helper_archive(context, "foo.tar.gz", sign._create_tarfile, sign._extract_tarfile, "gz")
 
 
+@pytest.mark.asyncio
+@pytest.mark.parametrize("compression", ("gz", "bz2", "xz"))
+@pytest.mark.parametrize("workers", (1, 2))
+async def test_working_tarfile_compression(context, compression, workers):
+    context.config["compression_workers"] = workers
+    context.config["compression_block_size"] = 1024
+    await helper_archive(context, f"foo.tar.{compression}", sign._create_tarfile, sign._extract_tarfile, compression)
+
+
+@pytest.mark.asyncio
+async def test_create_tarfile_hard_linked(context):
+    upstream = os.path.join(context.config["work_dir"], "upstream.tar.gz")
+    to = os.path.join(context.config["work_dir"], "foo.tar.gz")
+    await sign._create_tarfile(context, upstream, [__file__], "gz", tmp_dir=BASE_DIR)
+    with open(upstream, "rb") as fh:
+        orig = fh.read()
+    os.link(upstream, to)
+    await sign._create_tarfile(context, to, [SERVER_CONFIG_PATH], "gz", tmp_dir=BASE_DIR)
+    with open(upstream, "rb") as fh:
+        assert fh.read() == orig
+    assert not os.path.samefile(upstream, to)
+    with tarfile.open(to) as t:
+        assert t.getnames() == [os.path.relpath(SERVER_CONFIG_PATH, BASE_DIR)]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("compression", ("gz", "bz2", "xz"))
+async def test_create_tarfile_single_stream_by_default(context, compression):
+    # Parallel compression writes several members, which stream readers stop after
+    to = os.path.join(context.config["work_dir"], f"foo.tar.{compression}")
+    await sign._create_tarfile(context, to, [__file__, SERVER_CONFIG_PATH], compression, tmp_dir=BASE_DIR)
+    with tarfile.open(to, mode=f"r|{compression}") as t:
+        assert [m.name for m in t] == [os.path.relpath(__file__, BASE_DIR), os.path.relpath(SERVER_CONFIG_PATH, BASE_DIR)]
+
+
+@pytest.mark.asyncio
+async def test_create_tarfile_shared_executor(context, mocker):
+    context.config["compression_workers"] = 2
+    context.compression_executor = mocker.sentinel.executor
+    create = mocker.patch.object(sign, "create_parallel_tarfile")
+    to = os.path.join(context.config["work_dir"], "foo.tar.gz")
+    await sign._create_tarfile(context, to, [__file__], "gz", tmp_dir=BASE_DIR)
+    assert create.call_args.kwargs["executor"] is mocker.sentinel.executor
+
+
+@pytest.mark.asyncio
+async def test_create_tarfile_process_executor(context):
+    context.config.update({"executor_type": "process", "compression_workers": 2})
+    with utils.get_executor(context.config) as context.executor, get_compression_executor(context.config) as context.compression_executor:
+        to = os.path.join(context.config["work_dir"], "foo.tar.gz")
+        await sign._create_tarfile(context, to, [__file__], "gz", tmp_dir=BASE_DIR)
+    with tarfile.open(to) as t:
+        assert t.getnames() == [os.path.relpath(__file__, BASE_DIR)]
+
+
 @pytest.mark.asyncio
 async def test_bad_create_tarfile(context, mocker):
     mocker.patch.object(tarfile, "open", new=context_die)
@@ -763,7 +1215,8 @@ async def test_tarfile_append_write(context):
     # mode='w' -- tarfile should only have these two files
     shutil.copyfile(os.path.join(TEST_DATA_DIR, "test.tar.bz2"), to)
     await sign._create_tarfile(context, to, abs_files, "bz2", tmp_dir=top_dir)
-    assert sorted(await sign._get_tarfile_files(to, "bz2")) == rel_files
+    with tarfile.open(to, mode="r:bz2") as t:
+        assert sorted(m.name for m in t.getmembers() if m.isfile()) == rel_files
 
 
 def test_signreq_task_keyid():
@@ -815,6 +1268,70 @@ async def test_bad_autograph_format(context):
         await sign.sign_hash_with_autograph(context, "", "gpg")
 
 
+@pytest.mark.asyncio
+async def test_sign_hash_with_autograph_batched(context, mocker):
+    batches = []
+
+    async def send(key, hashes):
+        batches.append((key, hashes))
+        return [base64.b64encode(b"sig:" + h).decode() for h in hashes]
+
+    context.autograph_configs = {
+        TEST_CERT_TYPE: [utils.Autograph("https://autograph", "alice", "secret", ["autograph_hash_only_mar384"])],
+    }
+    context.hash_batcher = RequestBatcher(send, window=0.01)
+    signatures = await asyncio.gather(
+        sign.sign_hash_with_autograph(context, b"hash1", "autograph_hash_only_mar384"),
+        sign.sign_hash_with_autograph(context, b"hash2", "autograph_hash_only_mar384"),
+        sign.sign_hash_with_autograph(context, b"hash3", "autograph_hash_only_mar384", keyid="keyid1"),
+    )
+    assert signatures == [b"sig:hash1", b"sig:hash2", b"sig:hash3"]
+    assert len(batches) == 2
+    assert batches[0][0] == ("https://autograph", "alice", "secret", "autograph_hash_only_mar384", None)
+    assert batches[0][1] == [b"hash1", b"hash2"]
+    assert batches[1][0] == ("https://autograph", "alice", "secret", "autograph_hash_only_mar384", "keyid1")
+    assert batches[1][1] == [b"hash3"]
+
+
+@pytest.mark.asyncio
+async def test_sign_hash_with_autograph_cached(context, mocker, tmp_path):
+    context.autograph_configs = {
+        TEST_CERT_TYPE: [utils.Autograph("https://autograph", "alice", "secret", ["autograph_hash_only_mar384"])],
+    }
+    context.signing_cache = SigningCache(str(tmp_path))
+    mocked_session = MockedSession(signature=base64.b64encode(b"sig"))
+    mocker.patch.object(context, "session", new=mocked_session)
+
+    assert await sign.sign_hash_with_autograph(context, b"hash1", "autograph_hash_only_mar384") == b"sig"
+    assert await sign.sign_hash_with_autograph(context, b"hash1", "autograph_hash_only_mar384") == b"sig"
+    assert mocked_session.post.call_count == 1
+    assert await sign.sign_hash_with_autograph(context, b"hash1", "autograph_hash_only_mar384", keyid="keyid1") == b"sig"
+    assert await sign.sign_hash_with_autograph(context, b"hash2", "autograph_hash_only_mar384") == b"sig"
+    assert mocked_session.post.call_count == 3
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("signatures,raises", ((["c2lnMQ==", "c2lnMg=="], False), (["c2lnMQ=="], True)))
+async def test_sign_hash_batch_with_autograph(mocker, signatures, raises):
+    session = mock.MagicMock()
+
+    async def post(url, **kwargs):
+        session.body = b"".join([chunk async for chunk in kwargs["data"]])
+        return mocked_response([{"signature": s} for s in signatures], None)
+
+    session.post = post
+    key = ("https://autograph", "user", "secret", "autograph_hash_only_mar384", "keyid1")
+    if raises:
+        with pytest.raises(SigningScriptError):
+            await sign.sign_hash_batch_with_autograph(session, key, [b"hash1", b"hash2"])
+    else:
+        assert await sign.sign_hash_batch_with_autograph(session, key, [b"hash1", b"hash2"]) == signatures
+    assert json.loads(session.body) == [
+        {"input": "aGFzaDE=", "keyid": "keyid1"},
+        {"input": "aGFzaDI=", "keyid": "keyid1"},
+    ]
+
+
 @pytest.mark.asyncio
 @pytest.mark.parametrize("blessed", (True, False))
 async def test_widevine_autograph(context, mocker, tmp_path, blessed):
@@ -853,6 +1370,25 @@ async def test_no_widevine(context, mocker, tmp_path):
         to = await sign.sign_widevine_with_autograph(context, "from", True, "autograph_widevine", to=to)
 
 
+@pytest.mark.asyncio
+async def test_sign_file_detached_metrics(context, mocker, tmp_path):
+    path = tmp_path / "hello.txt"
+    path.write_bytes(b"Hello there!")
+    mocked_session = MockedSession(signature=base64.b64encode(b"0" * 512))
+    mocker.patch.object(context, "session", new=mocked_session)
+    context.autograph_configs = {TEST_CERT_TYPE: [utils.Autograph("https://autograph.example.com", "alice", "secret", ["autograph_rsa"])]}
+
+    collector = metrics.SigningMetrics()
+    with metrics.activate(collector), metrics.signing("hello.txt", "autograph_rsa"):
+        await sign.sign_file_detached(context, str(path), "autograph_rsa")
+    stages = {s["stage"]: s for s in collector.samples}
+    assert sorted(stages) == ["autograph", "hash"]
+    assert stages["autograph"]["bytes_up"] == len(mocked_session.body)
+    assert stages["autograph"]["bytes_down"] > 0
+    assert stages["hash"]["path"] == "hello.txt"
+    assert stages["hash"]["format"] == "autograph_rsa"
+
+
 @pytest.mark.asyncio
 async def test_gpg_autograph(context, mocker, tmp_path):
     tmp = tmp_path / "file.txt"
@@ -878,6 +1414,24 @@ async def test_gpg_autograph(context, mocker, tmp_path):
         result = await sign.sign_gpg_with_autograph(context, tmp, "gpg")
 
 
+@pytest.mark.asyncio
+async def test_gpg_autograph_cached(context, mocker, tmp_path):
+    tmp = tmp_path / "file.txt"
+    tmp.write_text("hello world")
+    context.autograph_configs = {
+        TEST_CERT_TYPE: [utils.Autograph("https://autograph-hsm.dev.mozaws.net", "alice", "secret", ["autograph_gpg"])],
+    }
+    context.signing_cache = SigningCache(str(tmp_path / "cache"))
+    mocker.patch.object(sign, "verify_gpg", new=noop_async)
+    mocked_sign = mocker.patch.object(sign, "sign_with_autograph")
+    mocked_sign.return_value = async_mock_return_value("--- FAKE SIG ---")
+
+    for _ in range(2):
+        await sign.sign_gpg_with_autograph(context, tmp, "autograph_gpg")
+        assert (tmp_path / "file.txt.asc").read_text() == "--- FAKE SIG ---"
+    assert mocked_sign.call_count == 1
+
+
 # sign_omnija {{{1  -- 537
 @pytest.mark.asyncio
 @pytest.mark.parametrize(
@@ -916,14 +1470,13 @@ async def test_sign_omnija(context, mocker, filename, raises, nofiles):
     def fake_isfile(path):
         return "isdir" not in path
 
-    mocker.patch.object(sign, "_get_tarfile_files", new=fake_filelist)
     mocker.patch.object(sign, "_extract_tarfile", new=fake_untar)
     mocker.patch.object(sign, "_get_zipfile_files", new=fake_filelist)
     mocker.patch.object(sign, "_extract_zipfile", new=fake_unzip)
     mocker.patch.object(sign, "_convert_dmg_to_tar_gz", new=fake_undmg)
     mocker.patch.object(sign, "sign_omnija_with_autograph", new=noop_async)
     mocker.patch.object(sign, "_create_tarfile", new=noop_async)
-    mocker.patch.object(sign, "_create_zipfile", new=noop_async)
+    mocker.patch.object(sign, "_update_zipfile", new=noop_async)
     mocker.patch.object(os.path, "isfile", new=fake_isfile)
 
     if raises:
@@ -952,25 +1505,26 @@ async def test_omnija_same(mocker, tmpdir, orig):
     shutil.copyfile(os.path.join(TEST_DATA_DIR, orig), copy_from)
     copy_to = os.path.join(tmpdir, "new_omni.ja")
 
-    class mockedZipFile(object):
-        def __init__(self, name, mode, *args, **kwargs):
-            assert name == "signed.ja"
-            assert mode == "r"
+    signed = os.path.join(tmpdir, "signed.ja")
+    with zipfile.ZipFile(signed, "w") as z:
+        z.writestr("foobar", "foobar")
+        z.writestr("baseball", "baseball")
 
-        def namelist(self):
-            return ["foobar", "baseball"]
-
-    mocker.patch.object(sign.zipfile, "ZipFile", mockedZipFile)
-    await sign.merge_omnija_files(copy_from, "signed.ja", copy_to)
+    await sign.merge_omnija_files(copy_from, signed, copy_to)
     assert open(copy_from, "rb").read() == open(copy_to, "rb").read()
 
 
+# The signed META-INF members are copied as autograph compressed them, where
+# mozjar.JarWriter used to store them with the original jar's compression, so
+# only their bytes differ from the JarWriter merge. The original entries are
+# laid out the same; test_merge_omnija_files_copies_entries checks them, and
+# that everything reads back through mozjar.
 @pytest.mark.asyncio
 @pytest.mark.parametrize(
     "orig,signed,sha256_expected",
     (
-        ("no_preload_unsigned_omni.ja", "no_preload_signed_omni.ja", "9b05478ca8774d13c9a5f1699b90a10ffd283b9a21b8ebe4653cd63f052cf107"),
-        ("preload_unsigned_omni.ja", "preload_signed_omni.ja", "c353145c32cb3b251d65f85bcdba0c96d361292dad932b85d30f1dfe0b073e3f"),
+        ("no_preload_unsigned_omni.ja", "no_preload_signed_omni.ja", "a100a53a8fc0b6b6440575c479c3acecc3504840f9a90333de5435adc2832ae8"),
+        ("preload_unsigned_omni.ja", "preload_signed_omni.ja", "2c0207bc612e9d36bcd806515e7f673d27587d3e38065dcc941d68e589a561f3"),
     ),
 )
 async def test_omnija_sign(tmpdir, mocker, context, orig, signed, sha256_expected):
@@ -985,6 +1539,62 @@ async def test_omnija_sign(tmpdir, mocker, context, orig, signed, sha256_expecte
     await sign.sign_omnija_with_autograph(context, copy_from, "autograph_omnija")
     sha256_actual = file_digest(open(copy_from, "rb"), "sha256").hexdigest()
     assert sha256_actual == sha256_expected
+    assert not [f for f in os.listdir(tmpdir) if f.startswith(".oj_merged")]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "orig,signed",
+    (
+        ("no_preload_unsigned_omni.ja", "no_preload_signed_omni.ja"),
+        ("preload_unsigned_omni.ja", "preload_signed_omni.ja"),
+    ),
+)
+async def test_merge_omnija_files_copies_entries(tmpdir, orig, signed):
+    orig = os.path.join(TEST_DATA_DIR, orig)
+    signed = os.path.join(TEST_DATA_DIR, signed)
+    to = os.path.join(tmpdir, "merged.ja")
+    await sign.merge_omnija_files(orig, signed, to)
+
+    orig_jar = sign.mozjar.JarReader(orig)
+    merged_jar = sign.mozjar.JarReader(to)
+    assert merged_jar.is_optimized == orig_jar.is_optimized
+    assert merged_jar.last_preloaded == orig_jar.last_preloaded
+    signed_zip = zipfile.ZipFile(signed)
+    meta_inf = [i.filename for i in signed_zip.infolist() if i.filename.startswith("META-INF") and not i.is_dir()]
+    assert list(merged_jar.entries) == list(orig_jar.entries) + meta_inf
+
+    orig_data = open(orig, "rb").read()
+    merged_data = open(to, "rb").read()
+    for name, entry in orig_jar.entries.items():
+        # local headers and compressed data are copied as is
+        merged_entry = merged_jar.entries[name]
+        length = sign.mozjar.JarLocalFileHeader(orig_data[entry["offset"] :]).size + entry["compressed_size"]
+        assert merged_data[merged_entry["offset"] :][:length] == orig_data[entry["offset"] :][:length]
+        # and read back the same through mozjar, like Gecko's reader
+        assert merged_jar[name].read() == orig_jar[name].read()
+    for name in meta_inf:
+        assert merged_jar.entries[name]["compression"] == signed_zip.getinfo(name).compress_type
+        assert merged_jar[name].read() == signed_zip.read(name)
+
+
+@pytest.mark.asyncio
+async def test_omnija_sign_failure(tmpdir, mocker, context):
+    omnija_dir = os.path.join(tmpdir, "omnija")
+    os.mkdir(omnija_dir)
+    copy_from = os.path.join(omnija_dir, "omni.ja")
+    shutil.copyfile(os.path.join(TEST_DATA_DIR, "preload_unsigned_omni.ja"), copy_from)
+
+    async def mocked_autograph(context, from_, fmt, to, extension_id):
+        with open(to, "wb") as fh:
+            fh.write(b"not a zip")
+
+    mocker.patch.object(sign, "sign_file_with_autograph", mocked_autograph)
+    with pytest.raises(zipfile.BadZipFile):
+        await sign.sign_omnija_with_autograph(context, copy_from, "autograph_omnija")
+    assert open(copy_from, "rb").read() == open(os.path.join(TEST_DATA_DIR, "preload_unsigned_omni.ja"), "rb").read()
+    assert os.listdir(omnija_dir) == ["omni.ja"]
+    assert [f for f in os.listdir(context.config["work_dir"]) if f.startswith("oj_signed")] == []
 
 
 def test_langpack_id_regex():
@@ -1090,7 +1700,7 @@ async def test_authenticode_sign_zip(tmpdir, mocker, context, fmt, use_comment):
             return True
 
     mocker.patch.object(sign, "retry_async", new=fake_retry_async)
-    mocker.patch.object(winsign.sign, "sign_file", mocked_winsign)
+    mocker.patch.object(authenticode, "sign_file", mocked_winsign)
     mocker.patch.object(winsign.osslsigncode, "is_signed", mocked_issigned)
     mocker.patch.object(sign, "sign_hash_with_autograph", mocked_autograph)
 
@@ -1135,7 +1745,7 @@ async def test_authenticode_sign_msi(tmpdir, mocker, context, fmt, use_comment):
             return True
 
     mocker.patch.object(sign, "retry_async", new=fake_retry_async)
-    mocker.patch.object(winsign.sign, "sign_file", mocked_winsign)
+    mocker.patch.object(authenticode, "sign_file", mocked_winsign)
     mocker.patch.object(winsign.osslsigncode, "is_signed", mocked_issigned)
     mocker.patch.object(sign, "sign_hash_with_autograph", mocked_autograph)
 
@@ -1144,6 +1754,72 @@ async def test_authenticode_sign_msi(tmpdir, mocker, context, fmt, use_comment):
     assert os.path.exists(result)
 
 
+@pytest.mark.asyncio
+async def test_authenticode_sign_zip_only_rewrites_signed_files(tmp_path, mocker, context):
+    test_file = tmp_path / "windows.zip"
+    with zipfile.ZipFile(test_file, "w", compression=zipfile.ZIP_DEFLATED) as z:
+        z.writestr("firefox/firefox.exe", b"exe")
+        z.writestr("firefox/xul.dll", b"dll")
+        z.writestr("firefox/omni.ja", b"omni" * 1000)
+    with zipfile.ZipFile(test_file) as z:
+        omni_info = z.getinfo("firefox/omni.ja")
+    signed = []
+
+    async def mocked_sign_authenticode_file(context, path, fmt, **kwargs):
+        signed.append(os.path.relpath(path, os.path.dirname(os.path.dirname(path))))
+        with open(path, "ab") as f:
+            f.write(b" signed")
+        return True
+
+    mocker.patch.object(sign, "sign_authenticode_file", mocked_sign_authenticode_file)
+    assert await sign.sign_authenticode(context, str(test_file), "autograph_authenticode_sha2") == str(test_file)
+    assert sorted(signed) == ["firefox/firefox.exe", "firefox/xul.dll"]
+    with zipfile.ZipFile(test_file) as z:
+        assert z.namelist() == ["firefox/firefox.exe", "firefox/xul.dll", "firefox/omni.ja"]
+        assert z.read("firefox/firefox.exe") == b"exe signed"
+        assert z.read("firefox/xul.dll") == b"dll signed"
+        assert z.read("firefox/omni.ja") == b"omni" * 1000
+        assert z.getinfo("firefox/omni.ja").compress_size == omni_info.compress_size
+
+
+@pytest.mark.asyncio
+async def test_authenticode_sign_zip_skips_signed_files(tmp_path, mocker, context):
+    test_file = tmp_path / "windows.zip"
+    with zipfile.ZipFile(test_file, "w", compression=zipfile.ZIP_DEFLATED) as z:
+        z.writestr("firefox/firefox.exe", make_pe(signed=True))
+        z.writestr("firefox/xul.dll", make_pe(signed=False))
+    signed = []
+
+    async def mocked_sign_authenticode_file(context, path, fmt, **kwargs):
+        signed.append(os.path.basename(path))
+        return True
+
+    mocker.patch.object(sign, "sign_authenticode_file", mocked_sign_authenticode_file)
+    update = mocker.patch.object(sign, "_update_zipfile", new=mock.AsyncMock())
+    assert await sign.sign_authenticode(context, str(test_file), "autograph_authenticode_sha2") == str(test_file)
+    assert signed == ["xul.dll"]
+    update.assert_awaited_once()
+    assert [os.path.basename(f) for f in update.await_args.args[2]] == ["xul.dll"]
+
+
+@pytest.mark.asyncio
+async def test_authenticode_sign_zip_all_signed(tmp_path, mocker, context):
+    test_file = tmp_path / "windows.zip"
+    with zipfile.ZipFile(test_file, "w", compression=zipfile.ZIP_DEFLATED) as z:
+        z.writestr("firefox/firefox.exe", make_pe(signed=True))
+        z.writestr("firefox/xul.dll", make_pe(0x10B, signed=True))
+    orig = test_file.read_bytes()
+    orig_mtime = os.stat(test_file).st_mtime_ns
+
+    extract = mocker.patch.object(sign, "_extract_zipfile", new=mock.AsyncMock())
+    sign_file = mocker.patch.object(sign, "sign_authenticode_file", new=mock.AsyncMock())
+    assert await sign.sign_authenticode(context, str(test_file), "autograph_authenticode_sha2") == str(test_file)
+    extract.assert_not_awaited()
+    sign_file.assert_not_awaited()
+    assert test_file.read_bytes() == orig
+    assert os.stat(test_file).st_mtime_ns == orig_mtime
+
+
 @pytest.mark.asyncio
 async def test_authenticode_sign_zip_nofiles(tmpdir, mocker, context):
     context.config["authenticode_cert"] = os.path.join(TEST_DATA_DIR, "windows.crt")
@@ -1160,7 +1836,7 @@ async def test_authenticode_sign_zip_nofiles(tmpdir, mocker, context):
         shutil.copyfile(infile, outfile)
         return True
 
-    mocker.patch.object(winsign.sign, "sign_file", mocked_winsign)
+    mocker.patch.object(authenticode, "sign_file", mocked_winsign)
     with pytest.raises(SigningScriptError):
         await sign.sign_authenticode(context, test_file, "autograph_authenticode_sha2")
 
@@ -1181,11 +1857,31 @@ async def test_authenticode_sign_zip_error(tmpdir, mocker, context):
         return False
 
     mocker.patch.object(sign, "retry_async", new=fake_retry_async)
-    mocker.patch.object(winsign.sign, "sign_file", mocked_winsign)
+    mocker.patch.object(authenticode, "sign_file", mocked_winsign)
     with pytest.raises(SigningScriptError):
         await sign.sign_authenticode(context, test_file, "autograph_authenticode_sha2")
 
 
+@pytest.mark.asyncio
+async def test_sign_authenticode_files_cancels_on_error(mocker, context):
+    cancelled = []
+
+    async def mocked_sign(context, path, fmt, *, authenticode_comment=None):
+        if path == "bad.exe":
+            raise SigningScriptError("bad")
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(path)
+            raise
+
+    mocker.patch.object(sign, "sign_authenticode_file", mocked_sign)
+    with pytest.raises(SigningScriptError, match="bad"):
+        await sign._sign_authenticode_files(context, ["a.exe", "bad.exe", "b.exe"], "autograph_authenticode_sha2", None)
+    # The other files were cancelled, and waited for, before the error was raised
+    assert sorted(cancelled) == ["a.exe", "b.exe"]
+
+
 @pytest.mark.asyncio
 async def test_authenticode_sign_authenticode_permanent_error(tmpdir, mocker, context, caplog):
     context.config["authenticode_cert"] = os.path.join(TEST_DATA_DIR, "windows.crt")
@@ -1208,7 +1904,7 @@ async def test_authenticode_sign_authenticode_permanent_error(tmpdir, mocker, co
 
     mocker.patch.object(sign, "retry_async", new=fake_retry_async)
     mocker.patch.object(sign, "sign_hash_with_autograph", mocked_authenticode_sign)
-    mocker.patch.object(winsign.sign, "sign_file", mocked_winsign)
+    mocker.patch.object(authenticode, "sign_file", mocked_winsign)
 
     with pytest.raises(Exception):
         await sign.sign_authenticode(context, test_file, "autograph_authenticode_sha2")
@@ -1243,7 +1939,7 @@ async def test_winsign_helper_clears_stale_outfile_between_retries(tmpdir, mocke
             return False
         return True
 
-    mocker.patch.object(winsign.sign, "sign_file", mocked_winsign)
+    mocker.patch.object(authenticode, "sign_file", mocked_winsign)
 
     # First attempt: winsign returns False -> helper raises. outfile is left behind.
     with pytest.raises(SigningScriptError):
@@ -1315,7 +2011,7 @@ async def test_authenticode_sign_single_file(tmpdir, mocker, context):
         shutil.copyfile(infile, outfile)
         return True
 
-    mocker.patch.object(winsign.sign, "sign_file", mocked_winsign)
+    mocker.patch.object(authenticode, "sign_file", mocked_winsign)
     mocker.patch.object(sign, "sign_hash_with_autograph", mocked_autograph)
 
     result = await sign.sign_authenticode(context, test_file, "autograph_authenticode_sha2")
@@ -1354,7 +2050,7 @@ async def test_authenticode_sign_keyids(tmpdir, mocker, context, keyid):
         shutil.copyfile(infile, outfile)
         return True
 
-    mocker.patch.object(winsign.sign, "sign_file", mocked_winsign)
+    mocker.patch.object(authenticode, "sign_file", mocked_winsign)
     mocker.patch.object(sign, "sign_hash_with_autograph", mocked_autograph)
 
     result = await sign.sign_authenticode(context, test_file, f"autograph_authenticode_sha2:{keyid}")
@@ -1392,7 +2088,7 @@ async def test_authenticode_sign_ev(tmpdir, mocker, context, keyid):
         shutil.copyfile(infile, outfile)
         return True
 
-    mocker.patch.object(winsign.sign, "sign_file", mocked_winsign)
+    mocker.patch.object(authenticode, "sign_file", mocked_winsign)
     mocker.patch.object(sign, "sign_hash_with_autograph", mocked_autograph)
 
     fmt = "gcp_prod_autograph_authenticode_ev_202412"
@@ -1403,28 +2099,72 @@ async def test_authenticode_sign_ev(tmpdir, mocker, context, keyid):
     assert os.path.exists(result)
 
 
-def test_encode_single_file(tmpdir, mocker, context):
+@pytest.mark.parametrize("block_size", (3, 6, sign.DEFAULT_ENCODE_BLOCK_SIZE))
+def test_encode_single_file(tmpdir, mocker, context, block_size):
     output_file = tempfile.TemporaryFile("w+b")
     signing_req = {"keyid": "rvkgu", "options": {"zip": "passthrough"}, "input": BufferedRandom(BytesIO(b"RmUOX3AesiyzSlh"))}
-    sign.write_signing_req_to_disk(output_file, signing_req)
+    sign.write_signing_req_to_disk(output_file, signing_req, block_size)
     output_file.seek(0)
     result = json.loads(output_file.read().decode())
     expected = [{"keyid": "rvkgu", "options": {"zip": "passthrough"}, "input": "Um1VT1gzQWVzaXl6U2xo"}]
     assert result == expected
 
 
+@pytest.mark.parametrize("block_size", (0, 4, 1024))
+def test_encode_bad_block_size(block_size):
+    with pytest.raises(SigningScriptError):
+        list(sign.iter_signing_req({"input": BytesIO(b"foo")}, block_size))
+
+
+def test_get_hawk_content_hash_chunks():
+    body = b'[{"input":"Zm9v"}]'
+    expected = sign.get_hawk_content_hash(BytesIO(body), "application/json")
+    assert sign.get_hawk_content_hash([body[:5], body[5:]], "application/json") == expected
+    assert expected == mohawk.util.calculate_payload_hash(body, "sha256", "application/json").decode()
+
+
+@pytest.mark.asyncio
+async def test_signing_request_body():
+    signing_req = {"input": BytesIO(b"a" * 100), "keyid": "key"}
+    request_body = sign.SigningRequestBody(signing_req, "application/json", block_size=30)
+    content_hash = request_body.prepare()
+    body = b"".join([chunk async for chunk in request_body])
+    assert json.loads(body) == [{"input": base64.b64encode(b"a" * 100).decode(), "keyid": "key"}]
+    assert request_body.size == len(body)
+    assert content_hash == sign.get_hawk_content_hash(BytesIO(body), "application/json")
+    # The body can be iterated over again for retries
+    assert b"".join([chunk async for chunk in request_body]) == body
+
+
+@pytest.mark.asyncio
+async def test_call_autograph_streams_body(mocker):
+    received = {}
+
+    async def handler(request):
+        received["headers"] = request.headers
+        received["body"] = await request.read()
+        return aiohttp.web.json_response([{"signature": "c2ln"}])
+
+    app = aiohttp.web.Application()
+    app.router.add_post("/sign/hash", handler)
+    async with aiohttp.test_utils.TestServer(app) as server, aiohttp.ClientSession() as session:
+        signing_req = {"input": BytesIO(b"hash" * 1000)}
+        url = str(server.make_url("/sign/hash"))
+        resp = await sign.call_autograph(session, url, "user", "secret", signing_req, block_size=300)
+    assert resp == [{"signature": "c2ln"}]
+    assert "chunked" not in received["headers"].get("Transfer-Encoding", "")
+    assert int(received["headers"]["Content-Length"]) == len(received["body"])
+    assert json.loads(received["body"]) == [{"input": base64.b64encode(b"hash" * 1000).decode()}]
+    content_hash = mohawk.util.calculate_payload_hash(received["body"], "sha256", "application/json").decode()
+    assert f'hash="{content_hash}"' in received["headers"]["Authorization"]
+
+
 class MockedFilesSession:
     def __init__(self, signed_files):
         self.signed_files = signed_files
 
     async def post(self, *args, **kwargs):
-        resp = mock.MagicMock()
-        resp.status = 200
-        resp.ok = True
-        future = asyncio.Future()
-        future.set_result([{"signed_files": self.signed_files}])
-        resp.json.return_value = future
-        return resp
+        return mocked_response([{"signed_files": self.signed_files}])
 
 
 @pytest.mark.asyncio
@@ -1440,6 +2180,7 @@ async def test_sign_rpm_pkg(mocker, context):
         f.write(b"original-rpm-content")
         f.flush()
         rpm_path = f.name
+        os.chmod(rpm_path, 0o644)
 
         session = MockedFilesSession([{"name": os.path.basename(rpm_path), "content": base64.b64encode(signed_content).decode()}])
         mocker.patch.object(context, "session", session)
@@ -1448,6 +2189,7 @@ async def test_sign_rpm_pkg(mocker, context):
         assert result == rpm_path
         with open(rpm_path, "rb") as rf:
             assert rf.read() == signed_content
+        assert stat.S_IMODE(os.stat(rpm_path).st_mode) == 0o644
 
 
 @pytest.mark.asyncio
@@ -1456,16 +2198,40 @@ async def test_sign_rpm_pkg_wrong_extension(context):
         await sign.sign_rpm_pkg(context, "/path/to/file.txt", "autograph_rpmsign")
 
 
+@pytest.mark.asyncio
+async def test_call_autograph_decodes_to_disk(tmp_path):
+    signed = os.urandom(5000)
+
+    async def handler(request):
+        await request.read()
+        return aiohttp.web.json_response([{"signed_file": base64.b64encode(signed).decode()}])
+
+    app = aiohttp.web.Application()
+    app.router.add_post("/sign/file", handler)
+    async with aiohttp.test_utils.TestServer(app) as server, aiohttp.ClientSession() as session:
+        url = str(server.make_url("/sign/file"))
+        resp = await sign.call_autograph(session, url, "user", "secret", {"input": BytesIO(b"unsigned")}, block_size=300, decode_dir=tmp_path)
+    assert os.path.dirname(resp[0]["signed_file"]) == str(tmp_path)
+    with open(resp[0]["signed_file"], "rb") as f:
+        assert f.read() == signed
+
+
+def test_encode_batch():
+    signing_reqs = [sign.make_signing_req(BytesIO(h), "autograph_hash_only_mar384", "hash", keyid="key") for h in (b"hash1", b"hash2")]
+    result = json.loads(b"".join(sign.iter_signing_req(signing_reqs, block_size=3)))
+    assert result == [
+        {"keyid": "key", "input": "aGFzaDE="},
+        {"keyid": "key", "input": "aGFzaDI="},
+    ]
+
+
 def test_encode_multiple_files():
-    output_file = tempfile.TemporaryFile("w+b")
     input_files = [
         {"name": "file1.rpm", "content": BufferedRandom(BytesIO(b"content1"))},
         {"name": "file2.rpm", "content": BufferedRandom(BytesIO(b"content2"))},
     ]
     signing_req = {"keyid": "testkey", "files": input_files}
-    sign._encode_multiple_files(output_file, signing_req)
-    output_file.seek(0)
-    result = json.loads(output_file.read().decode())
+    result = json.loads(b"".join(sign.iter_signing_req(signing_req, block_size=3)))
     expected = [
         {
             "keyid": "testkey",
@@ -1,3 +1,4 @@
+import dataclasses
 import os
 
 import pytest
@@ -136,10 +137,28 @@ async def test_sign(context, mocker, format, filename, post_files):
     def fake_log(context, new_files, *args):
         assert new_files == post_files
 
-    mocker.patch.object(stask, "FORMAT_TO_SIGNING_FUNCTION", new=fake_format_to)
+    mocker.patch.object(stask, "FORMAT_REGISTRY", new=stask.FormatRegistry(fake_format_to))
     await stask.sign(context, filename, [format])
 
 
+@pytest.mark.asyncio
+@pytest.mark.parametrize("format, unlinked", (("macapp", True), ("autograph_hash_only_mar384", False), ("autograph_gpg", False)))
+async def test_sign_breaks_links(context, mocker, format, unlinked):
+    upstream = os.path.join(context.config["work_dir"], "upstream")
+    path = os.path.join(context.config["work_dir"], "target.tar.gz")
+    with open(upstream, "wb") as fh:
+        fh.write(b"unsigned")
+    os.link(upstream, path)
+    signing_format = stask.FORMAT_REGISTRY.get(format)
+
+    async def fake_sign(_, path, *args, **kwargs):
+        return path
+
+    mocker.patch.object(stask, "FORMAT_REGISTRY", new=mocker.Mock(get=lambda fmt: dataclasses.replace(signing_format, signing_function=fake_sign)))
+    await stask.sign(context, path, [format])
+    assert os.path.samefile(upstream, path) is not unlinked
+
+
 @pytest.mark.parametrize(
     "format, expected",
     (
@@ -193,6 +212,65 @@ def test_get_signing_function_from_format(format, expected):
     assert stask._get_signing_function_from_format(format) == expected
 
 
+# FormatRegistry {{{1
+@pytest.mark.parametrize(
+    "format, keyid, is_xpi, is_apk, is_sha1_apk",
+    (
+        ("autograph_gpg", None, False, False, False),
+        ("autograph_authenticode_sha2:202404", "202404", False, False, False),
+        ("stage_autograph_omnija", None, True, False, False),
+        ("gcp_prod_autograph_langpack", None, True, False, False),
+        ("system_addon", None, True, False, False),
+        ("autograph_xpi_sha256_es256", None, True, False, False),
+        ("autograph_apk", None, False, False, False),
+        ("autograph_apk_focus", None, False, True, False),
+        ("gcp_prod_autograph_apk_sha1", None, False, True, True),
+        ("autograph_focus", None, False, True, False),
+    ),
+)
+def test_format_registry_properties(format, keyid, is_xpi, is_apk, is_sha1_apk):
+    signing_format = stask.FORMAT_REGISTRY.get(format)
+    assert signing_format.name == format
+    assert signing_format.keyid == keyid
+    assert signing_format.is_xpi is is_xpi
+    assert signing_format.is_apk is is_apk
+    assert signing_format.needs_zip_passthrough is is_apk
+    assert signing_format.is_sha1_apk is is_sha1_apk
+
+
+def test_format_registry_resolves_once(mocker):
+    registry = stask.FormatRegistry({"autograph_foo": stask.sign_xpi, "default": stask.sign_file})
+    assert "stage_autograph_foo" in registry._formats
+    assert "gcp_prod_autograph_gpg" in registry._formats
+    resolve = mocker.spy(registry, "_resolve")
+    first = registry.get("gcp_prod_autograph_foo:key1")
+    assert registry.get("gcp_prod_autograph_foo:key1") is first
+    assert registry.get("stage_autograph_foo") is registry.get("stage_autograph_foo")
+    assert resolve.call_count == 1
+    assert first.signing_function is stask.sign_xpi
+    assert first.keyid == "key1"
+
+
+# _sort_formats {{{1
+@pytest.mark.parametrize(
+    "formats, expected",
+    (
+        (["autograph_gpg", "autograph_mar384", "macapp", "widevine"], ["autograph_mar384", "widevine", "macapp", "autograph_gpg"]),
+        (
+            ["stage_autograph_gpg", "autograph_rsa", "gcp_prod_autograph_omnija", "autograph_authenticode_sha2", "autograph_widevine"],
+            ["autograph_authenticode_sha2", "autograph_widevine", "gcp_prod_autograph_omnija", "autograph_rsa", "stage_autograph_gpg"],
+        ),
+        # Only the exact formats in LAST_FORMATS are moved
+        (["autograph_gpg:keyid", "autograph_authenticode_sha2:202404"], ["autograph_gpg:keyid", "autograph_authenticode_sha2:202404"]),
+        (["gcp_prod_macapp", "autograph_gpg", "autograph_mar384"], ["gcp_prod_macapp", "autograph_mar384", "autograph_gpg"]),
+        (["b", "a", "c"], ["b", "a", "c"]),
+    ),
+)
+def test_sort_formats(formats, expected):
+    assert stask._sort_formats(formats) is formats
+    assert formats == expected
+
+
 # build_filelist_dict {{{1
 def test_build_filelist_dict(context, task_defn):
     full_path = os.path.join(context.config["work_dir"], "cot", "VALID_TASK_ID", "public/build/firefox-52.0a1.en-US.win64.installer.exe")
@@ -1,5 +1,7 @@
+import errno
 import json
 import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import mock
 import pytest
@@ -7,7 +9,7 @@ from conftest import PUB_KEY_PATH, read_file
 from scriptworker.context import Context
 
 import signingscript.utils as utils
-from signingscript.exceptions import FailedSubprocess, SigningServerError
+from signingscript.exceptions import FailedSubprocess, SigningScriptError, SigningServerError
 
 ID_RSA_PUB_HASH = "226658906e46b26ef195c468f94e2be983b6c53f370dff0d8e725832f" + "4645933de4755690a3438760afe8790a91938100b75b5d63e76ebd00920adc8d2a8857e"
 
@@ -121,6 +123,80 @@ def test_copy_to_dir_no_copy():
     assert utils.copy_to_dir(SERVER_CONFIG_PATH, os.path.dirname(SERVER_CONFIG_PATH)) is None
 
 
+@pytest.mark.parametrize("reflink", (True, False))
+def test_copy_to_dir_link(tmp_path, mocker, reflink):
+    source = tmp_path / "upstream" / "file"
+    source.parent.mkdir()
+    source.write_bytes(b"unsigned")
+    if not reflink:
+        mocker.patch.object(utils, "_reflink", return_value=False)
+    work_dir = tmp_path / "work"
+    (work_dir / "a").mkdir(parents=True)
+    (work_dir / "a" / "file").write_bytes(b"stale")
+
+    newpath = utils.copy_to_dir(str(source), str(work_dir), target="a/file", method="link")
+    assert newpath == str(work_dir / "a" / "file")
+    assert read_file(newpath) == "unsigned"
+    if not reflink:
+        assert os.path.samefile(source, newpath)
+
+    utils.break_link(newpath)
+    with open(newpath, "wb") as fh:
+        fh.write(b"signed")
+    assert source.read_bytes() == b"unsigned"
+
+
+@pytest.mark.parametrize("error", (errno.EXDEV, errno.EPERM))
+def test_copy_to_dir_link_falls_back_to_copy(tmp_path, mocker, error):
+    source = tmp_path / "file"
+    source.write_bytes(b"unsigned")
+    mocker.patch.object(utils, "_reflink", return_value=False)
+    mocker.patch.object(os, "link", side_effect=OSError(error, os.strerror(error)))
+    newpath = utils.copy_to_dir(str(source), str(tmp_path / "work"), method="link")
+    assert read_file(newpath) == "unsigned"
+    assert not os.path.samefile(source, newpath)
+
+
+def test_copy_to_dir_link_error(tmp_path, mocker):
+    source = tmp_path / "file"
+    source.write_bytes(b"unsigned")
+    mocker.patch.object(utils, "_reflink", return_value=False)
+    mocker.patch.object(os, "link", side_effect=OSError(errno.EIO, "I/O error"))
+    with pytest.raises(SigningServerError):
+        utils.copy_to_dir(str(source), str(tmp_path / "work"), method="link")
+
+
+def test_reflink_unsupported(tmp_path, mocker):
+    source = tmp_path / "file"
+    source.write_bytes(b"unsigned")
+    mocker.patch.object(utils.fcntl, "ioctl", side_effect=OSError(errno.EOPNOTSUPP, "Operation not supported"))
+    assert utils._reflink(str(source), str(tmp_path / "clone")) is False
+
+
+# break_link {{{1
+def test_break_link(tmp_path):
+    source = tmp_path / "file"
+    source.write_bytes(b"unsigned")
+    source.chmod(0o755)
+    linked = tmp_path / "linked"
+    os.link(source, linked)
+
+    assert utils.break_link(str(linked)) is True
+    assert not os.path.samefile(source, linked)
+    assert linked.read_bytes() == b"unsigned"
+    assert linked.stat().st_mode & 0o777 == 0o755
+    assert source.stat().st_nlink == 1
+    assert sorted(os.listdir(tmp_path)) == ["file", "linked"]
+
+
+def test_break_link_not_linked(tmp_path):
+    path = tmp_path / "file"
+    path.write_bytes(b"unsigned")
+    inode = path.stat().st_ino
+    assert utils.break_link(str(path)) is False
+    assert path.stat().st_ino == inode
+
+
 # execute_subprocess {{{1
 @pytest.mark.asyncio
 @pytest.mark.parametrize("exit_code", (1, 0))
@@ -133,6 +209,42 @@ async def test_execute_subprocess(exit_code):
         await utils.execute_subprocess(command, cwd="/tmp")
 
 
+# get_executor / run_in_executor {{{1
+@pytest.mark.parametrize(
+    "executor_type,expected,raises",
+    (
+        (None, ThreadPoolExecutor, False),
+        ("thread", ThreadPoolExecutor, False),
+        ("process", ProcessPoolExecutor, False),
+        ("fork", None, True),
+    ),
+)
+def test_get_executor(executor_type, expected, raises):
+    config = {"executor_workers": 2}
+    if executor_type:
+        config["executor_type"] = executor_type
+    if raises:
+        with pytest.raises(SigningScriptError):
+            utils.get_executor(config)
+    else:
+        with utils.get_executor(config) as executor:
+            assert isinstance(executor, expected)
+            assert executor._max_workers == 2
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("executor_type", (None, "thread", "process"))
+async def test_run_in_executor(executor_type):
+    context = Context()
+    if executor_type:
+        context.executor = utils.get_executor({"executor_type": executor_type})
+    try:
+        assert await utils.run_in_executor(context, utils.get_hash, __file__, hash_type="sha256") == utils.get_hash(__file__, "sha256")
+    finally:
+        if executor_type:
+            context.executor.shutdown()
+
+
 # is_sha1_apk_autograph_signing_format {{{1
 @pytest.mark.parametrize(
     "format,expected", (("autograph_apk_sha1", True), ("autograph_apk_not_sha1_but_sha384", False), ("foobar_sha1", False), ("foobar_sha384", False))